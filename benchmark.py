@@ -0,0 +1,604 @@
+"""
+Нагрузочный бенчмарк бота без сети: синтетические Update прогоняются через
+настоящий Dispatcher и обработчики main.py, Telegram подменяется на
+фейковый Request, Bitrix24 - на локальный HTTP-стаб с заданной задержкой.
+
+Нужна отдельная (тестовая) база PostgreSQL в DATABASE_URL:
+    DATABASE_URL=postgresql://localhost/bot_bench python benchmark.py --messages 5000
+    python benchmark.py --engine asyncio --bitrix-latency 200 --json after.json
+
+Обработчики в обоих движках одни и те же (потоки Dispatcher), поэтому
+--engine asyncio меняет прежде всего очередь CRM: задачи CRM/с и время
+от записи до завершения задачи.
+
+С --storage memory база не нужна: обработчики работают с MemoryStorage,
+очередь CRM не разбирается, /export исключается из смеси.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import asyncio
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from functools import wraps
+
+# ==========================================
+# ОКРУЖЕНИЕ (до импорта main - он читает настройки при импорте)
+# ==========================================
+
+STUB_HOST = "127.0.0.1"
+STUB_PORT = int(os.environ.get("BENCH_STUB_PORT", "18765"))
+STUB_URL = f"http://{STUB_HOST}:{STUB_PORT}"
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ["BITRIX_CONTACT_URL"] = f"{STUB_URL}/rest/1/bench/crm.contact.list"
+os.environ["BITRIX_TASK_URL"] = f"{STUB_URL}/rest/1/bench/task.item.add"
+os.environ["TELEGRAM_API_URL"] = f"{STUB_URL}/bot"
+os.environ.setdefault("CONTACTS_SYNC", "0")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+# Пустой DATABASE_URL допустим только для --storage memory (проверка в run_benchmark)
+os.environ.setdefault("DATABASE_URL", "")
+
+import main  # noqa: E402
+from telegram import Bot, Update  # noqa: E402
+from telegram.utils.request import Request  # noqa: E402
+
+# Сотрудники и категории бенчмарка - отдельные ID/коды, чтобы их можно было удалить
+BENCH_EMPLOYEE_BASE = 990000000
+BENCH_CATEGORIES = {"BN1": "Bench call", "BN2": "Bench email", "BN10": "Bench other"}
+
+# ==========================================
+# ЗАМЕРЫ ПО ЭТАПАМ
+# ==========================================
+
+class StageTimer:
+    """Длительности по этапам (обработчики, функции БД, вызовы CRM)"""
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, func, stage=None):
+        stage = stage or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - started)
+        return wrapper
+
+    def wrap_async(self, func, stage=None):
+        stage = stage or func.__name__
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - started)
+        return wrapper
+
+    def report(self):
+        """{этап: {count, p50, p95, p99, max}} в миллисекундах"""
+        result = {}
+        with self.lock:
+            for stage, values in sorted(self.samples.items()):
+                values = sorted(values)
+                result[stage] = {
+                    "count": len(values),
+                    "p50": percentile(values, 50) * 1000,
+                    "p95": percentile(values, 95) * 1000,
+                    "p99": percentile(values, 99) * 1000,
+                    "max": values[-1] * 1000,
+                }
+        return result
+
+def percentile(sorted_values, p):
+    """Перцентиль по ближайшему рангу"""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(p / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+timer = StageTimer()
+
+# Функции main.py, которые замеряются (обработчики берутся по имени при
+# регистрации, поэтому обёртки ставятся до build_updater)
+TIMED_FUNCTIONS = (
+    "handle_message", "parse_message", "resolve_message_context", "save_record", "add_record",
+    "handle_info_command", "get_records_by_phone", "find_contact_by_phone",
+    "handle_export_command", "handle_team_stats_command",
+    "claim_crm_jobs", "update_crm_job", "process_crm_job",
+)
+
+def instrument():
+    """Подменить функции main.py обёртками с замером времени"""
+    for name in TIMED_FUNCTIONS:
+        setattr(main, name, timer.wrap(getattr(main, name)))
+
+    for http_method in ("get", "post"):
+        original = getattr(main.bitrix, http_method)
+
+        def timed(method, *args, _original=original, **kwargs):
+            started = time.perf_counter()
+            try:
+                return _original(method, *args, **kwargs)
+            finally:
+                timer.add(f"bitrix:{method}", time.perf_counter() - started)
+        setattr(main.bitrix, http_method, timed)
+
+    main.AsyncEngine.process_crm_job = timer.wrap_async(main.AsyncEngine.process_crm_job)
+    main.AsyncEngine.claim_crm_jobs = timer.wrap_async(main.AsyncEngine.claim_crm_jobs)
+    original_request = main.AsyncBitrixClient.request
+
+    async def timed_request(self, http_method, method, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await original_request(self, http_method, method, **kwargs)
+        finally:
+            timer.add(f"bitrix:{method}", time.perf_counter() - started)
+    main.AsyncBitrixClient.request = timed_request
+
+# ==========================================
+# ЗАГЛУШКИ TELEGRAM И BITRIX24
+# ==========================================
+
+class FakeTelegramRequest(Request):
+    """Request для telegram.Bot без сети: ответы Bot API собираются на месте"""
+
+    __slots__ = ("latency", "message_id", "lock")
+
+    def __init__(self, latency=0.0):
+        super().__init__(con_pool_size=main.BOT_WORKERS + 4)
+        self.latency = latency
+        self.message_id = 0
+        self.lock = threading.Lock()
+
+    def post(self, url, data=None, timeout=None):
+        method = url.rsplit("/", 1)[-1]
+        if self.latency:
+            time.sleep(self.latency)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method.startswith("send"):
+            with self.lock:
+                self.message_id += 1
+                message_id = self.message_id
+            return {"message_id": message_id, "date": int(time.time()),
+                    "chat": {"id": int(data.get("chat_id", 0)), "type": "supergroup"}}
+        return True
+
+class BitrixStub(BaseHTTPRequestHandler):
+    """
+    Bitrix24 REST: crm.contact.list, task.item.add, crm.timeline.comment.add,
+    task.complete и batch; плюс sendMessage Bot API для asyncio-движка.
+    """
+
+    latency = 0.0
+    no_contact_ratio = 0.0
+    ids = iter(range(1, 10 ** 9))
+    ids_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def next_id(self):
+        with self.ids_lock:
+            return next(self.ids)
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def has_contact(self, phone):
+        return random.Random(phone).random() >= self.no_contact_ratio
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        time.sleep(self.latency)
+        phone = (parse_qs(url.query).get("filter[PHONE]") or [""])[0]
+        contacts = []
+        if phone and self.has_contact(phone):
+            contacts.append({"ID": phone[-7:].lstrip("0") or "1", "NAME": "Bench", "LAST_NAME": "Client",
+                             "PHONE": [{"VALUE": phone}], "DATE_MODIFY": "2024-01-01T00:00:00+03:00"})
+        self.send_json({"result": contacts, "total": len(contacts)})
+
+    def do_POST(self):
+        method = urlparse(self.path).path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        time.sleep(self.latency)
+        if method == "sendMessage":
+            return self.send_json({"ok": True, "result": {"message_id": 1, "date": 0, "chat": {"id": 0, "type": "group"}}})
+        if method == "batch":
+            commands = json.loads(body)["cmd"]
+            results = {name: (self.next_id() if cmd.startswith(("task.item.add", "crm.timeline")) else True)
+                       for name, cmd in commands.items()}
+            return self.send_json({"result": {"result": results, "result_error": []}})
+        if method in ("task.item.add", "crm.timeline.comment.add"):
+            return self.send_json({"result": self.next_id()})
+        self.send_json({"result": True})
+
+def start_stub(latency, no_contact_ratio):
+    BitrixStub.latency = latency
+    BitrixStub.no_contact_ratio = no_contact_ratio
+    server = ThreadingHTTPServer((STUB_HOST, STUB_PORT), BitrixStub)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="bitrix-stub", daemon=True).start()
+    return server
+
+# ==========================================
+# ДАННЫЕ И НАГРУЗКА
+# ==========================================
+
+def prepare_database(department, users):
+    """Схема, сотрудники и категории бенчмарка"""
+    main.init_database(migrate=True)
+    if not main.get_table_prefix(department):
+        sys.exit(f"❌ Неизвестный департамент: {department}")
+    conn = main.get_conn()
+    try:
+        with conn.cursor() as cur:
+            main.execute_values(
+                cur,
+                "INSERT INTO employees (department, telegram_id, name, bitrix_id) VALUES %s ON CONFLICT DO NOTHING",
+                [(department, BENCH_EMPLOYEE_BASE + i, f"Bench {i}", 1000 + i) for i in range(users)]
+            )
+            main.execute_values(
+                cur,
+                "INSERT INTO categories (department, code, name) VALUES %s ON CONFLICT DO NOTHING",
+                [(department, code, name) for code, name in BENCH_CATEGORIES.items()]
+            )
+        conn.commit()
+    finally:
+        main.release_conn(conn)
+    main.invalidate_reference_data(department)
+
+def prepare_memory_storage(department, users):
+    """Хранилище в памяти с сотрудниками и категориями бенчмарка"""
+    if not main.get_table_prefix(department):
+        sys.exit(f"❌ Неизвестный департамент: {department}")
+    main.storage = main.MemoryStorage()
+    for i in range(users):
+        main.add_employee(BENCH_EMPLOYEE_BASE + i, f"Bench {i}", 1000 + i, department)
+    for code, name in BENCH_CATEGORIES.items():
+        main.add_category(code, name, department)
+
+def cleanup_database(department):
+    """Удалить записи и задачи очереди сотрудников бенчмарка"""
+    conn = main.get_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                DELETE FROM crm_outbox WHERE department = %(department)s AND record_id IN (
+                    SELECT id FROM records WHERE department = %(department)s AND employee_telegram_id >= %(base)s
+                )
+                """,
+                {'department': department, 'base': BENCH_EMPLOYEE_BASE}
+            )
+            cur.execute(
+                "DELETE FROM records WHERE department = %s AND employee_telegram_id >= %s",
+                (department, BENCH_EMPLOYEE_BASE)
+            )
+            cur.execute(
+                "DELETE FROM employees WHERE department = %s AND telegram_id >= %s",
+                (department, BENCH_EMPLOYEE_BASE)
+            )
+            cur.execute(
+                "DELETE FROM categories WHERE department = %s AND code = ANY(%s)",
+                (department, list(BENCH_CATEGORIES))
+            )
+        conn.commit()
+    finally:
+        main.release_conn(conn)
+    main.invalidate_reference_data(department)
+
+def department_chat_id(department):
+    if department not in main.department_by_name:
+        raise SystemExit(f"❌ Нет чата для департамента {department}")
+    return main.department_by_name[department]["chat_id"]
+
+def parse_mix(text):
+    """'record=70,noise=15' -> {'record': 70, 'noise': 15}"""
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        mix[kind.strip()] = float(weight)
+    unknown = set(mix) - {"record", "noise", "duplicate", "info", "export"}
+    if unknown:
+        raise SystemExit(f"❌ Неизвестные типы сообщений: {', '.join(sorted(unknown))}")
+    return mix
+
+def generate_messages(count, users, phones, mix, seed):
+    """Поток (user_id, text) с заданной смесью типов сообщений"""
+    rng = random.Random(seed)
+    kinds, weights = zip(*mix.items())
+    phone_pool = [f"+38067{rng.randrange(10 ** 7):07d}" for _ in range(phones)]
+    last_record = {}
+    messages = []
+
+    while len(messages) < count:
+        kind = rng.choices(kinds, weights)[0]
+        user = BENCH_EMPLOYEE_BASE + rng.randrange(users)
+        if kind == "duplicate" and user in last_record:
+            messages.append((user, last_record[user]))
+            messages.append((user, "Так"))
+        elif kind in ("record", "duplicate"):
+            code = rng.choice(list(BENCH_CATEGORIES))
+            text = f"{code} {rng.choice(phone_pool)} | bench comment {len(messages)}"
+            last_record[user] = text
+            messages.append((user, text))
+        elif kind == "noise":
+            messages.append((user, rng.choice(("ок", "дякую, передзвоню", "хто на лінії?", "+380 не відповідає"))))
+        elif kind == "info":
+            messages.append((user, f"/info {rng.choice(phone_pool)}, 30"))
+        elif kind == "export":
+            messages.append((user, "/export 1"))
+    return messages[:count]
+
+def make_update(update_id, chat_id, user_id, text, bot):
+    data = {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+        },
+    }
+    if text.startswith("/"):
+        data["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json(data, bot)
+
+class DispatcherTracker:
+    """Сколько обновлений обработано и сколько run_async задач ещё в работе"""
+
+    def __init__(self, dispatcher):
+        self.processed = 0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+        process_update = dispatcher.process_update
+        run_async = dispatcher.run_async
+
+        def tracked_process_update(update):
+            try:
+                process_update(update)
+            finally:
+                with self.lock:
+                    self.processed += 1
+
+        def tracked_run_async(func, *args, update=None, **kwargs):
+            with self.lock:
+                self.in_flight += 1
+
+            def run(*a, **kw):
+                try:
+                    return func(*a, **kw)
+                finally:
+                    with self.lock:
+                        self.in_flight -= 1
+            return run_async(run, *args, update=update, **kwargs)
+
+        # object.__setattr__ - мимо предупреждения PTB о своих атрибутах
+        object.__setattr__(dispatcher, "process_update", tracked_process_update)
+        object.__setattr__(dispatcher, "run_async", tracked_run_async)
+
+    def idle(self, total):
+        with self.lock:
+            return self.processed >= total and self.in_flight == 0
+
+def pending_crm_jobs(department):
+    conn = main.get_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT count(*) FROM crm_outbox WHERE department = %s AND status IN ('pending', 'processing')",
+                (department,)
+            )
+            return cur.fetchone()[0]
+    finally:
+        main.release_conn(conn)
+
+def crm_end_to_end(department, since):
+    """Время от записи до завершения задачи в CRM по задачам этого прогона"""
+    conn = main.get_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT EXTRACT(EPOCH FROM updated_at - created_at)
+                FROM crm_outbox
+                WHERE department = %s AND created_at >= %s AND status IN ('done', 'no_contact')
+                """,
+                (department, since)
+            )
+            return [float(row[0]) for row in cur.fetchall()]
+    finally:
+        main.release_conn(conn)
+
+def wait_until(predicate, timeout, step=0.02):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(step)
+    return True
+
+# ==========================================
+# ПРОГОН
+# ==========================================
+
+def start_async_outbox(updater):
+    """Очередь CRM asyncio-движка в отдельном потоке, вернуть функцию остановки"""
+    engine = main.AsyncEngine(updater, ingest=None)
+    state = {}
+
+    async def run():
+        state["loop"] = asyncio.get_running_loop()
+        await engine.run()
+
+    thread = threading.Thread(target=asyncio.run, args=(run(),), name="async-engine", daemon=True)
+    thread.start()
+    wait_until(lambda: engine.stopping is not None, 10)
+
+    def stop():
+        state["loop"].call_soon_threadsafe(engine.stopping.set)
+        thread.join(10)
+    return stop
+
+def run_benchmark(args):
+    random.seed(args.seed)
+    memory = args.storage == "memory"
+    mix = parse_mix(args.mix)
+    if memory:
+        # Выгрузка читает записи напрямую из PostgreSQL
+        mix.pop("export", None)
+        prepare_memory_storage(args.department, args.users)
+    elif not main.DATABASE_URL:
+        sys.exit("❌ Укажите DATABASE_URL тестовой базы (бенчмарк пишет в неё записи)")
+    else:
+        prepare_database(args.department, args.users)
+        main.start_group_commit_writer()
+    main.warm_duplicate_index()
+    start_stub(args.bitrix_latency / 1000, args.no_contact_ratio)
+    instrument()
+
+    bot = Bot(main.BOT_TOKEN, request=FakeTelegramRequest(args.telegram_latency / 1000))
+    updater = main.build_updater(bot)
+    tracker = DispatcherTracker(updater.dispatcher)
+    main.start_dispatcher(updater)
+
+    if memory:
+        stop_outbox = None
+    elif args.engine == "asyncio":
+        stop_outbox = start_async_outbox(updater)
+    else:
+        main.start_crm_outbox_worker(bot)
+        stop_outbox = main.crm_outbox_stop.set
+
+    chat_id = department_chat_id(args.department)
+    messages = generate_messages(args.messages, args.users, args.phones, mix, args.seed)
+    started_at = None if memory else main.get_db_now()
+
+    started = time.perf_counter()
+    for update_id, (user_id, text) in enumerate(messages, 1):
+        updater.dispatcher.update_queue.put(make_update(update_id, chat_id, user_id, text, bot))
+    handled = wait_until(lambda: tracker.idle(len(messages)), args.timeout)
+    handle_seconds = time.perf_counter() - started
+
+    if memory:
+        crm_done, crm_seconds, e2e = False, 0.0, []
+    else:
+        crm_done = wait_until(lambda: pending_crm_jobs(args.department) == 0, args.timeout, step=0.1)
+        crm_seconds = time.perf_counter() - started
+        stop_outbox()
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
+
+    if not memory:
+        e2e = sorted(crm_end_to_end(args.department, started_at))
+    stages = timer.report()
+    if e2e:
+        stages["crm:record_to_done"] = {
+            "count": len(e2e),
+            "p50": percentile(e2e, 50) * 1000,
+            "p95": percentile(e2e, 95) * 1000,
+            "p99": percentile(e2e, 99) * 1000,
+            "max": e2e[-1] * 1000,
+        }
+
+    report = {
+        "engine": args.engine,
+        "storage": args.storage,
+        "messages": len(messages),
+        "handled": handled,
+        "crm_drained": crm_done,
+        "handle_seconds": handle_seconds,
+        "messages_per_second": len(messages) / handle_seconds if handle_seconds else 0.0,
+        "crm_seconds": crm_seconds,
+        "crm_jobs_per_second": len(e2e) / crm_seconds if crm_seconds else 0.0,
+        "settings": {
+            "bitrix_latency_ms": args.bitrix_latency,
+            "telegram_latency_ms": args.telegram_latency,
+            "users": args.users,
+            "phones": args.phones,
+            "mix": ",".join(f"{kind}={weight:g}" for kind, weight in mix.items()),
+            "seed": args.seed,
+            "bot_workers": main.BOT_WORKERS,
+            "db_pool_max": main.DB_POOL_MAX,
+            "group_commit_ms": main.GROUP_COMMIT_MS if not memory else 0,
+            "info_cache_size": main.INFO_CACHE_SIZE if main.info_cache is not None else 0,
+            "bitrix_batch": main.BITRIX_BATCH_ENABLED,
+        },
+        "stages": stages,
+    }
+
+    if not memory and not args.keep:
+        cleanup_database(args.department)
+    return report
+
+def print_report(report):
+    print(
+        f"\nДвижок: {report['engine']}, хранилище: {report['storage']}, сообщений: {report['messages']}"
+        f"{'' if report['handled'] else ' (НЕ ВСЕ ОБРАБОТАНЫ - таймаут)'}"
+    )
+    print(f"Обработка: {report['handle_seconds']:.2f} с, {report['messages_per_second']:.1f} сообщ/с")
+    if report["storage"] == "memory":
+        print("Очередь CRM: не разбирается (хранилище в памяти)")
+    else:
+        print(
+            f"Очередь CRM: {report['crm_seconds']:.2f} с, {report['crm_jobs_per_second']:.1f} задач/с"
+            f"{'' if report['crm_drained'] else ' (очередь не разобрана - таймаут)'}"
+        )
+    print(f"\n{'этап':<36}{'count':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'max мс':>10}")
+    for stage, s in report["stages"].items():
+        print(f"{stage:<36}{s['count']:>8}{s['p50']:>10.2f}{s['p95']:>10.2f}{s['p99']:>10.2f}{s['max']:>10.2f}")
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк бота (офлайн)")
+    parser.add_argument("--messages", type=int, default=2000, help="Сколько сообщений отправить")
+    parser.add_argument("--users", type=int, default=20, help="Сотрудников в чате")
+    parser.add_argument("--phones", type=int, default=500, help="Размер пула телефонов клиентов")
+    parser.add_argument("--mix", default="record=70,noise=15,duplicate=7,info=6,export=2",
+                        help="Смесь сообщений: record, noise, duplicate, info, export")
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default="threads")
+    parser.add_argument("--storage", choices=("postgres", "memory"), default="postgres",
+                        help="memory - без БД, замеряются только обработчики")
+    parser.add_argument("--department", default="support", help="Департамент из реестра")
+    parser.add_argument("--bitrix-latency", type=float, default=50, help="Задержка ответа Bitrix24, мс")
+    parser.add_argument("--telegram-latency", type=float, default=0, help="Задержка ответа Bot API, мс")
+    parser.add_argument("--no-contact-ratio", type=float, default=0.1, help="Доля телефонов без контакта в CRM")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=300, help="Ожидание обработки и очереди CRM, с")
+    parser.add_argument("--keep", action="store_true", help="Не удалять записи бенчмарка из БД")
+    parser.add_argument("--json", help="Сохранить отчёт в JSON (для сравнения прогонов)")
+    args = parser.parse_args()
+
+    main.setup_logging()
+    report = run_benchmark(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,18 +1,59 @@
 import re
 import os
+import argparse
+import time
+import threading
+import asyncio
+import json
+import io
+import csv
+import logging
+import atexit
+import random
+import sys
+import signal
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue, Empty
+import hmac
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import requests
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from psycopg2.pool import SimpleConnectionPool
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import quote
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
     Updater, MessageHandler, Filters, CallbackContext,
     CommandHandler, ConversationHandler
 )
-from collections import Counter
+from collections import Counter, OrderedDict, deque
 from openpyxl import Workbook
-from io import BytesIO
+from openpyxl.utils import get_column_letter
+from itertools import chain, islice, count
+import tempfile
+from abc import ABC, abstractmethod
+import gzip
+from prometheus_client import Counter as MetricCounter, Histogram, start_http_server, REGISTRY
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+
+# Parquet-экспорт - опционально (requirements-optional.txt)
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# asyncio-движок - опционально (pip install aiohttp asyncpg)
+try:
+    import aiohttp
+    import aiohttp.web
+    import asyncpg
+except ImportError:
+    aiohttp = asyncpg = None
 
 # ==========================================
 # НАСТРОЙКИ
@@ -20,20 +61,125 @@ from io import BytesIO
 BOT_TOKEN = os.environ["BOT_TOKEN"]
 DATABASE_URL = os.environ["DATABASE_URL"]
 
+# Пул соединений PostgreSQL и потоки обработчиков.
+# DB_POOL_MAX должен покрывать BOT_WORKERS + фоновые потоки (очередь CRM, синхронизация)
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "12"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5"))  # ожидание свободного соединения, сек
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "8"))            # потоки для run_async обработчиков
+
+# Групповая фиксация: add_record из параллельных обработчиков копятся до
+# GROUP_COMMIT_MS мс (или GROUP_COMMIT_MAX штук) и пишутся одной транзакцией
+GROUP_COMMIT_MS = float(os.environ.get("GROUP_COMMIT_MS", "0"))  # 0 - каждая запись фиксируется сразу
+GROUP_COMMIT_MAX = int(os.environ.get("GROUP_COMMIT_MAX", "100"))
+
+# Движок бота: threads (Updater + потоки) или asyncio - приём обновлений и
+# очередь CRM на aiohttp + asyncpg; обработчики в обоих - в потоках Dispatcher
+BOT_ENGINE = os.environ.get("BOT_ENGINE", "threads")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+TELEGRAM_POLL_TIMEOUT = int(os.environ.get("TELEGRAM_POLL_TIMEOUT", "30"))  # long polling getUpdates, сек
+ASYNC_CRM_CONCURRENCY = int(os.environ.get("ASYNC_CRM_CONCURRENCY", "100"))  # задач CRM одновременно
+ASYNC_DB_POOL_MAX = int(os.environ.get("ASYNC_DB_POOL_MAX", "20"))
+
+# Приём обновлений: polling (getUpdates) или webhook (встроенный HTTP-сервер)
+BOT_INGEST = os.environ.get("BOT_INGEST", "polling")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", "8443")))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")          # публичный адрес, https://bot.example.com
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")    # X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+
 # Вебхуки Bitrix24
 BITRIX_CONTACT_URL = os.environ["BITRIX_CONTACT_URL"]  # crm.contact.list
 BITRIX_TASK_URL = os.environ["BITRIX_TASK_URL"]        # task.item.add
 
+# Отправлять задачу, комментарий и завершение одним запросом batch
+BITRIX_BATCH_ENABLED = os.environ.get("BITRIX_BATCH", "1") != "0"
+
+# HTTP-клиент Bitrix24
+BITRIX_CONNECT_TIMEOUT = float(os.environ.get("BITRIX_CONNECT_TIMEOUT", "3.05"))  # сек
+BITRIX_READ_TIMEOUT = float(os.environ.get("BITRIX_READ_TIMEOUT", "15"))          # сек
+BITRIX_POOL_SIZE = int(os.environ.get("BITRIX_POOL_SIZE", "10"))   # keep-alive соединений
+BITRIX_RETRIES = int(os.environ.get("BITRIX_RETRIES", "2"))        # повторы идемпотентных запросов
+
+# Кэш контактов Bitrix24 по телефону
+CONTACT_CACHE_SIZE = int(os.environ.get("CONTACT_CACHE_SIZE", "5000"))
+CONTACT_CACHE_TTL = int(os.environ.get("CONTACT_CACHE_TTL", "600"))                # сек
+CONTACT_CACHE_NEGATIVE_TTL = int(os.environ.get("CONTACT_CACHE_NEGATIVE_TTL", "60"))  # «не найден», сек
+
+# Локальная копия контактов Bitrix24
+CONTACTS_SYNC_ENABLED = os.environ.get("CONTACTS_SYNC", "1") != "0"
+CONTACTS_SYNC_INTERVAL = int(os.environ.get("CONTACTS_SYNC_INTERVAL", "300"))        # инкремент, сек
+CONTACTS_FULL_SYNC_HOURS = int(os.environ.get("CONTACTS_FULL_SYNC_HOURS", "24"))     # полная сверка
+CONTACTS_SYNC_PAGE_DELAY = float(os.environ.get("CONTACTS_SYNC_PAGE_DELAY", "0.5"))  # лимит REST API
+
 # Админ (только для управления сотрудниками/категориями)
 ADMIN_TELEGRAM_ID = 727013047
 
-# ID чатов для отделов
-SUPPORT_CHAT_ID = -1003053461710  # Чат поддержки
-PRE_TRIAL_CHAT_ID = -5070042846   # Чат досудебки
+# Реестр департаментов: JSON-файл DEPARTMENTS_FILE
+#   [{"name": "support", "chat_id": -1003053461710, "title": "Підтримка"}, ...]
+# или, если файл не задан, таблица departments в БД (заполняется миграцией 7).
+# name - латиница/цифры/_, из него строятся имена партиций {name}_records и т.п.
+DEPARTMENTS_FILE = os.environ.get("DEPARTMENTS_FILE")
+
+# Департаменты по умолчанию (до загрузки реестра из БД)
+DEFAULT_DEPARTMENTS = (
+    {"name": "support", "chat_id": -1003053461710, "title": "Підтримка"},  # Чат поддержки
+    {"name": "pre_trial", "chat_id": -5070042846, "title": "Досудебка"},   # Чат досудебки
+)
 
 # Дефолтный ответственный для новых сотрудников
 RESPONSIBLE_ID = 596
 
+# Очередь задач в Bitrix24 (outbox)
+CRM_OUTBOX_POLL_SECONDS = 2       # Пауза между опросами пустой очереди
+CRM_OUTBOX_BATCH_SIZE = 10        # Сколько задач забирать за раз
+CRM_OUTBOX_LEASE_SECONDS = 120    # Через сколько зависшая задача снова доступна
+CRM_OUTBOX_MAX_ATTEMPTS = 8       # После этого задача помечается как failed
+CRM_OUTBOX_BACKOFF_SECONDS = 10   # Базовая пауза перед повтором (удваивается)
+CRM_OUTBOX_BACKOFF_MAX_SECONDS = 900
+CRM_OUTBOX_STATE_ATTEMPTS = 5     # Попыток записать шаг задачи в БД
+CRM_OUTBOX_STATE_BACKOFF_SECONDS = 0.5  # Пауза между ними (удваивается)
+
+# Время жизни кэша справочников (сотрудники + категории), сек
+REFERENCE_CACHE_TTL = 60
+
+# Окно дубликатов в памяти: недавние записи (прогрев из БД при запуске) вместо
+# запроса COUNT(*) на каждое сообщение. Видит только записи этого процесса -
+# при нескольких экземплярах бота на одну базу выключить (DUPLICATE_INDEX=0)
+DUPLICATE_INDEX_ENABLED = os.environ.get("DUPLICATE_INDEX", "1") != "0"
+DUPLICATE_INDEX_MINUTES = int(os.environ.get("DUPLICATE_INDEX_MINUTES", "10"))  # не меньше окна проверки (5 мин)
+
+# Кэш ответов /info по (департамент, телефон, дни). Сбрасывается при новой записи
+# по телефону в этом процессе; TTL ограничивает устаревание от записей других
+# процессов (backfill) и выпадения старых записей из окна N дней
+INFO_CACHE_SIZE = int(os.environ.get("INFO_CACHE_SIZE", "1000"))  # 0 - выключен
+INFO_CACHE_TTL = int(os.environ.get("INFO_CACHE_TTL", "300"))     # сек
+
+# Часовой пояс, по которому записи раскладываются по дням в дневных агрегатах.
+# После смены нужно перестроить агрегаты: python main.py rebuild-rollup
+STATS_TIMEZONE = os.environ.get("STATS_TIMEZONE", "Europe/Kiev")
+
+# Миграции схемы БД
+AUTO_MIGRATE = os.environ.get("AUTO_MIGRATE", "1") != "0"  # применять при запуске бота
+MIGRATIONS_LOCK_ID = 727013047          # pg_advisory_lock: один мигратор одновременно
+RECORDS_PARTITION_MONTHS_AHEAD = 3      # Сколько месячных партиций записей создавать наперёд
+
+# Экспорт
+EXPORT_ITERSIZE = 2000        # Строк за один FETCH серверного курсора
+EXPORT_WIDTH_SAMPLE = 1000    # По скольким первым строкам считать ширину колонок
+EXPORT_MAX_FILE_BYTES = 45 * 1024 * 1024  # Telegram принимает от бота файлы до 50 МБ
+EXPORT_PARQUET_ROW_GROUP = 50000          # Строк в одной row group Parquet
+
+# Логи: JSON-строки в stdout через очередь и фоновый поток
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_REJECTED = float(os.environ.get("LOG_SAMPLE_REJECTED", "0.01"))  # доля логируемых «не записей»
+
+# Метрики Prometheus: http://METRICS_ADDR:METRICS_PORT/metrics (0 - выключено)
+METRICS_ADDR = os.environ.get("METRICS_ADDR", "0.0.0.0")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+
 # Состояния для ConversationHandler
 (
     ADD_EMPLOYEE_TG_ID,
@@ -44,17 +190,252 @@ RESPONSIBLE_ID = 596
     CONFIRM_DUPLICATE
 ) = range(6)
 
+# ==========================================
+# ЛОГИРОВАНИЕ
+# ==========================================
+# Обработчики только кладут запись в очередь, форматирование и запись
+# в stdout - в потоке QueueListener. Частые записи помечаются
+# extra={"sample": доля} и прореживаются до постановки в очередь.
+
+log = logging.getLogger("bot")
+
+# Стандартные атрибуты LogRecord - всё остальное пришло через extra.
+# sample - служебная пометка SampleFilter, в вывод не попадает
+LOG_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "sample"}
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога -> одна JSON-строка"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in LOG_RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SampleFilter(logging.Filter):
+    """Пропускает записи с extra={"sample": p} с вероятностью p"""
+
+    def filter(self, record):
+        rate = getattr(record, "sample", None)
+        return rate is None or random.random() < rate
+
+class LogQueueHandler(QueueHandler):
+    """
+    QueueHandler без форматирования в потоке обработчика: подставляются
+    только аргументы сообщения (объекты могут измениться позже),
+    traceback превращается в текст.
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging(level=LOG_LEVEL):
+    """Корневой логгер -> очередь -> фоновый поток -> stdout (JSON)"""
+    records = SimpleQueue()
+    handler = LogQueueHandler(records)
+    handler.addFilter(SampleFilter())
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    listener = QueueListener(records, output, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    # DEBUG библиотек (каждый update целиком) слишком шумный
+    for name in ("telegram", "apscheduler", "urllib3"):
+        logging.getLogger(name).setLevel(max(root.level, logging.INFO))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+# ==========================================
+# МЕТРИКИ (PROMETHEUS)
+# ==========================================
+
+# Бакеты от 5 мс до 30 с: и запросы к БД, и CRM, и выгрузки
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_seconds", "Время обработки команд и сообщений",
+    ["handler"], buckets=LATENCY_BUCKETS
+)
+DB_LATENCY = Histogram(
+    "bot_db_seconds", "Время функций работы с БД",
+    ["function"], buckets=LATENCY_BUCKETS
+)
+BITRIX_LATENCY = Histogram(
+    "bot_bitrix_seconds", "Время запросов к Bitrix24",
+    ["method"], buckets=LATENCY_BUCKETS
+)
+BITRIX_ERRORS = MetricCounter(
+    "bot_bitrix_errors", "Сетевые ошибки запросов к Bitrix24", ["method"]
+)
+MESSAGES = MetricCounter(
+    "bot_messages", "Рабочие сообщения по результату разбора",
+    ["department", "result"]
+)
+CRM_JOBS = MetricCounter(
+    "bot_crm_jobs", "Смены статуса задач очереди CRM (pending - повтор)", ["status"]
+)
+GROUP_COMMIT_WAIT = Histogram(
+    "bot_group_commit_wait_seconds", "Ожидание add_record в пачке групповой фиксации",
+    buckets=(.001, .0025) + LATENCY_BUCKETS
+)
+
+def observe_handler(func):
+    """Гистограмма времени обработчика (метка - имя функции)"""
+    return HANDLER_LATENCY.labels(func.__name__).time()(func)
+
+def observe_db(func):
+    """Гистограмма времени функции БД (метка - имя функции)"""
+    return DB_LATENCY.labels(func.__name__).time()(func)
+
+class StatsCollector:
+    """Пул соединений и кэши - снимаются в момент запроса /metrics"""
+
+    def collect(self):
+        if pool is not None:
+            stats = pool.stats()
+            size = GaugeMetricFamily("bot_db_pool_size", "Размер пула соединений")
+            size.add_metric([], stats['size'])
+            in_use = GaugeMetricFamily("bot_db_pool_in_use", "Выданные соединения")
+            in_use.add_metric([], stats['in_use'])
+            checkouts = CounterMetricFamily("bot_db_pool_checkouts", "Выдачи соединений")
+            checkouts.add_metric([], stats['checkouts'])
+            timeouts = CounterMetricFamily("bot_db_pool_timeouts", "Таймауты ожидания соединения")
+            timeouts.add_metric([], stats['timeouts'])
+            wait = CounterMetricFamily("bot_db_pool_wait_seconds", "Суммарное ожидание соединения")
+            wait.add_metric([], stats['wait_total'])
+            yield from (size, in_use, checkouts, timeouts, wait)
+
+        if record_writer is not None:
+            stats = record_writer.stats()
+            batches = CounterMetricFamily("bot_group_commit_batches", "Пачки групповой фиксации")
+            batches.add_metric([], stats['batches'])
+            records = CounterMetricFamily("bot_group_commit_records", "Записи, прошедшие через пачки")
+            records.add_metric([], stats['records'])
+            fallbacks = CounterMetricFamily("bot_group_commit_fallbacks", "Пачки, записанные по одной после ошибки")
+            fallbacks.add_metric([], stats['fallbacks'])
+            yield from (batches, records, fallbacks)
+
+        size = GaugeMetricFamily("bot_cache_size", "Записей в кэше", labels=["cache"])
+        hits = CounterMetricFamily("bot_cache_hits", "Попадания в кэш", labels=["cache"])
+        misses = CounterMetricFamily("bot_cache_misses", "Промахи кэша", labels=["cache"])
+        caches = [("contacts", contact_cache)]
+        if info_cache is not None:
+            caches.append(("info", info_cache))
+        if duplicate_index is not None:
+            # Для окна дубликатов промах - проверка ушла в БД
+            caches.append(("duplicates", duplicate_index))
+        for name, cache in caches:
+            stats = cache.stats()
+            size.add_metric([name], stats['size'])
+            hits.add_metric([name], stats['hits'])
+            misses.add_metric([name], stats['misses'])
+        yield from (size, hits, misses)
+
+def start_metrics_server():
+    """HTTP-эндпоинт /metrics для Prometheus"""
+    if not METRICS_PORT:
+        return
+    REGISTRY.register(StatsCollector())
+    start_http_server(METRICS_PORT, addr=METRICS_ADDR)
+    log.info("Метрики Prometheus запущены", extra={"addr": METRICS_ADDR, "port": METRICS_PORT})
+
 # ==========================================
 # POSTGRESQL CONNECTION POOL
 # ==========================================
+class PoolTimeout(PoolError):
+    """Свободное соединение не появилось за DB_POOL_TIMEOUT"""
+
+class BlockingConnectionPool(ThreadedConnectionPool):
+    """
+    Потокобезопасный пул, который при исчерпании ждёт свободное соединение
+    не дольше timeout (ThreadedConnectionPool сразу бросает PoolError),
+    и считает статистику выдачи: ожидание, занятость, таймауты.
+    """
+
+    def __init__(self, minconn, maxconn, *args, timeout=DB_POOL_TIMEOUT, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._stats_lock = threading.Lock()
+        self.in_use = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def getconn(self, key=None):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._stats_lock:
+                self.timeouts += 1
+            raise PoolTimeout(f"no free connection in {self.timeout}s (pool size {self.maxconn})")
+        waited = time.monotonic() - started
+
+        try:
+            conn = super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._stats_lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return conn
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            with self._stats_lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        """Статистика пула"""
+        with self._stats_lock:
+            return {
+                'size': self.maxconn,
+                'in_use': self.in_use,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_total': self.wait_total,
+                'wait_avg': self.wait_total / self.checkouts if self.checkouts else 0.0,
+                'wait_max': self.wait_max
+            }
+
 pool = None
-categories_cache = {}  # Кэш по департаментам: {'support': [...], 'pre_trial': [...]}
-categories_cache_time = {}  # Время кэша по департаментам
+pool_lock = threading.Lock()
+reference_cache = {}  # Справочники по департаментам: {'support': ReferenceData, ...}
+reference_cache_lock = threading.Lock()
+category_matchers = {}  # Скомпилированные парсеры по департаментам
 
 def init_pool():
     global pool
-    if pool is None:
-        pool = SimpleConnectionPool(1, 10, DATABASE_URL)
+    with pool_lock:
+        if pool is None:
+            pool = BlockingConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, timeout=DB_POOL_TIMEOUT)
     return pool
 
 def get_conn():
@@ -68,395 +449,2328 @@ def release_conn(conn):
     if pool:
         pool.putconn(conn)
 
+# ==========================================
+# РЕЕСТР ДЕПАРТАМЕНТОВ
+# ==========================================
+
+DEPARTMENT_NAME_RE = re.compile(r"^[a-z][a-z0-9_]{0,31}$")
+
+department_by_name = {}     # имя -> {'name', 'chat_id', 'title'}
+department_by_chat_id = {}  # chat_id -> имя
+DEPARTMENTS = ()            # имена департаментов (для фоновых задач и миграций)
+
+def set_departments(departments):
+    """Заменить реестр списком словарей {'name', 'chat_id', 'title'}"""
+    global DEPARTMENTS, department_by_name, department_by_chat_id
+    by_name = {}
+    by_chat_id = {}
+    for department in departments:
+        name = department['name']
+        chat_id = int(department['chat_id'])
+        if not DEPARTMENT_NAME_RE.match(name):
+            raise ValueError(f"Недопустимое имя департамента: {name!r}")
+        if name in by_name or chat_id in by_chat_id:
+            raise ValueError(f"Департамент или чат указан дважды: {name} / {chat_id}")
+        by_name[name] = {'name': name, 'chat_id': chat_id, 'title': department.get('title') or name}
+        by_chat_id[chat_id] = name
+
+    # Словари подменяются целиком: обработчики видят либо старый реестр, либо новый
+    department_by_name, department_by_chat_id = by_name, by_chat_id
+    DEPARTMENTS = tuple(by_name)
+
+def read_departments_file(path):
+    """Департаменты из JSON-файла: список или {"departments": [...]}"""
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return data["departments"] if isinstance(data, dict) else data
+
+def load_departments():
+    """
+    Загрузить реестр: из DEPARTMENTS_FILE, иначе из таблицы departments
+    (если она уже есть и не пуста). Вызывается после миграций.
+    """
+    if DEPARTMENTS_FILE:
+        set_departments(read_departments_file(DEPARTMENTS_FILE))
+        return
+
+    conn = get_conn()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("SELECT to_regclass('departments') AS name")
+            if cur.fetchone()['name'] is None:
+                return
+            cur.execute("SELECT name, chat_id, title FROM departments ORDER BY name")
+            rows = cur.fetchall()
+    finally:
+        release_conn(conn)
+    if rows:
+        set_departments(rows)
+    log.info("Реестр департаментов загружен", extra={"departments": list(DEPARTMENTS)})
+
 def get_department_by_chat_id(chat_id):
     """Определить департамент по ID чата"""
-    if chat_id == SUPPORT_CHAT_ID:
-        return 'support'
-    elif chat_id == PRE_TRIAL_CHAT_ID:
-        return 'pre_trial'
-    return None
+    return department_by_chat_id.get(chat_id)
+
+def department_chat_only_text():
+    """Ответ на команду департамента вне его чата (названия чатов - из реестра)"""
+    titles = ", ".join(d['title'] or d['name'] for d in department_by_name.values())
+    return f"❌ Ця команда доступна тільки в чатах відділів: {titles}"
 
 def get_table_prefix(department):
     """Получить префикс таблицы для департамента"""
-    if department == 'support':
-        return 'support'
-    elif department == 'pre_trial':
-        return 'pre_trial'
-    return None
+    return department if department in department_by_name else None
+
+set_departments(read_departments_file(DEPARTMENTS_FILE) if DEPARTMENTS_FILE else DEFAULT_DEPARTMENTS)
 
 # ==========================================
-# DATABASE FUNCTIONS - EMPLOYEES
+# СХЕМА БД И МИГРАЦИИ
 # ==========================================
 
-def get_employee_by_telegram_id(telegram_id, department):
-    """Получить сотрудника по Telegram ID"""
-    prefix = get_table_prefix(department)
-    if not prefix:
-        return None
+# Таблицы департаментов до миграции 10 - нужны миграциям 1-2 новой БД
 
-    conn = get_conn()
-    try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+def legacy_create_reference_tables(cur, prefix):
+    """Сотрудники и категории департамента"""
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {prefix}_employees (
+            telegram_id BIGINT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            bitrix_id INT NOT NULL
+        )
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {prefix}_categories (
+            code VARCHAR(10) PRIMARY KEY,
+            name VARCHAR(255) NOT NULL
+        )
+        """
+    )
+
+def legacy_create_crm_outbox_table(cur, prefix):
+    """Очередь задач Bitrix24 департамента"""
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {prefix}_crm_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            record_id INT NOT NULL,
+            phone VARCHAR(20) NOT NULL,
+            category_name VARCHAR(255) NOT NULL,
+            comment TEXT,
+            responsible_id INT NOT NULL,
+            chat_id BIGINT,
+            message_id BIGINT,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            last_error TEXT,
+            contact_id BIGINT,
+            task_id BIGINT,
+            comment_id BIGINT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE INDEX IF NOT EXISTS {prefix}_crm_outbox_due_idx
+        ON {prefix}_crm_outbox (next_attempt_at)
+        WHERE status IN ('pending', 'processing')
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE INDEX IF NOT EXISTS {prefix}_crm_outbox_record_idx
+        ON {prefix}_crm_outbox (record_id)
+        """
+    )
+
+def legacy_record_prefixes(cur):
+    """
+    (департамент, префикс) реестра, у которых уже есть {prefix}_records.
+    Департамент, добавленный в DEPARTMENTS_FILE после миграции 1, таблиц
+    ещё не имеет - их создаст create_department_tables после миграций.
+    """
+    found = []
+    for department in DEPARTMENTS:
+        prefix = get_table_prefix(department)
+        cur.execute("SELECT to_regclass(%s)", (f"{prefix}_records",))
+        if cur.fetchone()[0] is not None:
+            found.append((department, prefix))
+    return found
+
+def migration_base_tables(cur):
+    """Основные таблицы департаментов (для новой БД)"""
+    for department in DEPARTMENTS:
+        prefix = get_table_prefix(department)
+        legacy_create_reference_tables(cur, prefix)
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {prefix}_records (
+                id SERIAL PRIMARY KEY,
+                employee_telegram_id BIGINT,
+                category_code VARCHAR(10),
+                phone VARCHAR(20) NOT NULL,
+                comment TEXT,
+                timestamp TIMESTAMPTZ DEFAULT NOW()
+            )
+            """
+        )
+
+def migration_crm_outbox(cur):
+    """Очередь задач Bitrix24"""
+    for department in DEPARTMENTS:
+        legacy_create_crm_outbox_table(cur, get_table_prefix(department))
+
+def migration_contacts_mirror(cur):
+    """Копия контактов Bitrix24 (общая для всех департаментов)"""
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bitrix_contacts (
+            id BIGINT PRIMARY KEY,
+            name VARCHAR(255),
+            last_name VARCHAR(255),
+            date_modify TIMESTAMPTZ,
+            synced_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bitrix_contact_phones (
+            phone VARCHAR(20) NOT NULL,
+            contact_id BIGINT NOT NULL REFERENCES bitrix_contacts (id) ON DELETE CASCADE,
+            PRIMARY KEY (phone, contact_id)
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS bitrix_contact_phones_contact_idx
+        ON bitrix_contact_phones (contact_id)
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bitrix_sync_state (
+            name VARCHAR(50) PRIMARY KEY,
+            value TEXT,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+
+def migration_daily_rollup(cur):
+    """Дневные агрегаты записей"""
+    for department, prefix in legacy_record_prefixes(cur):
+        legacy_init_daily_rollup(cur, prefix)
+
+def migration_partition_records(cur):
+    """
+    {prefix}_records -> таблица, секционированная по месяцам (RANGE по timestamp).
+    Данные переносятся в одной транзакции; id продолжают ту же последовательность.
+    Первичный ключ секционированной таблицы обязан включать ключ секционирования,
+    поэтому он становится (id, timestamp).
+    """
+    for department, prefix in legacy_record_prefixes(cur):
+        cur.execute(
+            "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)",
+            (f"{prefix}_records",)
+        )
+        if cur.fetchone()[0] == 'p':
+            continue
+
+        cur.execute(f"LOCK TABLE {prefix}_records IN ACCESS EXCLUSIVE MODE")
+        cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", (f"{prefix}_records",))
+        sequence = cur.fetchone()[0]
+        if sequence is None:
+            sequence = f"{prefix}_records_id_seq"
+            cur.execute(f"CREATE SEQUENCE IF NOT EXISTS {sequence}")
             cur.execute(
-                f"SELECT * FROM {prefix}_employees WHERE telegram_id = %s",
-                (telegram_id,)
+                f"SELECT setval(%s, COALESCE((SELECT MAX(id) FROM {prefix}_records), 0) + 1, false)",
+                (sequence,)
             )
-            return cur.fetchone()
+
+        cur.execute(f"ALTER TABLE {prefix}_records RENAME TO {prefix}_records_legacy")
+        cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+        cur.execute(
+            f"""
+            CREATE TABLE {prefix}_records (
+                id INT NOT NULL DEFAULT nextval('{sequence}'),
+                employee_telegram_id BIGINT,
+                category_code VARCHAR(10),
+                phone VARCHAR(20) NOT NULL,
+                comment TEXT,
+                timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (id, timestamp)
+            ) PARTITION BY RANGE (timestamp)
+            """
+        )
+        cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY {prefix}_records.id")
+        cur.execute(f"CREATE TABLE {prefix}_records_default PARTITION OF {prefix}_records DEFAULT")
+
+        cur.execute(f"SELECT MIN(timestamp) FROM {prefix}_records_legacy")
+        oldest = cur.fetchone()[0]
+        create_record_partitions(cur, prefix, oldest)
+
+        # Агрегаты уже учитывают эти строки: триггеры на новую таблицу - после переноса
+        cur.execute(
+            f"""
+            INSERT INTO {prefix}_records (id, employee_telegram_id, category_code, phone, comment, timestamp)
+            SELECT id, employee_telegram_id, category_code, phone, comment, COALESCE(timestamp, NOW())
+            FROM {prefix}_records_legacy
+            """
+        )
+        cur.execute(f"DROP TABLE {prefix}_records_legacy")
+        legacy_create_daily_rollup_triggers(cur, prefix)
+
+def migration_hot_path_indexes(cur):
+    """Индексы под горячие запросы: /info, проверка дубликата, окна по времени"""
+    for department, prefix in legacy_record_prefixes(cur):
+        # get_records_by_phone
+        cur.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS {prefix}_records_phone_ts_idx
+            ON {prefix}_records (phone, timestamp)
+            """
+        )
+        # check_duplicate_record
+        cur.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS {prefix}_records_duplicate_idx
+            ON {prefix}_records (employee_telegram_id, category_code, phone, timestamp)
+            """
+        )
+        # /export, /team_stats (неполный первый день)
+        cur.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS {prefix}_records_ts_idx
+            ON {prefix}_records (timestamp)
+            """
+        )
+
+def migration_shared_records(cur):
+    """
+    Общая таблица records, секционированная по департаментам (LIST по
+    department, внутри - прежние месячные RANGE-партиции), и общая
+    records_daily. Существующие таблицы {prefix}_records подключаются как
+    партиции без переноса данных, id продолжают общую последовательность
+    records_id_seq. Реестр департаментов переносится в таблицу departments;
+    партиции департаментов без таблиц создаёт create_department_tables.
+    """
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS departments (
+            name VARCHAR(32) PRIMARY KEY,
+            chat_id BIGINT NOT NULL UNIQUE,
+            title VARCHAR(255)
+        )
+        """
+    )
+    execute_values(
+        cur,
+        "INSERT INTO departments (name, chat_id, title) VALUES %s ON CONFLICT DO NOTHING",
+        [(d['name'], d['chat_id'], d['title']) for d in department_by_name.values()]
+    )
+
+    cur.execute("CREATE SEQUENCE records_id_seq")
+    cur.execute(
+        """
+        CREATE TABLE records (
+            id INT NOT NULL DEFAULT nextval('records_id_seq'),
+            department VARCHAR(32) NOT NULL,
+            employee_telegram_id BIGINT,
+            category_code VARCHAR(10),
+            phone VARCHAR(20) NOT NULL,
+            comment TEXT,
+            timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (department, id, timestamp)
+        ) PARTITION BY LIST (department)
+        """
+    )
+    cur.execute("ALTER SEQUENCE records_id_seq OWNED BY records.id")
+    cur.execute(
+        """
+        CREATE TABLE records_daily (
+            department VARCHAR(32) NOT NULL,
+            day DATE NOT NULL,
+            employee_telegram_id BIGINT NOT NULL,
+            category_code VARCHAR(10) NOT NULL,
+            count INT NOT NULL,
+            PRIMARY KEY (department, day, employee_telegram_id, category_code)
+        )
+        """
+    )
+
+    next_id = 1
+    for department, prefix in legacy_record_prefixes(cur):
+        cur.execute(f"LOCK TABLE {prefix}_records IN ACCESS EXCLUSIVE MODE")
+        cur.execute(f"DROP TRIGGER IF EXISTS {prefix}_records_daily_insert ON {prefix}_records")
+        cur.execute(f"DROP TRIGGER IF EXISTS {prefix}_records_daily_delete ON {prefix}_records")
+        cur.execute(f"DROP FUNCTION IF EXISTS {prefix}_records_daily_insert()")
+        cur.execute(f"DROP FUNCTION IF EXISTS {prefix}_records_daily_delete()")
+        cur.execute(
+            f"""
+            INSERT INTO records_daily (department, day, employee_telegram_id, category_code, count)
+            SELECT %s, day, employee_telegram_id, category_code, count
+            FROM {prefix}_records_daily
+            WHERE count > 0
+            """,
+            (department,)
+        )
+        cur.execute(f"DROP TABLE {prefix}_records_daily")
+
+        # Первичный ключ партиции создаст ATTACH по ключу records
+        cur.execute(
+            "SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'",
+            (f"{prefix}_records",)
+        )
+        for (constraint,) in cur.fetchall():
+            cur.execute(f"ALTER TABLE {prefix}_records DROP CONSTRAINT {constraint}")
+        cur.execute(f"ALTER TABLE {prefix}_records ADD COLUMN department VARCHAR(32) NOT NULL DEFAULT %s", (department,))
+
+        cur.execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {prefix}_records")
+        next_id = max(next_id, cur.fetchone()[0])
+        cur.execute("SELECT pg_get_serial_sequence(%s, 'id')", (f"{prefix}_records",))
+        sequence = cur.fetchone()[0]
+        cur.execute(f"ALTER TABLE {prefix}_records ALTER COLUMN id SET DEFAULT nextval('records_id_seq')")
+        if sequence:
+            cur.execute(f"DROP SEQUENCE {sequence}")
+
+        cur.execute(f"ALTER TABLE records ATTACH PARTITION {prefix}_records FOR VALUES IN (%s)", (department,))
+
+    cur.execute("SELECT setval('records_id_seq', %s, false)", (next_id,))
+    # Одноимённые индексы партиций подключаются к индексам records
+    cur.execute("CREATE INDEX records_phone_ts_idx ON records (phone, timestamp)")
+    cur.execute(
+        "CREATE INDEX records_duplicate_idx ON records (employee_telegram_id, category_code, phone, timestamp)"
+    )
+    cur.execute("CREATE INDEX records_ts_idx ON records (timestamp)")
+    create_daily_rollup_functions(cur)
+    create_daily_rollup_triggers(cur)
+
+def migration_contact_phone_keys(cur):
+    """
+    Телефоны копии контактов были сохранены через normalize_phone и для части
+    иностранных номеров не восстанавливаются. Очищаем их и состояние
+    синхронизации: при старте пройдёт полная синхронизация с новыми ключами,
+    до её завершения поиск идёт в crm.contact.list.
+    """
+    cur.execute("DELETE FROM bitrix_contact_phones")
+    cur.execute("DELETE FROM bitrix_sync_state WHERE name IN ('contacts_date_modify', 'contacts_full_sync_at')")
+
+def migration_rollup_null_category(cur):
+    """
+    Записи без категории (category_code NULL) роняли триггер агрегатов:
+    records_daily.category_code NOT NULL. Функции триггеров пересоздаются
+    с COALESCE(category_code, '').
+    """
+    create_daily_rollup_functions(cur)
+
+def migration_shared_reference_tables(cur):
+    """
+    Общие таблицы employees, categories и crm_outbox с колонкой department
+    вместо {prefix}_employees, {prefix}_categories и {prefix}_crm_outbox.
+    Строки переносятся из таблиц всех департаментов - и реестра, и таблицы
+    departments; задачи очереди получают новые id в прежнем порядке.
+    """
+    cur.execute(
+        """
+        CREATE TABLE employees (
+            department VARCHAR(32) NOT NULL,
+            telegram_id BIGINT NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            bitrix_id INT NOT NULL,
+            PRIMARY KEY (department, telegram_id)
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE categories (
+            department VARCHAR(32) NOT NULL,
+            code VARCHAR(10) NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            PRIMARY KEY (department, code)
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE crm_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            department VARCHAR(32) NOT NULL,
+            record_id INT NOT NULL,
+            phone VARCHAR(20) NOT NULL,
+            category_name VARCHAR(255) NOT NULL,
+            comment TEXT,
+            responsible_id INT NOT NULL,
+            chat_id BIGINT,
+            message_id BIGINT,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            last_error TEXT,
+            contact_id BIGINT,
+            task_id BIGINT,
+            comment_id BIGINT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE INDEX crm_outbox_due_idx
+        ON crm_outbox (department, next_attempt_at)
+        WHERE status IN ('pending', 'processing')
+        """
+    )
+    cur.execute("CREATE INDEX crm_outbox_record_idx ON crm_outbox (department, record_id)")
+
+    outbox_columns = (
+        "record_id, phone, category_name, comment, responsible_id, chat_id, message_id, status, "
+        "attempts, last_error, contact_id, task_id, comment_id, created_at, updated_at, next_attempt_at"
+    )
+    copies = (
+        ("employees", "telegram_id, name, bitrix_id", "telegram_id"),
+        ("categories", "code, name", "code"),
+        ("crm_outbox", outbox_columns, "id"),
+    )
+    cur.execute("SELECT name FROM departments")
+    names = sorted(set(DEPARTMENTS) | {row[0] for row in cur.fetchall()})
+    for department in names:
+        for table, columns, order in copies:
+            legacy = f"{department}_{table}"
+            cur.execute("SELECT to_regclass(%s)", (legacy,))
+            if cur.fetchone()[0] is None:
+                continue
+            cur.execute(f"LOCK TABLE {legacy} IN ACCESS EXCLUSIVE MODE")
+            cur.execute(
+                f"""
+                INSERT INTO {table} (department, {columns})
+                SELECT %s, {columns} FROM {legacy} ORDER BY {order}
+                """,
+                (department,)
+            )
+            cur.execute(f"DROP TABLE {legacy}")
+
+# (версия, название, функция) - только дописывать в конец
+MIGRATIONS = [
+    (1, "base tables", migration_base_tables),
+    (2, "crm outbox", migration_crm_outbox),
+    (3, "bitrix contacts mirror", migration_contacts_mirror),
+    (4, "daily rollup", migration_daily_rollup),
+    (5, "monthly partitions for records", migration_partition_records),
+    (6, "hot path indexes", migration_hot_path_indexes),
+    (7, "shared records partitioned by department", migration_shared_records),
+    (8, "contact mirror phone keys", migration_contact_phone_keys),
+    (9, "daily rollup for records without category", migration_rollup_null_category),
+    (10, "shared employees, categories and crm outbox", migration_shared_reference_tables),
+]
+
+def run_migrations():
+    """
+    Применить недостающие миграции. Каждая миграция - отдельная транзакция,
+    применённые версии хранятся в schema_migrations. Advisory lock не даёт
+    двум процессам мигрировать одновременно. Возвращает список применённых версий.
+    """
+    applied_now = []
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_ID,))
+            try:
+                cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INT PRIMARY KEY,
+                        name VARCHAR(255) NOT NULL,
+                        applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                    )
+                    """
+                )
+                cur.execute("SELECT version FROM schema_migrations")
+                applied = {row[0] for row in cur.fetchall()}
+                conn.commit()
+
+                for version, name, migrate in MIGRATIONS:
+                    if version in applied:
+                        continue
+                    log.info("Миграция схемы", extra={"version": version, "migration": name})
+                    migrate(cur)
+                    cur.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                        (version, name)
+                    )
+                    conn.commit()
+                    applied_now.append(version)
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_ID,))
+                conn.commit()
     finally:
         release_conn(conn)
+    return applied_now
 
-def add_employee(telegram_id, name, bitrix_id, department):
-    """Добавить сотрудника"""
+def month_start(dt):
+    """Начало месяца (UTC) для даты/времени"""
+    dt = dt.astimezone(timezone.utc) if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def next_month(dt):
+    return (dt + timedelta(days=32)).replace(day=1)
+
+def create_record_partitions(cur, prefix, since=None, months_ahead=RECORDS_PARTITION_MONTHS_AHEAD):
+    """
+    Создать месячные партиции {prefix}_records_pYYYY_MM от месяца since
+    (по умолчанию - текущего) до текущего + months_ahead. Существующие пропускаются.
+    """
+    now = datetime.now(timezone.utc)
+    month = month_start(since or now)
+    last = month_start(now)
+    for _ in range(months_ahead):
+        last = next_month(last)
+
+    while month <= last:
+        upper = next_month(month)
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {prefix}_records_p{month:%Y_%m}
+            PARTITION OF {prefix}_records
+            FOR VALUES FROM (%s) TO (%s)
+            """,
+            (month, upper)
+        )
+        month = upper
+
+def create_department_tables(cur, department):
+    """
+    Партиция департамента в records (для департаментов, добавленных в реестр
+    после миграций). Сотрудники, категории и очередь CRM - в общих таблицах.
+    Существующие партиции пропускаются.
+    """
     prefix = get_table_prefix(department)
-    if not prefix:
-        return False
+    cur.execute("SELECT to_regclass(%s)", (f"{prefix}_records",))
+    if cur.fetchone()[0] is None:
+        cur.execute(
+            f"""
+            CREATE TABLE {prefix}_records PARTITION OF records
+            FOR VALUES IN (%s) PARTITION BY RANGE (timestamp)
+            """,
+            (department,)
+        )
+        cur.execute(f"CREATE TABLE {prefix}_records_default PARTITION OF {prefix}_records DEFAULT")
+        create_record_partitions(cur, prefix)
 
+def ensure_department_tables():
+    """Досоздать партиции для всех департаментов реестра (при запуске)"""
     conn = get_conn()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                INSERT INTO {prefix}_employees (telegram_id, name, bitrix_id)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (telegram_id) DO UPDATE
-                SET name = EXCLUDED.name, bitrix_id = EXCLUDED.bitrix_id
-                """,
-                (telegram_id, name, bitrix_id)
-            )
+            for department in DEPARTMENTS:
+                create_department_tables(cur, department)
             conn.commit()
-            return True
-    except Exception as e:
+    except Exception:
         conn.rollback()
-        print(f"❌ add_employee error: {e}")
-        return False
+        raise
+    finally:
+        release_conn(conn)
+
+def ensure_record_partitions():
+    """Досоздать партиции записей наперёд (при запуске и раз в сутки)"""
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            for department in DEPARTMENTS:
+                create_record_partitions(cur, get_table_prefix(department))
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        log.exception("ensure_record_partitions error")
     finally:
         release_conn(conn)
 
+# ==========================================
+# DATABASE FUNCTIONS - EMPLOYEES
+# ==========================================
+
+def get_employee_by_telegram_id(telegram_id, department, use_cache=True):
+    """Получить сотрудника по Telegram ID"""
+    if not get_table_prefix(department):
+        return None
+
+    if use_cache:
+        return get_reference_data(department).employees_by_id.get(telegram_id)
+    return storage.get_employee(telegram_id, department)
+
+@observe_db
+def add_employee(telegram_id, name, bitrix_id, department):
+    """Добавить сотрудника"""
+    if not get_table_prefix(department):
+        return False
+
+    added = storage.add_employee(telegram_id, name, bitrix_id, department)
+    if added:
+        invalidate_reference_data(department)
+    return added
+
+@observe_db
 def delete_employee(telegram_id, department):
     """Удалить сотрудника"""
+    if not get_table_prefix(department):
+        return False
+
+    deleted = storage.delete_employee(telegram_id, department)
+    if deleted:
+        invalidate_reference_data(department)
+    return deleted
+
+@observe_db
+def get_all_employees(department):
+    """Получить всех сотрудников"""
+    if not get_table_prefix(department):
+        return []
+
+    return storage.get_employees(department)
+
+# ==========================================
+# DATABASE FUNCTIONS - CATEGORIES
+# ==========================================
+
+def get_category_by_code(code, department, use_cache=True):
+    """Получить категорию по коду"""
+    if not get_table_prefix(department):
+        return None
+
+    if use_cache:
+        return get_reference_data(department).categories_by_code.get(code.upper())
+    return storage.get_category(code.upper(), department)
+
+@observe_db
+def add_category(code, name, department):
+    """Добавить категорию"""
+    if not get_table_prefix(department):
+        return False
+
+    added = storage.add_category(code.upper(), name, department)
+    if added:
+        # Сбрасываем кэш для этого департамента
+        invalidate_reference_data(department)
+    return added
+
+@observe_db
+def delete_category(code, department):
+    """Удалить категорию"""
+    if not get_table_prefix(department):
+        return False
+
+    deleted = storage.delete_category(code.upper(), department)
+    if deleted:
+        # Сбрасываем кэш для этого департамента
+        invalidate_reference_data(department)
+    return deleted
+
+def get_all_categories(department, use_cache=True):
+    """Получить все категории (с кэшированием на REFERENCE_CACHE_TTL секунд)"""
     prefix = get_table_prefix(department)
     if not prefix:
+        return []
+
+    return get_reference_data(department, use_cache=use_cache).categories
+
+# ==========================================
+# СПРАВОЧНИКИ (КЭШ СОТРУДНИКОВ И КАТЕГОРИЙ)
+# ==========================================
+
+class ReferenceData:
+    """Снимок справочников департамента с индексами по telegram_id и коду"""
+
+    def __init__(self, employees, categories):
+        self.employees = employees
+        self.categories = categories
+        self.employees_by_id = {emp['telegram_id']: emp for emp in employees}
+        self.categories_by_code = {cat['code'].upper(): cat for cat in categories}
+        self.loaded_at = time.monotonic()
+
+    def is_fresh(self):
+        return time.monotonic() - self.loaded_at < REFERENCE_CACHE_TTL
+
+@observe_db
+def load_reference_data(department):
+    """Загрузить сотрудников и категории из хранилища"""
+    employees, categories = storage.get_reference(department)
+    return ReferenceData(employees, categories)
+
+def get_reference_data(department, use_cache=True):
+    """
+    Справочники департамента из кэша.
+    Новый снимок собирается целиком и подменяет старый одной операцией,
+    поэтому читатели никогда не видят частично обновлённые данные.
+    """
+    data = reference_cache.get(department)
+    if use_cache and data is not None and data.is_fresh():
+        return data
+
+    with reference_cache_lock:
+        # Пока ждали блокировку, другой поток мог уже обновить кэш
+        data = reference_cache.get(department)
+        if use_cache and data is not None and data.is_fresh():
+            return data
+        data = load_reference_data(department)
+        reference_cache[department] = data
+        return data
+
+def invalidate_reference_data(department):
+    """Сбросить кэш справочников департамента"""
+    reference_cache.pop(department, None)
+    # В сводках /info - имена сотрудников и категорий
+    if info_cache is not None:
+        info_cache.clear()
+
+# ==========================================
+# DATABASE FUNCTIONS - RECORDS
+# ==========================================
+
+@observe_db
+def add_record(employee_telegram_id, category_code, phone, comment, department, crm_job=None):
+    """
+    Добавить запись.
+    Если передан crm_job, в той же транзакции ставится задача в очередь Bitrix24.
+    """
+    if not get_table_prefix(department):
+        return None
+
+    record_id = storage.add_record(employee_telegram_id, category_code.upper(), phone, comment, department, crm_job)
+    if record_id and duplicate_index is not None:
+        duplicate_index.add(department, employee_telegram_id, category_code.upper(), phone)
+    if record_id and info_cache is not None:
+        info_cache.invalidate(department, phone)
+    return record_id
+
+@observe_db
+def check_duplicate_record(employee_telegram_id, category_code, phone, department, minutes=5):
+    """Проверить наличие дубликата за последние N минут (окно в памяти, иначе - БД)"""
+    if not get_table_prefix(department):
         return False
 
+    if duplicate_index is not None:
+        seen = duplicate_index.seen(department, employee_telegram_id, category_code.upper(), phone, minutes)
+        if seen is not None:
+            return seen
+    return storage.has_recent_record(employee_telegram_id, category_code.upper(), phone, department, minutes)
+
+@observe_db
+def resolve_message_context(telegram_id, code, phone, department, minutes=5):
+    """
+    Категория, сотрудник и проверка дубликата. Справочники берутся из кэша,
+    дубликат - из окна в памяти, при холодном окне - один запрос к БД.
+    Возвращает {'category': dict|None, 'employee': dict|None, 'is_duplicate': bool}
+    """
+    if not get_table_prefix(department):
+        return None
+
+    category = get_category_by_code(code, department)
+    return {
+        'category': category,
+        'employee': get_employee_by_telegram_id(telegram_id, department),
+        'is_duplicate': category is not None and check_duplicate_record(
+            telegram_id, code, phone, department, minutes=minutes
+        )
+    }
+
+@observe_db
+def get_records_by_phone(phone, days, department):
+    """Получить записи по телефону за последние N дней"""
+    if not get_table_prefix(department):
+        return []
+
+    return storage.get_records_by_phone(phone, days, department)
+
+@observe_db
+def get_team_stats(days, department):
+    """Получить статистику по команде за последние N дней"""
+    if not get_table_prefix(department):
+        return {'total': 0, 'by_employee': [], 'by_category': []}
+
+    return storage.get_team_stats(days, department)
+
+def split_team_stats(rows):
+    """
+    Разложить строки GROUPING SETS на итог и две разбивки.
+    GROUPING(...) = 0 для колонок, по которым сгруппирована строка.
+    """
+    total = 0
+    by_employee = []
+    by_category = []
+    for row in rows:
+        if row['by_employee'] and row['by_category']:
+            total = row['count']
+        elif not row['by_employee']:
+            by_employee.append({'name': row['employee_name'], 'count': row['count']})
+        else:
+            by_category.append({'name': row['category_name'], 'code': row['code'], 'count': row['count']})
+
+    return {
+        'total': total,
+        'by_employee': by_employee,
+        'by_category': by_category
+    }
+
+# ==========================================
+# ОКНО ДУБЛИКАТОВ (В ПАМЯТИ)
+# ==========================================
+
+class DuplicateIndex:
+    """
+    Недавние ключи (департамент, сотрудник, категория, телефон) -> время
+    последней записи. Ключи разложены по минутным корзинам: корзины старше
+    окна удаляются целиком, так что проверка дубликата - поиск в словаре.
+    Заполняется из БД при запуске (warm) и пополняется в add_record.
+    До прогрева и для окна шире хранимого отвечает None - тогда спрашиваем БД.
+    """
+
+    def __init__(self, window_minutes=DUPLICATE_INDEX_MINUTES, bucket_seconds=60):
+        self.window = window_minutes * 60
+        self.bucket_seconds = bucket_seconds
+        self.last_seen = {}
+        self.buckets = deque()  # (номер корзины, [ключи])
+        self.lock = threading.Lock()
+        self.ready = False
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, department, employee_telegram_id, category_code, phone, at=None):
+        at = at if at is not None else time.time()
+        key = (department, employee_telegram_id, category_code, phone)
+        bucket = int(at // self.bucket_seconds)
+        with self.lock:
+            if self.last_seen.get(key, 0) < at:
+                self.last_seen[key] = at
+            # Запись из прошлого попадает в последнюю корзину - просто проживёт дольше
+            if not self.buckets or self.buckets[-1][0] < bucket:
+                self.buckets.append((bucket, []))
+            self.buckets[-1][1].append(key)
+            self.expire(time.time())
+
+    def expire(self, now):
+        """Удалить корзины старше окна (под self.lock)"""
+        cutoff = now - self.window
+        horizon = int(cutoff // self.bucket_seconds)
+        while self.buckets and self.buckets[0][0] < horizon:
+            _, keys = self.buckets.popleft()
+            for key in keys:
+                if self.last_seen.get(key, now) <= cutoff:
+                    del self.last_seen[key]
+
+    def seen(self, department, employee_telegram_id, category_code, phone, minutes):
+        """Была ли такая запись за minutes минут; None - индекс ответить не может"""
+        if not self.ready or minutes * 60 > self.window:
+            with self.lock:
+                self.misses += 1
+            return None
+        now = time.time()
+        with self.lock:
+            self.expire(now)
+            self.hits += 1
+            at = self.last_seen.get((department, employee_telegram_id, category_code, phone))
+        return at is not None and at > now - minutes * 60
+
+    def warm(self):
+        """Загрузить записи за окно из хранилища"""
+        for department in DEPARTMENTS:
+            for row in storage.recent_records(department, self.window // 60):
+                self.add(
+                    department, row['employee_telegram_id'], row['category_code'],
+                    row['phone'], row['timestamp'].timestamp()
+                )
+        self.ready = True
+        log.info("Окно дубликатов прогрето", extra={"keys": len(self.last_seen)})
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.last_seen), 'hits': self.hits, 'misses': self.misses}
+
+duplicate_index = DuplicateIndex() if DUPLICATE_INDEX_ENABLED else None
+
+# Записи, принятые handle_message, но ещё не сохранённые (save_record идёт в
+# пуле потоков): такой же ключ в это время - тоже дубликат
+saving_records = set()
+saving_records_lock = threading.Lock()
+
+def reserve_record(key):
+    """Занять ключ (департамент, сотрудник, категория, телефон); False - уже сохраняется"""
+    with saving_records_lock:
+        if key in saving_records:
+            return False
+        saving_records.add(key)
+        return True
+
+def release_record(key):
+    with saving_records_lock:
+        saving_records.discard(key)
+
+def warm_duplicate_index():
+    """Прогреть окно дубликатов при запуске (ошибка - остаёмся на запросах к БД)"""
+    if duplicate_index is None:
+        return
+    try:
+        duplicate_index.warm()
+    except Exception:
+        log.exception("warm_duplicate_index error")
+
+# ==========================================
+# ХРАНИЛИЩЕ
+# ==========================================
+# Функции выше - публичный API для обработчиков (кэш справочников, метрики,
+# проверка департамента); чтение и запись идут через storage. PostgresStorage -
+# рабочее хранилище, MemoryStorage - в памяти процесса с той же семантикой
+# (для бенчмарков и профилирования без БД): main.storage = MemoryStorage().
+
+class Storage(ABC):
+    """
+    Интерфейс хранилища сотрудников, категорий, записей и статистики.
+    Департамент уже проверен, коды категорий приходят в верхнем регистре.
+    """
+
+    @abstractmethod
+    def get_employee(self, telegram_id, department):
+        """Сотрудник {'telegram_id', 'name', 'bitrix_id'} или None"""
+
+    @abstractmethod
+    def get_employees(self, department):
+        """Все сотрудники, по имени"""
+
+    @abstractmethod
+    def add_employee(self, telegram_id, name, bitrix_id, department):
+        """Добавить или обновить сотрудника, True при успехе"""
+
+    @abstractmethod
+    def delete_employee(self, telegram_id, department):
+        """True, если сотрудник был удалён"""
+
+    @abstractmethod
+    def get_category(self, code, department):
+        """Категория {'code', 'name'} или None"""
+
+    @abstractmethod
+    def get_categories(self, department):
+        """Все категории, по коду"""
+
+    @abstractmethod
+    def add_category(self, code, name, department):
+        """Добавить или переименовать категорию, True при успехе"""
+
+    @abstractmethod
+    def delete_category(self, code, department):
+        """True, если категория была удалена"""
+
+    def get_reference(self, department):
+        """(сотрудники, категории) - для кэша справочников"""
+        return self.get_employees(department), self.get_categories(department)
+
+    @abstractmethod
+    def add_record(self, employee_telegram_id, category_code, phone, comment, department, crm_job=None):
+        """ID новой записи или None при ошибке"""
+
+    @abstractmethod
+    def has_recent_record(self, employee_telegram_id, category_code, phone, department, minutes):
+        """Есть ли такая же запись за последние minutes минут"""
+
+    @abstractmethod
+    def recent_records(self, department, minutes):
+        """Записи за последние minutes минут: employee_telegram_id, category_code, phone, timestamp"""
+
+    @abstractmethod
+    def get_records_by_phone(self, phone, days, department):
+        """
+        Записи по телефону за N дней, новые первыми:
+        timestamp, employee_name, category_name, category_code, phone, comment
+        """
+
+    @abstractmethod
+    def get_team_stats(self, days, department):
+        """{'total', 'by_employee': [{name, count}], 'by_category': [{name, code, count}]}"""
+
+# Колонки справочников - как у MemoryStorage, без department
+EMPLOYEE_COLUMNS = "telegram_id, name, bitrix_id"
+CATEGORY_COLUMNS = "code, name"
+
+class PostgresStorage(Storage):
+    """Хранилище в PostgreSQL: общие employees / categories / records с колонкой department"""
+
+    def get_employee(self, telegram_id, department):
+        conn = get_conn()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    f"SELECT {EMPLOYEE_COLUMNS} FROM employees WHERE department = %s AND telegram_id = %s",
+                    (department, telegram_id)
+                )
+                return cur.fetchone()
+        finally:
+            release_conn(conn)
+
+    def get_employees(self, department):
+        conn = get_conn()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    f"SELECT {EMPLOYEE_COLUMNS} FROM employees WHERE department = %s ORDER BY name",
+                    (department,)
+                )
+                return cur.fetchall()
+        finally:
+            release_conn(conn)
+
+    def add_employee(self, telegram_id, name, bitrix_id, department):
+        conn = get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO employees (department, telegram_id, name, bitrix_id)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (department, telegram_id) DO UPDATE
+                    SET name = EXCLUDED.name, bitrix_id = EXCLUDED.bitrix_id
+                    """,
+                    (department, telegram_id, name, bitrix_id)
+                )
+                conn.commit()
+                return True
+        except Exception:
+            conn.rollback()
+            log.exception("add_employee error")
+            return False
+        finally:
+            release_conn(conn)
+
+    def delete_employee(self, telegram_id, department):
+        conn = get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM employees WHERE department = %s AND telegram_id = %s",
+                    (department, telegram_id)
+                )
+                conn.commit()
+                return cur.rowcount > 0
+        except Exception:
+            conn.rollback()
+            log.exception("delete_employee error")
+            return False
+        finally:
+            release_conn(conn)
+
+    def get_category(self, code, department):
+        conn = get_conn()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    f"SELECT {CATEGORY_COLUMNS} FROM categories WHERE department = %s AND code = %s",
+                    (department, code)
+                )
+                return cur.fetchone()
+        finally:
+            release_conn(conn)
+
+    def get_categories(self, department):
+        conn = get_conn()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    f"SELECT {CATEGORY_COLUMNS} FROM categories WHERE department = %s ORDER BY code",
+                    (department,)
+                )
+                return cur.fetchall()
+        finally:
+            release_conn(conn)
+
+    def add_category(self, code, name, department):
+        conn = get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO categories (department, code, name)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (department, code) DO UPDATE
+                    SET name = EXCLUDED.name
+                    """,
+                    (department, code, name)
+                )
+                conn.commit()
+                return True
+        except Exception:
+            conn.rollback()
+            log.exception("add_category error")
+            return False
+        finally:
+            release_conn(conn)
+
+    def delete_category(self, code, department):
+        conn = get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM categories WHERE department = %s AND code = %s",
+                    (department, code)
+                )
+                conn.commit()
+                return cur.rowcount > 0
+        except Exception:
+            conn.rollback()
+            log.exception("delete_category error")
+            return False
+        finally:
+            release_conn(conn)
+
+    def get_reference(self, department):
+        """Сотрудники и категории одним соединением"""
+        conn = get_conn()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    f"SELECT {EMPLOYEE_COLUMNS} FROM employees WHERE department = %s ORDER BY name",
+                    (department,)
+                )
+                employees = cur.fetchall()
+                cur.execute(
+                    f"SELECT {CATEGORY_COLUMNS} FROM categories WHERE department = %s ORDER BY code",
+                    (department,)
+                )
+                categories = cur.fetchall()
+                return employees, categories
+        finally:
+            release_conn(conn)
+
+    def add_record(self, employee_telegram_id, category_code, phone, comment, department, crm_job=None):
+        if record_writer is not None:
+            return record_writer.add(employee_telegram_id, category_code, phone, comment, department, crm_job)
+        return self.insert_record(employee_telegram_id, category_code, phone, comment, department, crm_job)
+
+    def insert_record(self, employee_telegram_id, category_code, phone, comment, department, crm_job=None):
+        """Одна запись - отдельная транзакция"""
+        conn = None
+        try:
+            conn = get_conn()
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    INSERT INTO records
+                    (department, employee_telegram_id, category_code, phone, comment)
+                    VALUES (%s, %s, %s, %s, %s)
+                    RETURNING id
+                    """,
+                    (department, employee_telegram_id, category_code, phone, comment)
+                )
+                record_id = cur.fetchone()[0]
+                if crm_job:
+                    enqueue_crm_job(cur, department, record_id, phone, comment, crm_job)
+                conn.commit()
+                return record_id
+        except Exception:
+            if conn is not None:
+                conn.rollback()
+            log.exception("add_record error")
+            return None
+        finally:
+            if conn is not None:
+                release_conn(conn)
+
+    def has_recent_record(self, employee_telegram_id, category_code, phone, department, minutes):
+        conn = get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT COUNT(*) FROM records
+                    WHERE department = %s
+                    AND employee_telegram_id = %s
+                    AND category_code = %s
+                    AND phone = %s
+                    AND timestamp > NOW() - make_interval(mins => %s)
+                    """,
+                    (department, employee_telegram_id, category_code, phone, minutes)
+                )
+                count = cur.fetchone()[0]
+                return count > 0
+        finally:
+            release_conn(conn)
+
+    def recent_records(self, department, minutes):
+        conn = get_conn()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    """
+                    SELECT employee_telegram_id, category_code, phone, timestamp
+                    FROM records
+                    WHERE department = %s
+                    AND timestamp > NOW() - make_interval(mins => %s)
+                    ORDER BY timestamp
+                    """,
+                    (department, minutes)
+                )
+                return cur.fetchall()
+        finally:
+            release_conn(conn)
+
+    def get_records_by_phone(self, phone, days, department):
+        conn = get_conn()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    """
+                    SELECT
+                        r.timestamp,
+                        e.name as employee_name,
+                        c.name as category_name,
+                        r.category_code,
+                        r.phone,
+                        r.comment
+                    FROM records r
+                    LEFT JOIN employees e ON e.department = r.department AND e.telegram_id = r.employee_telegram_id
+                    LEFT JOIN categories c ON c.department = r.department AND c.code = r.category_code
+                    WHERE r.department = %s
+                    AND r.phone = %s
+                    AND r.timestamp > NOW() - make_interval(days => %s)
+                    ORDER BY r.timestamp DESC
+                    """,
+                    (department, phone, days)
+                )
+                return cur.fetchall()
+        finally:
+            release_conn(conn)
+
+    def get_team_stats(self, days, department):
+        """
+        Полные дни берутся из дневных агрегатов (records_daily, их
+        поддерживает триггер - включая сегодняшний день), сырые записи читаются
+        только за неполный первый день окна. Итог, разбивка по сотрудникам и по
+        категориям считаются одним проходом (GROUPING SETS).
+        """
+        conn = get_conn()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    """
+                    WITH bounds AS (
+                        SELECT
+                            NOW() - make_interval(days => %(days)s) AS since,
+                            ((NOW() - make_interval(days => %(days)s)) AT TIME ZONE %(tz)s)::date AS first_day
+                    ),
+                    src AS (
+                        SELECT d.employee_telegram_id, d.category_code, d.count
+                        FROM records_daily d, bounds b
+                        WHERE d.department = %(department)s
+                        AND d.day > b.first_day
+                        UNION ALL
+                        SELECT COALESCE(r.employee_telegram_id, 0), COALESCE(r.category_code, ''), 1
+                        FROM records r, bounds b
+                        WHERE r.department = %(department)s
+                        AND r.timestamp > b.since
+                        AND r.timestamp < (b.first_day + 1)::timestamp AT TIME ZONE %(tz)s
+                    )
+                    SELECT
+                        GROUPING(e.name) AS by_employee,
+                        GROUPING(c.name, c.code) AS by_category,
+                        e.name AS employee_name,
+                        c.name AS category_name,
+                        c.code,
+                        COALESCE(SUM(s.count), 0) AS count
+                    FROM src s
+                    LEFT JOIN employees e ON e.department = %(department)s AND e.telegram_id = s.employee_telegram_id
+                    LEFT JOIN categories c ON c.department = %(department)s AND c.code = s.category_code
+                    GROUP BY GROUPING SETS ((), (e.name), (c.name, c.code))
+                    ORDER BY count DESC
+                    """,
+                    {'department': department, 'days': days, 'tz': STATS_TIMEZONE}
+                )
+                rows = cur.fetchall()
+        finally:
+            release_conn(conn)
+
+        return split_team_stats(rows)
+
+class MemoryStorage(Storage):
+    """
+    Хранилище в памяти процесса. Повторяет семантику PostgresStorage:
+    upsert справочников, записи без внешних ключей (как в секционированной
+    records), окно дубликатов, агрегация статистики.
+    Задачи CRM из add_record складываются в crm_jobs (воркер их не забирает).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.employees = {}   # department -> {telegram_id: сотрудник}
+        self.categories = {}  # department -> {code: категория}
+        self.records = {}     # department -> [запись] в порядке добавления
+        self.by_phone = {}    # (department, phone) -> [запись]
+        self.last_seen = {}   # (department, employee, code, phone) -> время последней записи
+        self.crm_jobs = []
+        self.next_id = 1
+
+    def get_employee(self, telegram_id, department):
+        with self.lock:
+            employee = self.employees.get(department, {}).get(telegram_id)
+            return dict(employee) if employee else None
+
+    def get_employees(self, department):
+        with self.lock:
+            employees = self.employees.get(department, {}).values()
+            return sorted((dict(emp) for emp in employees), key=lambda emp: emp['name'])
+
+    def add_employee(self, telegram_id, name, bitrix_id, department):
+        with self.lock:
+            self.employees.setdefault(department, {})[telegram_id] = {
+                'telegram_id': telegram_id, 'name': name, 'bitrix_id': bitrix_id
+            }
+            return True
+
+    def delete_employee(self, telegram_id, department):
+        with self.lock:
+            return self.employees.get(department, {}).pop(telegram_id, None) is not None
+
+    def get_category(self, code, department):
+        with self.lock:
+            category = self.categories.get(department, {}).get(code)
+            return dict(category) if category else None
+
+    def get_categories(self, department):
+        with self.lock:
+            categories = self.categories.get(department, {}).values()
+            return sorted((dict(cat) for cat in categories), key=lambda cat: cat['code'])
+
+    def add_category(self, code, name, department):
+        with self.lock:
+            self.categories.setdefault(department, {})[code] = {'code': code, 'name': name}
+            return True
+
+    def delete_category(self, code, department):
+        with self.lock:
+            return self.categories.get(department, {}).pop(code, None) is not None
+
+    def add_record(self, employee_telegram_id, category_code, phone, comment, department, crm_job=None):
+        with self.lock:
+            record = {
+                'id': self.next_id,
+                'employee_telegram_id': employee_telegram_id,
+                'category_code': category_code,
+                'phone': phone,
+                'comment': comment,
+                'timestamp': datetime.now(timezone.utc)
+            }
+            self.next_id += 1
+            self.records.setdefault(department, []).append(record)
+            self.by_phone.setdefault((department, phone), []).append(record)
+            self.last_seen[(department, employee_telegram_id, category_code, phone)] = record['timestamp']
+            if crm_job:
+                self.crm_jobs.append(dict(crm_job, record_id=record['id'], department=department,
+                                          phone=phone, comment=comment))
+            return record['id']
+
+    def has_recent_record(self, employee_telegram_id, category_code, phone, department, minutes):
+        with self.lock:
+            seen = self.last_seen.get((department, employee_telegram_id, category_code, phone))
+        return seen is not None and seen > datetime.now(timezone.utc) - timedelta(minutes=minutes)
+
+    def recent_records(self, department, minutes):
+        since = datetime.now(timezone.utc) - timedelta(minutes=minutes)
+        with self.lock:
+            records = self.records.get(department, ())
+            start = len(records)
+            while start and records[start - 1]['timestamp'] > since:
+                start -= 1
+            return [dict(record) for record in records[start:]]
+
+    def get_records_by_phone(self, phone, days, department):
+        since = datetime.now(timezone.utc) - timedelta(days=days)
+        with self.lock:
+            employees = self.employees.get(department, {})
+            categories = self.categories.get(department, {})
+            result = []
+            for record in reversed(self.by_phone.get((department, phone), ())):
+                if record['timestamp'] <= since:
+                    break
+                employee = employees.get(record['employee_telegram_id'])
+                category = categories.get(record['category_code'])
+                result.append({
+                    'timestamp': record['timestamp'],
+                    'employee_name': employee['name'] if employee else None,
+                    'category_name': category['name'] if category else None,
+                    'category_code': record['category_code'],
+                    'phone': record['phone'],
+                    'comment': record['comment']
+                })
+            return result
+
+    def get_team_stats(self, days, department):
+        since = datetime.now(timezone.utc) - timedelta(days=days)
+        with self.lock:
+            employees = self.employees.get(department, {})
+            categories = self.categories.get(department, {})
+            by_employee = Counter()
+            by_category = Counter()
+            total = 0
+            for record in reversed(self.records.get(department, ())):
+                if record['timestamp'] <= since:
+                    break
+                employee = employees.get(record['employee_telegram_id'])
+                category = categories.get(record['category_code'])
+                by_employee[employee['name'] if employee else None] += 1
+                by_category[(category['name'], category['code']) if category else (None, None)] += 1
+                total += 1
+
+        return {
+            'total': total,
+            'by_employee': [{'name': name, 'count': count} for name, count in by_employee.most_common()],
+            'by_category': [
+                {'name': name, 'code': code, 'count': count}
+                for (name, code), count in by_category.most_common()
+            ]
+        }
+
+storage = PostgresStorage()
+
+# ==========================================
+# ГРУППОВАЯ ФИКСАЦИЯ ЗАПИСЕЙ
+# ==========================================
+
+class PendingRecord:
+    """add_record, ожидающий записи пачкой"""
+
+    def __init__(self, employee_telegram_id, category_code, phone, comment, department, crm_job):
+        self.employee_telegram_id = employee_telegram_id
+        self.category_code = category_code
+        self.phone = phone
+        self.comment = comment
+        self.department = department
+        self.crm_job = crm_job
+        self.record_id = None
+        self.done = threading.Event()
+        self.queued_at = time.monotonic()
+        self.taken = False      # попала в записываемую пачку
+        self.cancelled = False  # вызывающий перестал ждать до записи
+
+class GroupCommitWriter:
+    """
+    Пачечная запись add_record из параллельных обработчиков: одна транзакция,
+    один INSERT в records (execute_values) и одна фиксация на пачку.
+    Пачка уходит через max_delay после первой записи или при max_batch записях,
+    поэтому задержка ограничена. id выделяются из последовательности заранее -
+    каждый вызывающий получает id своей записи. Если пачка не записалась,
+    записи повторяются по одной, чтобы ошибка одной строки не задела остальные.
+    Ожидание ограничено timeout: запись, не попавшая в пачку за это время,
+    отменяется, и add_record возвращает None, как при ошибке БД.
+    """
+
+    def __init__(self, max_delay=GROUP_COMMIT_MS / 1000, max_batch=GROUP_COMMIT_MAX):
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        # Очередь за предыдущей пачкой + ожидание соединения для своей
+        self.timeout = max_delay + 2 * DB_POOL_TIMEOUT
+        self.queue = SimpleQueue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.records = 0
+        self.fallbacks = 0
+        self.largest = 0
+
+    def start(self):
+        worker = threading.Thread(target=self.run, name="group-commit", daemon=True)
+        worker.start()
+        return worker
+
+    def add(self, employee_telegram_id, category_code, phone, comment, department, crm_job=None):
+        """Поставить запись в пачку и дождаться её фиксации, вернуть id или None"""
+        pending = PendingRecord(employee_telegram_id, category_code, phone, comment, department, crm_job)
+        self.queue.put(pending)
+        if pending.done.wait(self.timeout):
+            return pending.record_id
+
+        with self.lock:
+            if not pending.taken:
+                pending.cancelled = True
+        if pending.cancelled:
+            log.error("group commit timeout", extra={"department": department, "waited": self.timeout})
+            return None
+        # Пачка уже пишется - исход записи узнаем после фиксации
+        if not pending.done.wait(self.timeout):
+            log.error("group commit write timeout", extra={"department": department})
+        return pending.record_id
+
+    def run(self):
+        while True:
+            try:
+                batch = self.collect()
+                if batch:
+                    self.flush(batch)
+            except Exception:
+                log.exception("group commit worker error")
+
+    def collect(self):
+        """Собрать пачку: первая запись + всё, что пришло за max_delay"""
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Empty:
+                break
+        with self.lock:
+            batch = [pending for pending in batch if not pending.cancelled]
+            for pending in batch:
+                pending.taken = True
+        return batch
+
+    def flush(self, batch):
+        try:
+            self.write_records(batch)
+        except Exception:
+            log.exception("group commit error", extra={"records": len(batch)})
+            with self.lock:
+                self.fallbacks += 1
+            for pending in batch:
+                # insert_record сам возвращает None при ошибке; страховка на случай сбоя вне его try
+                try:
+                    pending.record_id = storage.insert_record(
+                        pending.employee_telegram_id, pending.category_code, pending.phone,
+                        pending.comment, pending.department, pending.crm_job
+                    )
+                except Exception:
+                    log.exception("add_record error")
+                    pending.record_id = None
+        finally:
+            now = time.monotonic()
+            with self.lock:
+                self.batches += 1
+                self.records += len(batch)
+                self.largest = max(self.largest, len(batch))
+            for pending in batch:
+                GROUP_COMMIT_WAIT.observe(now - pending.queued_at)
+                pending.done.set()
+
+    @observe_db
+    def write_records(self, batch):
+        """Записать пачку одной транзакцией, проставить record_id после фиксации"""
+        conn = get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT nextval('records_id_seq') FROM generate_series(1, %s)",
+                    (len(batch),)
+                )
+                assigned = [(row[0], pending) for row, pending in zip(cur.fetchall(), batch)]
+                execute_values(
+                    cur,
+                    """
+                    INSERT INTO records
+                    (id, department, employee_telegram_id, category_code, phone, comment)
+                    VALUES %s
+                    """,
+                    [
+                        (record_id, p.department, p.employee_telegram_id, p.category_code, p.phone, p.comment)
+                        for record_id, p in assigned
+                    ],
+                    page_size=len(assigned)
+                )
+                jobs = [
+                    crm_job_row(p.department, record_id, p.phone, p.comment, p.crm_job)
+                    for record_id, p in assigned if p.crm_job
+                ]
+                if jobs:
+                    enqueue_crm_jobs(cur, jobs)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            release_conn(conn)
+
+        for record_id, pending in assigned:
+            pending.record_id = record_id
+
+    def stats(self):
+        with self.lock:
+            return {
+                'batches': self.batches,
+                'records': self.records,
+                'fallbacks': self.fallbacks,
+                'largest': self.largest,
+                'avg_batch': self.records / self.batches if self.batches else 0.0
+            }
+
+record_writer = None
+
+def start_group_commit_writer():
+    """Включить групповую фиксацию add_record, если задан GROUP_COMMIT_MS"""
+    global record_writer
+    if GROUP_COMMIT_MS <= 0 or record_writer is not None:
+        return record_writer
+    record_writer = GroupCommitWriter()
+    record_writer.start()
+    log.info("Групповая фиксация записей включена",
+             extra={"max_delay_ms": GROUP_COMMIT_MS, "max_batch": GROUP_COMMIT_MAX})
+    return record_writer
+
+# ==========================================
+# DATABASE FUNCTIONS - ДНЕВНЫЕ АГРЕГАТЫ
+# ==========================================
+# records_daily (департамент, день, сотрудник, категория -> количество)
+# поддерживается триггерами уровня оператора на records: пачка строк
+# (COPY, multi-row INSERT) обновляет агрегаты одним запросом. Запись без
+# категории (category_code NULL) считается под кодом '', как запись без
+# сотрудника - под telegram_id 0.
+
+def create_daily_rollup_functions(cur):
+    """Функции триггеров дневных агрегатов (часовой пояс вшивается в тело)"""
+    tz = cur.mogrify("%s", (STATS_TIMEZONE,)).decode()
+    cur.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION records_daily_insert() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO records_daily AS d (department, day, employee_telegram_id, category_code, count)
+            SELECT department, (timestamp AT TIME ZONE {tz})::date, COALESCE(employee_telegram_id, 0),
+                   COALESCE(category_code, ''), COUNT(*)
+            FROM new_rows
+            GROUP BY 1, 2, 3, 4
+            ORDER BY 1, 2, 3, 4
+            ON CONFLICT (department, day, employee_telegram_id, category_code)
+            DO UPDATE SET count = d.count + EXCLUDED.count;
+            RETURN NULL;
+        END
+        $$
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION records_daily_delete() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE records_daily AS d
+            SET count = d.count - o.count
+            FROM (
+                SELECT department,
+                       (timestamp AT TIME ZONE {tz})::date AS day,
+                       COALESCE(employee_telegram_id, 0) AS employee_telegram_id,
+                       COALESCE(category_code, '') AS category_code,
+                       COUNT(*) AS count
+                FROM old_rows
+                GROUP BY 1, 2, 3, 4
+            ) o
+            WHERE d.department = o.department
+            AND d.day = o.day
+            AND d.employee_telegram_id = o.employee_telegram_id
+            AND d.category_code = o.category_code;
+            RETURN NULL;
+        END
+        $$
+        """
+    )
+
+def create_daily_rollup_triggers(cur):
+    """Триггеры уровня оператора на records"""
+    cur.execute("DROP TRIGGER IF EXISTS records_daily_insert ON records")
+    cur.execute(
+        """
+        CREATE TRIGGER records_daily_insert
+        AFTER INSERT ON records
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION records_daily_insert()
+        """
+    )
+    cur.execute("DROP TRIGGER IF EXISTS records_daily_delete ON records")
+    cur.execute(
+        """
+        CREATE TRIGGER records_daily_delete
+        AFTER DELETE ON records
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION records_daily_delete()
+        """
+    )
+
+def fill_daily_rollup(cur, department):
+    """
+    Пересчитать дневные агрегаты департамента по всей истории (внутри
+    транзакции вызывающего). Партиция департамента блокируется на запись,
+    чтобы вставки во время пересчёта не посчитались дважды.
+    """
+    prefix = get_table_prefix(department)
+    cur.execute(f"LOCK TABLE {prefix}_records IN SHARE MODE")
+    cur.execute("DELETE FROM records_daily WHERE department = %s", (department,))
+    cur.execute(
+        """
+        INSERT INTO records_daily (department, day, employee_telegram_id, category_code, count)
+        SELECT department, (timestamp AT TIME ZONE %s)::date, COALESCE(employee_telegram_id, 0),
+               COALESCE(category_code, ''), COUNT(*)
+        FROM records
+        WHERE department = %s
+        GROUP BY 1, 2, 3, 4
+        """,
+        (STATS_TIMEZONE, department)
+    )
+    return cur.rowcount
+
+@observe_db
+def rebuild_daily_rollup(department):
+    """
+    Перестроить дневные агрегаты департамента (и функции триггеров - на случай
+    смены STATS_TIMEZONE), вернуть число строк агрегатов
+    """
+    if not get_table_prefix(department):
+        return 0
+
     conn = get_conn()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                f"DELETE FROM {prefix}_employees WHERE telegram_id = %s",
-                (telegram_id,)
-            )
+            create_daily_rollup_functions(cur)
+            rows = fill_daily_rollup(cur, department)
             conn.commit()
-            return cur.rowcount > 0
-    except Exception as e:
+            return rows
+    except Exception:
         conn.rollback()
-        print(f"❌ delete_employee error: {e}")
-        return False
+        raise
     finally:
         release_conn(conn)
 
-def get_all_employees(department):
-    """Получить всех сотрудников"""
+# Агрегаты по таблицам департаментов - схема до миграции 7, нужны миграциям 4-5 новой БД
+
+def legacy_init_daily_rollup(cur, prefix):
+    """
+    Таблица {prefix}_records_daily (день, сотрудник, категория -> количество)
+    и триггеры, которые поддерживают её при INSERT/DELETE в {prefix}_records.
+    Триггеры уровня оператора: пачка строк (COPY, multi-row INSERT) обновляет
+    агрегаты одним запросом. Если таблица создаётся впервые, она сразу
+    заполняется по всей истории.
+    """
+    cur.execute("SELECT to_regclass(%s)", (f"{prefix}_records_daily",))
+    is_new = cur.fetchone()[0] is None
+
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {prefix}_records_daily (
+            day DATE NOT NULL,
+            employee_telegram_id BIGINT NOT NULL,
+            category_code VARCHAR(10) NOT NULL,
+            count INT NOT NULL,
+            PRIMARY KEY (day, employee_telegram_id, category_code)
+        )
+        """
+    )
+    legacy_create_daily_rollup_functions(cur, prefix)
+    legacy_create_daily_rollup_triggers(cur, prefix)
+
+    if is_new:
+        legacy_fill_daily_rollup(cur, prefix)
+
+def legacy_create_daily_rollup_functions(cur, prefix):
+    """Функции триггеров дневных агрегатов (часовой пояс вшивается в тело)"""
+    tz = cur.mogrify("%s", (STATS_TIMEZONE,)).decode()
+    cur.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION {prefix}_records_daily_insert() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO {prefix}_records_daily AS d (day, employee_telegram_id, category_code, count)
+            SELECT (timestamp AT TIME ZONE {tz})::date, COALESCE(employee_telegram_id, 0), COALESCE(category_code, ''), COUNT(*)
+            FROM new_rows
+            GROUP BY 1, 2, 3
+            ORDER BY 1, 2, 3
+            ON CONFLICT (day, employee_telegram_id, category_code)
+            DO UPDATE SET count = d.count + EXCLUDED.count;
+            RETURN NULL;
+        END
+        $$
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION {prefix}_records_daily_delete() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE {prefix}_records_daily AS d
+            SET count = d.count - o.count
+            FROM (
+                SELECT (timestamp AT TIME ZONE {tz})::date AS day,
+                       COALESCE(employee_telegram_id, 0) AS employee_telegram_id,
+                       COALESCE(category_code, '') AS category_code,
+                       COUNT(*) AS count
+                FROM old_rows
+                GROUP BY 1, 2, 3
+            ) o
+            WHERE d.day = o.day
+            AND d.employee_telegram_id = o.employee_telegram_id
+            AND d.category_code = o.category_code;
+            RETURN NULL;
+        END
+        $$
+        """
+    )
+
+def legacy_create_daily_rollup_triggers(cur, prefix):
+    """Триггеры уровня оператора на {prefix}_records"""
+    cur.execute(f"DROP TRIGGER IF EXISTS {prefix}_records_daily_insert ON {prefix}_records")
+    cur.execute(
+        f"""
+        CREATE TRIGGER {prefix}_records_daily_insert
+        AFTER INSERT ON {prefix}_records
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION {prefix}_records_daily_insert()
+        """
+    )
+    cur.execute(f"DROP TRIGGER IF EXISTS {prefix}_records_daily_delete ON {prefix}_records")
+    cur.execute(
+        f"""
+        CREATE TRIGGER {prefix}_records_daily_delete
+        AFTER DELETE ON {prefix}_records
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION {prefix}_records_daily_delete()
+        """
+    )
+
+def legacy_fill_daily_rollup(cur, prefix):
+    """
+    Пересчитать дневные агрегаты по всей истории (внутри транзакции вызывающего).
+    Таблица записей блокируется на запись, чтобы вставки во время пересчёта
+    не посчитались дважды.
+    """
+    cur.execute(f"LOCK TABLE {prefix}_records IN SHARE MODE")
+    cur.execute(f"DELETE FROM {prefix}_records_daily")
+    cur.execute(
+        f"""
+        INSERT INTO {prefix}_records_daily (day, employee_telegram_id, category_code, count)
+        SELECT (timestamp AT TIME ZONE %s)::date, COALESCE(employee_telegram_id, 0), COALESCE(category_code, ''), COUNT(*)
+        FROM {prefix}_records
+        GROUP BY 1, 2, 3
+        """,
+        (STATS_TIMEZONE,)
+    )
+    return cur.rowcount
+
+# Колонки «сырой» выгрузки (CSV / Parquet) для pandas и хранилища
+RAW_EXPORT_COLUMNS = [
+    'timestamp', 'employee_telegram_id', 'employee_name',
+    'category_code', 'category_name', 'phone', 'comment'
+]
+
+def export_records_sql(raw=False):
+    """SELECT записей департамента за последние N дней (параметры - department, days)"""
+    if raw:
+        columns = """
+                    r.timestamp,
+                    r.employee_telegram_id,
+                    e.name as employee_name,
+                    r.category_code,
+                    c.name as category_name,
+                    r.phone,
+                    r.comment"""
+    else:
+        columns = """
+                    r.timestamp,
+                    e.name as employee_name,
+                    c.name as category_name,
+                    r.category_code,
+                    r.phone,
+                    r.comment"""
+    return f"""
+                SELECT{columns}
+                FROM records r
+                LEFT JOIN employees e ON e.department = r.department AND e.telegram_id = r.employee_telegram_id
+                LEFT JOIN categories c ON c.department = r.department AND c.code = r.category_code
+                WHERE r.department = %s
+                AND r.timestamp > NOW() - make_interval(days => %s)
+                ORDER BY r.timestamp DESC
+                """
+
+def iter_all_records(days, department, itersize=EXPORT_ITERSIZE, raw=False):
+    """
+    Все записи за последние N дней (для экспорта) - потоком.
+    Серверный курсор отдаёт строки пачками по itersize, в памяти
+    никогда не лежит вся выборка. Строки - кортежи
+    (timestamp, employee_name, category_name, category_code, phone, comment),
+    при raw=True - в порядке RAW_EXPORT_COLUMNS.
+    Соединение возвращается в пул, когда генератор исчерпан или закрыт.
+    """
     prefix = get_table_prefix(department)
     if not prefix:
-        return []
+        return
 
     conn = get_conn()
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                f"SELECT * FROM {prefix}_employees ORDER BY name"
-            )
-            return cur.fetchall()
+        with conn.cursor(name=f"export_{prefix}") as cur:
+            cur.itersize = itersize
+            cur.execute(export_records_sql(raw=raw), (department, days))
+            yield from cur
+        conn.commit()
+    finally:
+        if not conn.closed and conn.status != psycopg2.extensions.STATUS_READY:
+            conn.rollback()
+        release_conn(conn)
+
+@observe_db
+def copy_records_csv(days, department, fileobj):
+    """
+    Выгрузить записи за последние N дней в CSV прямо из PostgreSQL
+    (COPY ... TO STDOUT) в файлоподобный fileobj.
+    """
+    if not get_table_prefix(department):
+        return
+
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            # COPY не принимает параметры - подставляем их через mogrify
+            query = cur.mogrify(export_records_sql(raw=True), (department, days)).decode()
+            cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", fileobj)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
     finally:
         release_conn(conn)
 
 # ==========================================
-# DATABASE FUNCTIONS - CATEGORIES
+# DATABASE FUNCTIONS - CRM OUTBOX
 # ==========================================
 
-def get_category_by_code(code, department):
-    """Получить категорию по коду"""
-    prefix = get_table_prefix(department)
-    if not prefix:
-        return None
+def crm_job_row(department, record_id, phone, comment, crm_job):
+    """Значения строки crm_outbox"""
+    return (
+        department, record_id, phone, crm_job['category_name'], comment,
+        crm_job['responsible_id'], crm_job.get('chat_id'), crm_job.get('message_id')
+    )
+
+def enqueue_crm_job(cur, department, record_id, phone, comment, crm_job):
+    """Поставить задачу для Bitrix24 в очередь (внутри транзакции записи)"""
+    cur.execute(
+        """
+        INSERT INTO crm_outbox
+        (department, record_id, phone, category_name, comment, responsible_id, chat_id, message_id)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """,
+        crm_job_row(department, record_id, phone, comment, crm_job)
+    )
+
+def enqueue_crm_jobs(cur, rows):
+    """Поставить пачку задач одним INSERT (строки - из crm_job_row)"""
+    execute_values(
+        cur,
+        """
+        INSERT INTO crm_outbox
+        (department, record_id, phone, category_name, comment, responsible_id, chat_id, message_id)
+        VALUES %s
+        """,
+        rows,
+        page_size=len(rows)
+    )
+
+# Аренда задач очереди департамента, параметры: (аренда в секундах, департамент, лимит)
+CLAIM_CRM_JOBS_SQL = """
+    UPDATE crm_outbox
+    SET status = 'processing',
+        attempts = attempts + 1,
+        updated_at = NOW(),
+        next_attempt_at = NOW() + make_interval(secs => %s)
+    WHERE id IN (
+        SELECT id FROM crm_outbox
+        WHERE department = %s
+        AND status IN ('pending', 'processing')
+        AND next_attempt_at <= NOW()
+        ORDER BY next_attempt_at, id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING *
+"""
+
+@observe_db
+def claim_crm_jobs(department, limit=CRM_OUTBOX_BATCH_SIZE):
+    """
+    Забрать готовые к выполнению задачи из очереди.
+    Задача арендуется на CRM_OUTBOX_LEASE_SECONDS: если воркер упадёт,
+    она снова станет доступна после истечения аренды.
+    """
+    if not get_table_prefix(department):
+        return []
 
     conn = get_conn()
     try:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                f"SELECT * FROM {prefix}_categories WHERE code = %s",
-                (code.upper(),)
-            )
-            return cur.fetchone()
+            cur.execute(CLAIM_CRM_JOBS_SQL, (CRM_OUTBOX_LEASE_SECONDS, department, limit))
+            jobs = cur.fetchall()
+            conn.commit()
+            return jobs
+    except Exception:
+        conn.rollback()
+        log.exception("claim_crm_jobs error")
+        return []
     finally:
         release_conn(conn)
 
-def add_category(code, name, department):
-    """Добавить категорию"""
-    global categories_cache, categories_cache_time
-    prefix = get_table_prefix(department)
-    if not prefix:
+def update_crm_job_sql(department, job_id, fields):
+    """Запрос и параметры обновления задачи очереди (retry_in - пауза до повтора, сек)"""
+    fields = dict(fields)
+    delay = fields.pop('retry_in', None)
+    assignments = [f"{column} = %s" for column in fields]
+    values = list(fields.values())
+    assignments.append("updated_at = NOW()")
+    if delay is not None:
+        assignments.append("next_attempt_at = NOW() + make_interval(secs => %s)")
+        values.append(delay)
+    sql = f"UPDATE crm_outbox SET {', '.join(assignments)} WHERE id = %s AND department = %s"
+    return sql, (*values, job_id, department)
+
+@observe_db
+def update_crm_job(job_id, department, **fields):
+    """Обновить поля задачи очереди (status, contact_id, task_id, ...)"""
+    if not get_table_prefix(department) or not fields:
         return False
 
+    if 'status' in fields:
+        CRM_JOBS.labels(fields['status']).inc()
+
     conn = get_conn()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                INSERT INTO {prefix}_categories (code, name)
-                VALUES (%s, %s)
-                ON CONFLICT (code) DO UPDATE
-                SET name = EXCLUDED.name
-                """,
-                (code.upper(), name)
-            )
+            cur.execute(*update_crm_job_sql(department, job_id, fields))
             conn.commit()
-            # Сбрасываем кэш для этого департамента
-            if department in categories_cache:
-                del categories_cache[department]
-            if department in categories_cache_time:
-                del categories_cache_time[department]
-            return True
-    except Exception as e:
+            return cur.rowcount > 0
+    except Exception:
         conn.rollback()
-        print(f"❌ add_category error: {e}")
+        log.exception("update_crm_job error")
         return False
     finally:
         release_conn(conn)
 
-def delete_category(code, department):
-    """Удалить категорию"""
-    global categories_cache, categories_cache_time
-    prefix = get_table_prefix(department)
-    if not prefix:
-        return False
+class CrmJobStateError(RuntimeError):
+    """
+    Шаг задачи очереди выполнен в CRM, но не записан в БД и после повторов.
+    Задача помечается как stuck: повтор создал бы дубль в CRM.
+    """
+
+def crm_state_retry_delay(attempt):
+    """Пауза перед повторной записью шага задачи (attempt - с единицы)"""
+    return CRM_OUTBOX_STATE_BACKOFF_SECONDS * 2 ** (attempt - 1)
+
+def write_crm_job_state(job_id, department, **fields):
+    """update_crm_job с повторами: шаг уже выполнен в CRM, терять его нельзя"""
+    for attempt in range(1, CRM_OUTBOX_STATE_ATTEMPTS + 1):
+        if update_crm_job(job_id, department, **fields):
+            return True
+        if attempt < CRM_OUTBOX_STATE_ATTEMPTS:
+            time.sleep(crm_state_retry_delay(attempt))
+    return False
+
+def save_crm_job_step(job_id, department, **fields):
+    """write_crm_job_state, который при неудаче останавливает обработку задачи"""
+    if not write_crm_job_state(job_id, department, **fields):
+        raise CrmJobStateError(f"crm job {job_id}: не сохранено {fields}")
+
+@observe_db
+def get_crm_job_by_record(record_id, department):
+    """Получить состояние синхронизации записи с Bitrix24"""
+    if not get_table_prefix(department):
+        return None
 
     conn = get_conn()
     try:
-        with conn.cursor() as cur:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(
-                f"DELETE FROM {prefix}_categories WHERE code = %s",
-                (code.upper(),)
+                """
+                SELECT * FROM crm_outbox
+                WHERE department = %s
+                AND record_id = %s
+                ORDER BY id DESC
+                LIMIT 1
+                """,
+                (department, record_id)
             )
-            conn.commit()
-            # Сбрасываем кэш для этого департамента
-            if department in categories_cache:
-                del categories_cache[department]
-            if department in categories_cache_time:
-                del categories_cache_time[department]
-            return cur.rowcount > 0
-    except Exception as e:
-        conn.rollback()
-        print(f"❌ delete_category error: {e}")
-        return False
+            return cur.fetchone()
     finally:
         release_conn(conn)
 
-def get_all_categories(department, use_cache=True):
-    """Получить все категории (с кэшированием на 60 секунд)"""
-    global categories_cache, categories_cache_time
-    prefix = get_table_prefix(department)
-    if not prefix:
-        return []
+# ==========================================
+# DATABASE FUNCTIONS - КОПИЯ КОНТАКТОВ BITRIX24
+# ==========================================
 
-    # Проверяем кэш для этого департамента
-    if use_cache and department in categories_cache and department in categories_cache_time:
-        if (datetime.now() - categories_cache_time[department]).total_seconds() < 60:
-            return categories_cache[department]
+def mirror_contact_to_bitrix(row):
+    """Строка копии -> контакт в формате ответа crm.contact.list"""
+    return {
+        "ID": str(row['id']),
+        "NAME": row['name'] or "",
+        "LAST_NAME": row['last_name'] or "",
+        "PHONE": [{"VALUE": phone} for phone in row['phones'] or []],
+    }
 
-    # Загружаем из БД
+MIRROR_CONTACT_BY_PHONE_SQL = """
+    SELECT c.id, c.name, c.last_name,
+           ARRAY(SELECT phone FROM bitrix_contact_phones WHERE contact_id = c.id) AS phones
+    FROM bitrix_contact_phones p
+    JOIN bitrix_contacts c ON c.id = p.contact_id
+    WHERE p.phone = %s
+    ORDER BY c.id
+    LIMIT 1
+"""
+
+@observe_db
+def get_mirror_contact_by_phone(phone):
+    """Найти контакт в локальной копии по нормализованному телефону"""
     conn = get_conn()
     try:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                f"SELECT * FROM {prefix}_categories ORDER BY code"
-            )
-            result = cur.fetchall()
-
-            # Обновляем кэш для этого департамента
-            if use_cache:
-                categories_cache[department] = result
-                categories_cache_time[department] = datetime.now()
-
-            return result
+            cur.execute(MIRROR_CONTACT_BY_PHONE_SQL, (contact_phone_key(phone),))
+            row = cur.fetchone()
+            return mirror_contact_to_bitrix(row) if row else None
     finally:
         release_conn(conn)
 
-# ==========================================
-# DATABASE FUNCTIONS - RECORDS
-# ==========================================
+def contact_phone_key(phone):
+    """
+    Ключ телефона в копии контактов: +380XXXXXXXXX для номеров с 380 или
+    ведущим 0, остальные - только цифры. Не normalize_phone: его lstrip("380")
+    сводит, например, +33 6... к +380 6..., и копия находила бы чужой контакт,
+    которого точное совпадение crm.contact.list не вернёт.
+    """
+    digits = clean_phone(phone)
+    if digits.startswith("0"):
+        digits = "38" + digits
+    return "+" + digits
 
-def add_record(employee_telegram_id, category_code, phone, comment, department):
-    """Добавить запись"""
-    prefix = get_table_prefix(department)
-    if not prefix:
-        return None
+def contact_phones(contact):
+    """Ключи телефонов контакта Bitrix24 для копии"""
+    phones = set()
+    for ph in contact.get("PHONE") or []:
+        value = ph.get("VALUE", "")
+        if clean_phone(value):
+            phones.add(contact_phone_key(value))
+    return phones
+
+@observe_db
+def store_mirror_contacts(contacts, synced_at=None):
+    """Сохранить/обновить пачку контактов из Bitrix24 в локальной копии"""
+    if not contacts:
+        return 0
+
+    rows = {}
+    for c in contacts:
+        rows[int(c["ID"])] = (
+            int(c["ID"]),
+            c.get("NAME") or None,
+            c.get("LAST_NAME") or None,
+            c.get("DATE_MODIFY") or None,
+            synced_at,
+        )
+    phone_rows = [
+        (phone, int(c["ID"]))
+        for c in contacts
+        for phone in contact_phones(c)
+    ]
 
     conn = get_conn()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                f"""
-                INSERT INTO {prefix}_records
-                (employee_telegram_id, category_code, phone, comment)
-                VALUES (%s, %s, %s, %s)
-                RETURNING id
+            execute_values(
+                cur,
+                """
+                INSERT INTO bitrix_contacts (id, name, last_name, date_modify, synced_at)
+                VALUES %s
+                ON CONFLICT (id) DO UPDATE
+                SET name = EXCLUDED.name,
+                    last_name = EXCLUDED.last_name,
+                    date_modify = COALESCE(EXCLUDED.date_modify, bitrix_contacts.date_modify),
+                    synced_at = EXCLUDED.synced_at
                 """,
-                (employee_telegram_id, category_code.upper(), phone, comment)
+                list(rows.values()),
+                template="(%s, %s, %s, %s::timestamptz, COALESCE(%s::timestamptz, NOW()))"
+            )
+            cur.execute(
+                "DELETE FROM bitrix_contact_phones WHERE contact_id = ANY(%s)",
+                (list(rows),)
             )
+            if phone_rows:
+                execute_values(
+                    cur,
+                    """
+                    INSERT INTO bitrix_contact_phones (phone, contact_id)
+                    VALUES %s
+                    ON CONFLICT DO NOTHING
+                    """,
+                    phone_rows
+                )
             conn.commit()
-            record_id = cur.fetchone()[0]
-            return record_id
-    except Exception as e:
+            return len(rows)
+    except Exception:
         conn.rollback()
-        print(f"❌ add_record error: {e}")
-        return None
+        raise
     finally:
         release_conn(conn)
 
-def check_duplicate_record(employee_telegram_id, category_code, phone, department, minutes=5):
-    """Проверить наличие дубликата за последние N минут"""
-    prefix = get_table_prefix(department)
-    if not prefix:
-        return False
-
+@observe_db
+def delete_stale_mirror_contacts(synced_before):
+    """Удалить контакты, не встретившиеся при полной сверке (удалены в CRM)"""
     conn = get_conn()
     try:
         with conn.cursor() as cur:
             cur.execute(
-                f"""
-                SELECT COUNT(*) FROM {prefix}_records
-                WHERE employee_telegram_id = %s
-                AND category_code = %s
-                AND phone = %s
-                AND timestamp > NOW() - make_interval(mins => %s)
-                """,
-                (employee_telegram_id, category_code.upper(), phone, minutes)
+                "DELETE FROM bitrix_contacts WHERE synced_at < %s",
+                (synced_before,)
             )
-            count = cur.fetchone()[0]
-            return count > 0
+            conn.commit()
+            return cur.rowcount
+    except Exception:
+        conn.rollback()
+        raise
     finally:
         release_conn(conn)
 
-def get_records_by_phone(phone, days, department):
-    """Получить записи по телефону за последние N дней"""
-    prefix = get_table_prefix(department)
-    if not prefix:
-        return []
-
+def get_db_now():
+    """Текущее время сервера БД (метка начала полной сверки)"""
     conn = get_conn()
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                f"""
-                SELECT
-                    r.timestamp,
-                    e.name as employee_name,
-                    c.name as category_name,
-                    r.category_code,
-                    r.phone,
-                    r.comment
-                FROM {prefix}_records r
-                LEFT JOIN {prefix}_employees e ON r.employee_telegram_id = e.telegram_id
-                LEFT JOIN {prefix}_categories c ON r.category_code = c.code
-                WHERE r.phone = %s
-                AND r.timestamp > NOW() - make_interval(days => %s)
-                ORDER BY r.timestamp DESC
-                """,
-                (phone, days)
-            )
-            return cur.fetchall()
+        with conn.cursor() as cur:
+            cur.execute("SELECT NOW()")
+            return cur.fetchone()[0]
     finally:
         release_conn(conn)
 
-def get_team_stats(days, department):
-    """Получить статистику по команде за последние N дней"""
-    prefix = get_table_prefix(department)
-    if not prefix:
-        return {'total': 0, 'by_employee': [], 'by_category': []}
-
+def get_sync_state(name):
+    """Прочитать значение состояния синхронизации"""
     conn = get_conn()
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # Общая статистика
-            cur.execute(
-                f"""
-                SELECT COUNT(*) as total_records
-                FROM {prefix}_records
-                WHERE timestamp > NOW() - make_interval(days => %s)
-                """,
-                (days,)
-            )
-            total = cur.fetchone()['total_records']
-
-            # По сотрудникам
-            cur.execute(
-                f"""
-                SELECT
-                    e.name,
-                    COUNT(*) as count
-                FROM {prefix}_records r
-                LEFT JOIN {prefix}_employees e ON r.employee_telegram_id = e.telegram_id
-                WHERE r.timestamp > NOW() - make_interval(days => %s)
-                GROUP BY e.name
-                ORDER BY count DESC
-                """,
-                (days,)
-            )
-            by_employee = cur.fetchall()
-
-            # По категориям
-            cur.execute(
-                f"""
-                SELECT
-                    c.name,
-                    c.code,
-                    COUNT(*) as count
-                FROM {prefix}_records r
-                LEFT JOIN {prefix}_categories c ON r.category_code = c.code
-                WHERE r.timestamp > NOW() - make_interval(days => %s)
-                GROUP BY c.name, c.code
-                ORDER BY count DESC
-                """,
-                (days,)
-            )
-            by_category = cur.fetchall()
-
-            return {
-                'total': total,
-                'by_employee': by_employee,
-                'by_category': by_category
-            }
+        with conn.cursor() as cur:
+            cur.execute("SELECT value FROM bitrix_sync_state WHERE name = %s", (name,))
+            row = cur.fetchone()
+            return row[0] if row else None
     finally:
         release_conn(conn)
 
-def get_all_records(days, department):
-    """Получить все записи за последние N дней (для экспорта)"""
-    prefix = get_table_prefix(department)
-    if not prefix:
-        return []
-
+def set_sync_state(name, value):
+    """Сохранить значение состояния синхронизации"""
     conn = get_conn()
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        with conn.cursor() as cur:
             cur.execute(
-                f"""
-                SELECT
-                    r.timestamp,
-                    e.name as employee_name,
-                    c.name as category_name,
-                    r.category_code,
-                    r.phone,
-                    r.comment
-                FROM {prefix}_records r
-                LEFT JOIN {prefix}_employees e ON r.employee_telegram_id = e.telegram_id
-                LEFT JOIN {prefix}_categories c ON r.category_code = c.code
-                WHERE r.timestamp > NOW() - make_interval(days => %s)
-                ORDER BY r.timestamp DESC
+                """
+                INSERT INTO bitrix_sync_state (name, value, updated_at)
+                VALUES (%s, %s, NOW())
+                ON CONFLICT (name) DO UPDATE
+                SET value = EXCLUDED.value, updated_at = NOW()
                 """,
-                (days,)
+                (name, value)
             )
-            return cur.fetchall()
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
     finally:
         release_conn(conn)
 
@@ -477,6 +2791,68 @@ def normalize_phone(phone: str) -> str:
         digits = "380" + digits.lstrip("380")
     return "+" + digits
 
+class TTLCache:
+    """
+    Потокобезопасный LRU-кэш с ограничением размера и временем жизни записей.
+    Значение None тоже кэшируется (негативный кэш) - со своим TTL.
+    """
+
+    MISSING = object()
+
+    def __init__(self, maxsize, ttl, negative_ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Вернуть значение или TTLCache.MISSING"""
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return self.MISSING
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl if value is not None else self.negative_ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Размер и счётчики попаданий"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0
+            }
+
 def is_admin(user_id: int) -> bool:
     """Проверка, является ли пользователь админом"""
     return user_id == ADMIN_TELEGRAM_ID
@@ -485,111 +2861,701 @@ def is_admin(user_id: int) -> bool:
 # ПАРСИНГ СООБЩЕНИЙ
 # ==========================================
 
-def parse_message(text: str, department):
+class CategoryMatcher:
     """
-    Парсинг рабочего сообщения формата:
-    CODE +380XXXXXXXXX | Комментарий
+    Скомпилированный парсер рабочих сообщений для набора кодов категорий.
+    Строится один раз на набор кодов, а не на каждое сообщение.
+    """
+
+    def __init__(self, codes):
+        self.codes = frozenset(code.upper() for code in codes)
+        # Длинные коды первыми, чтобы CL10 не перехватывался CL1
+        ordered = sorted(self.codes, key=lambda c: (-len(c), c))
+        codes_pattern = '|'.join(re.escape(code) for code in ordered)
+        self.pattern = re.compile(
+            rf"({codes_pattern})\s+(\+?[0-9]+)\s*\|\s*(.+)",
+            re.IGNORECASE | re.S
+        )
+        # Первые символы кодов - быстрый отсев обычной переписки
+        self.first_chars = frozenset(
+            ch for code in self.codes for ch in (code[0].upper(), code[0].lower())
+        )
+        self.source = None
+
+    def match(self, text: str):
+        """Вернуть (code, phone, comment) или None"""
+        text = text.strip()
+        if not text or text[0] not in self.first_chars or '|' not in text:
+            return None
+        match = self.pattern.match(text)
+        if not match:
+            return None
+        return match.groups()
+
+def get_category_matcher(department):
+    """
+    Получить парсер для департамента.
+    Пересобирается только если изменился набор кодов (add/delete_category
+    или истечение кэша категорий с новыми кодами).
     """
-    # Получаем все доступные коды из БД для данного департамента
     categories = get_all_categories(department)
     if not categories:
-        print(f"❌ Нет категорий в базе данных для {department}")
         return None
 
-    # Создаём список кодов для regex
-    codes = [cat['code'] for cat in categories]
-    codes_pattern = '|'.join(codes)
+    matcher = category_matchers.get(department)
+    if matcher is not None and matcher.source is categories:
+        return matcher
+
+    codes = frozenset(cat['code'].upper() for cat in categories)
+    if matcher is None or matcher.codes != codes:
+        matcher = CategoryMatcher(codes)
+    matcher.source = categories
+    category_matchers[department] = matcher
+    return matcher
 
-    # Динамический regex на основе кодов из БД
-    pattern = rf"^({codes_pattern})\s+(\+?[0-9]+)\s*\|\s*(.+)"
-    match = re.match(pattern, text.strip(), re.IGNORECASE | re.S)
+def parse_message(text: str, department):
+    """
+    Парсинг рабочего сообщения формата:
+    CODE +380XXXXXXXXX | Комментарий
+    """
+    # Парсер по кодам из БД для данного департамента
+    matcher = get_category_matcher(department)
+    if matcher is None:
+        log.warning("Нет категорий в базе данных", extra={"department": department})
+        return None
 
-    if not match:
-        print(f"❌ Сообщение не соответствует формату: {text}")
+    groups = matcher.match(text)
+    if not groups:
+        log.info(
+            "Сообщение не соответствует формату",
+            extra={"department": department, "length": len(text), "sample": LOG_SAMPLE_REJECTED}
+        )
         return None
-    code, phone, comment = match.groups()
+    code, phone, comment = groups
     phone = normalize_phone(phone)
-    print(f"✅ Распознано: code={code}, phone={phone}, comment={comment[:50]}")
+    log.debug("Распознано", extra={"department": department, "code": code, "phone": phone})
     return code.upper(), phone, comment.strip()
 
 # ==========================================
 # BITRIX24 ИНТЕГРАЦИЯ
 # ==========================================
 
-def find_contact_by_phone(phone):
-    """Поиск контакта в Bitrix24 по телефону"""
+class BitrixClient:
+    """
+    Общий HTTP-клиент Bitrix24: keep-alive пул соединений, таймауты
+    и ограниченные повторы. Повторяются только GET-запросы (и ошибки
+    установки соединения, когда запрос ещё не ушёл), чтобы не создать
+    задачу дважды.
+    """
+
+    def __init__(self, contact_url, task_url, connect_timeout=BITRIX_CONNECT_TIMEOUT,
+                 read_timeout=BITRIX_READ_TIMEOUT, pool_size=BITRIX_POOL_SIZE,
+                 retries=BITRIX_RETRIES):
+        self.contact_url = contact_url
+        self.task_url = task_url
+        self.timeout = (connect_timeout, read_timeout)
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=0.3,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def method_url(self, method):
+        """URL метода по вебхукам: task.* и batch - от BITRIX_TASK_URL, остальное - от BITRIX_CONTACT_URL"""
+        if method.startswith("task.") or method == "batch":
+            return self.task_url.replace("task.item.add", method)
+        return self.contact_url.replace("crm.contact.list", method)
+
+    def get(self, method, params=None):
+        with BITRIX_ERRORS.labels(method).count_exceptions(), BITRIX_LATENCY.labels(method).time():
+            return self.session.get(self.method_url(method), params=params, timeout=self.timeout)
+
+    def post(self, method, payload=None):
+        with BITRIX_ERRORS.labels(method).count_exceptions(), BITRIX_LATENCY.labels(method).time():
+            return self.session.post(self.method_url(method), json=payload, timeout=self.timeout)
+
+bitrix = BitrixClient(BITRIX_CONTACT_URL, BITRIX_TASK_URL)
+
+contact_cache = TTLCache(CONTACT_CACHE_SIZE, CONTACT_CACHE_TTL, CONTACT_CACHE_NEGATIVE_TTL)
+
+def fetch_contact_by_phone(phone, use_cache=True, trust_negative=True):
+    """
+    Поиск контакта в Bitrix24 по телефону (через кэш по нормализованному номеру).
+    В отличие от find_contact_by_phone пробрасывает ошибки сети/API,
+    чтобы очередь могла отличить «не найден» от «CRM недоступна».
+    trust_negative=False - закэшированное «не найден» перепроверяется в CRM.
+    """
     norm_phone_full = normalize_phone(phone)
+    if use_cache:
+        cached = contact_cache.get(norm_phone_full)
+        if cached is not TTLCache.MISSING and (cached is not None or trust_negative):
+            return cached
+
+    contact = None
+    if CONTACTS_SYNC_ENABLED:
+        # Сначала локальная копия: индексный запрос вместо похода в CRM
+        try:
+            contact = get_mirror_contact_by_phone(norm_phone_full)
+        except Exception:
+            log.warning("contacts mirror error", exc_info=True)
+
+    if contact is None:
+        contact = request_contact_by_phone(norm_phone_full)
+        if contact and CONTACTS_SYNC_ENABLED:
+            try:
+                store_mirror_contacts([contact])
+            except Exception:
+                log.warning("contacts mirror error", exc_info=True)
+
+    # При ошибке CRM выше будет исключение - кэшируется только ответ CRM
+    contact_cache.set(norm_phone_full, contact)
+    return contact
+
+def request_contact_by_phone(norm_phone_full):
+    """Запрос crm.contact.list по телефону"""
+    r = bitrix.get("crm.contact.list", params=contact_by_phone_params(norm_phone_full))
+    r.raise_for_status()
+    return match_contact_by_phone(r.json().get("result", []), norm_phone_full)
+
+def contact_by_phone_params(norm_phone_full):
+    """Параметры crm.contact.list для поиска по телефону"""
+    return [
+        ("filter[PHONE]", norm_phone_full),
+        *(("select[]", field) for field in ("ID", "NAME", "LAST_NAME", "PHONE", "DATE_MODIFY"))
+    ]
+
+def match_contact_by_phone(contacts, norm_phone_full):
+    """Контакт из ответа crm.contact.list с точным совпадением телефона"""
+    for c in contacts or []:
+        for ph in c.get("PHONE", []):
+            if clean_phone(ph.get("VALUE", "")) == clean_phone(norm_phone_full):
+                return c
+    return None
+
+def find_contact_by_phone(phone, use_cache=True):
+    """Поиск контакта в Bitrix24 по телефону"""
     try:
-        r = requests.get(
-            BITRIX_CONTACT_URL,
-            params={
-                "filter[PHONE]": norm_phone_full,
-                "select[]": ["ID", "NAME", "LAST_NAME", "PHONE"]
-            }
-        )
-        r.raise_for_status()
-        data = r.json()
+        return fetch_contact_by_phone(phone, use_cache=use_cache)
     except Exception as e:
-        print(f"❌ Bitrix24 error: {e}")
+        log.warning("Bitrix24 error", extra={"error": str(e)})
+        return None
+
+def task_payload(contact_id, category, comment, responsible_id):
+    """Параметры task.item.add"""
+    now = datetime.now()
+    deadline = now + timedelta(days=1)
+    deadline_str = deadline.strftime("%Y-%m-%dT%H:%M:%S+03:00")
+
+    return {
+        "fields": {
+            "TITLE": f"Запис: {category}",
+            "DESCRIPTION": comment,
+            "RESPONSIBLE_ID": responsible_id,
+            "DEADLINE": deadline_str,
+            "UF_CRM_TASK": [f"C_{contact_id}"],
+        },
+        "notify": True
+    }
+
+def timeline_payload(contact_id, category, comment, responsible_id):
+    """Параметры crm.timeline.comment.add"""
+    return {
+        "fields": {
+            "ENTITY_ID": contact_id,
+            "ENTITY_TYPE": "contact",
+            "COMMENT": f"📌 {category}: {comment}",
+            "AUTHOR_ID": responsible_id
+        }
+    }
+
+def add_task(contact_id, category, comment, responsible_id):
+    """Создание задачи в Bitrix24, возвращает ID задачи"""
+    payload = task_payload(contact_id, category, comment, responsible_id)
+    task_res = bitrix.post("task.item.add", payload)
+    if task_res.status_code != 200:
+        raise RuntimeError(f"task.item.add: {task_res.text}")
+
+    task_id = task_res.json().get("result")
+    if not task_id:
+        raise RuntimeError("task.item.add: no task id")
+    return task_id
+
+def add_timeline_comment(contact_id, category, comment, responsible_id):
+    """Добавить комментарий в таймлайн контакта, возвращает ID комментария"""
+    payload = timeline_payload(contact_id, category, comment, responsible_id)
+    res = bitrix.post("crm.timeline.comment.add", payload)
+    res.raise_for_status()
+    return res.json().get("result")
+
+def complete_task(task_id):
+    """Завершить задачу"""
+    res = bitrix.post("task.complete", {"id": task_id})
+    res.raise_for_status()
+
+def bitrix_query(params, prefix=None):
+    """Сериализация параметров в формат http_build_query (как ждёт REST Bitrix24)"""
+    if isinstance(params, dict):
+        items = params.items()
+    else:
+        items = enumerate(params)
+
+    parts = []
+    for key, value in items:
+        name = f"{prefix}[{key}]" if prefix is not None else str(key)
+        if isinstance(value, (dict, list, tuple)):
+            parts.append(bitrix_query(value, name))
+        else:
+            if isinstance(value, bool):
+                value = int(value)
+            elif value is None:
+                value = ""
+            parts.append(f"{quote(name, safe='[]')}={quote(str(value), safe='')}")
+    return "&".join(part for part in parts if part)
+
+def call_bitrix_batch(commands, halt=False):
+    """
+    Выполнить несколько методов одним запросом batch.
+    commands: {имя: (метод, параметры)}, в параметрах можно ссылаться
+    на результаты предыдущих команд: $result[имя].
+    Возвращает (results, errors) - словари по именам команд.
+    """
+    res = bitrix.post("batch", batch_payload(commands, halt))
+    res.raise_for_status()
+    return batch_results(res.json())
+
+def batch_payload(commands, halt=False):
+    """Тело запроса batch"""
+    cmd = {
+        name: f"{method}?{bitrix_query(params)}"
+        for name, (method, params) in commands.items()
+    }
+    return {"halt": int(halt), "cmd": cmd}
+
+def batch_results(data):
+    """Ответ batch -> (results, errors)"""
+    if "error" in data:
+        raise RuntimeError(f"batch: {data.get('error_description') or data['error']}")
+
+    batch = data.get("result") or {}
+    # Пустые словари PHP отдаёт как []
+    results = batch.get("result") or {}
+    errors = batch.get("result_error") or {}
+    return results, errors
+
+def create_task_batch(contact_id, category, comment, responsible_id, task_id=None, with_comment=True):
+    """
+    Задача + комментарий в таймлайн + завершение одним запросом batch.
+    task_id - уже созданная задача (при повторе создаётся только недостающее).
+    Возвращает (results, errors) с ключами task/comment/complete.
+    """
+    return call_bitrix_batch(task_batch_commands(contact_id, category, comment, responsible_id, task_id, with_comment))
+
+def task_batch_commands(contact_id, category, comment, responsible_id, task_id=None, with_comment=True):
+    """Команды batch для create_task_batch"""
+    commands = {}
+    if not task_id:
+        commands["task"] = ("task.item.add", task_payload(contact_id, category, comment, responsible_id))
+    if with_comment:
+        commands["comment"] = ("crm.timeline.comment.add", timeline_payload(contact_id, category, comment, responsible_id))
+    commands["complete"] = ("task.complete", {"id": task_id or "$result[task]"})
+    return commands
+
+def format_batch_errors(errors):
+    """Текст ошибок batch для логов и last_error"""
+    parts = []
+    for name, error in errors.items():
+        if isinstance(error, dict):
+            error = error.get("error_description") or error.get("error")
+        parts.append(f"{name}: {error}")
+    return "; ".join(parts)
+
+def create_task(contact_id, category, comment, responsible_id):
+    """Создание задачи в Bitrix24 (задача + комментарий + завершение)"""
+    if BITRIX_BATCH_ENABLED:
+        results, errors = create_task_batch(contact_id, category, comment, responsible_id)
+        if errors:
+            raise RuntimeError(format_batch_errors(errors))
+        return results.get("task")
+
+    task_id = add_task(contact_id, category, comment, responsible_id)
+    add_timeline_comment(contact_id, category, comment, responsible_id)
+    complete_task(task_id)
+    return task_id
+
+# ==========================================
+# СИНХРОНИЗАЦИЯ КОНТАКТОВ BITRIX24
+# ==========================================
+
+contacts_sync_stop = threading.Event()
+
+def list_bitrix_contacts(filter_=None, order=None, start=0):
+    """Одна страница crm.contact.list (до 50 контактов)"""
+    params = {
+        "select": ["ID", "NAME", "LAST_NAME", "PHONE", "DATE_MODIFY"],
+        "order": order or {"ID": "ASC"},
+        "start": start,
+    }
+    if filter_:
+        params["filter"] = filter_
+    r = bitrix.get("crm.contact.list", params=bitrix_query(params))
+    r.raise_for_status()
+    data = r.json()
+    if "error" in data:
+        raise RuntimeError(f"crm.contact.list: {data.get('error_description') or data['error']}")
+    return data
+
+def parse_bitrix_datetime(value):
+    """DATE_MODIFY из Bitrix24 (ISO 8601 со смещением) -> datetime"""
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
         return None
 
-    result = data.get("result", [])
-    if not result:
-        return None
+def sync_bitrix_contacts(full=False):
+    """
+    Синхронизировать локальную копию контактов.
+    Полная сверка проходит по всем контактам (и удаляет исчезнувшие в CRM),
+    инкрементальная - только по изменённым с последнего DATE_MODIFY.
+    Возвращает количество сохранённых контактов.
+    """
+    last_modify = None if full else get_sync_state('contacts_date_modify')
+    full = full or last_modify is None
+    started_at = get_db_now()
+
+    if full:
+        filter_ = None
+        order = {"ID": "ASC"}
+    else:
+        # >= : контакты, изменённые в ту же секунду, не теряются (upsert идемпотентен)
+        filter_ = {">=DATE_MODIFY": last_modify}
+        order = {"DATE_MODIFY": "ASC", "ID": "ASC"}
+
+    max_modify = last_modify
+    max_modify_dt = parse_bitrix_datetime(last_modify)
+    stored = 0
+    start = 0
+    while True:
+        data = list_bitrix_contacts(filter_, order, start)
+        contacts = data.get("result") or []
+        stored += store_mirror_contacts(contacts)
+
+        for c in contacts:
+            modify_dt = parse_bitrix_datetime(c.get("DATE_MODIFY"))
+            if modify_dt and (max_modify_dt is None or modify_dt > max_modify_dt):
+                max_modify_dt = modify_dt
+                max_modify = c["DATE_MODIFY"]
+
+        if "next" not in data:
+            break
+        start = data["next"]
+        time.sleep(CONTACTS_SYNC_PAGE_DELAY)
+
+    if full:
+        removed = delete_stale_mirror_contacts(started_at)
+        set_sync_state('contacts_full_sync_at', started_at.isoformat())
+        log.info("Полная синхронизация контактов", extra={"stored": stored, "removed": removed})
+    if max_modify:
+        set_sync_state('contacts_date_modify', max_modify)
+    return stored
+
+def full_contacts_sync_due():
+    """Пора ли делать полную сверку контактов"""
+    last_full = parse_bitrix_datetime(get_sync_state('contacts_full_sync_at'))
+    if last_full is None:
+        return True
+    return datetime.now(timezone.utc) - last_full > timedelta(hours=CONTACTS_FULL_SYNC_HOURS)
+
+def run_contacts_sync_worker():
+    """Фоновый цикл синхронизации контактов"""
+    while not contacts_sync_stop.is_set():
+        try:
+            sync_bitrix_contacts(full=full_contacts_sync_due())
+        except Exception:
+            log.exception("contacts sync error")
+        contacts_sync_stop.wait(CONTACTS_SYNC_INTERVAL)
+
+def start_contacts_sync_worker():
+    """Запустить синхронизацию контактов в фоновом потоке"""
+    contacts_sync_stop.clear()
+    worker = threading.Thread(
+        target=run_contacts_sync_worker,
+        name="contacts-sync",
+        daemon=True
+    )
+    worker.start()
+    return worker
+
+# ==========================================
+# ОЧЕРЕДЬ ЗАДАЧ BITRIX24 (OUTBOX)
+# ==========================================
+
+crm_outbox_stop = threading.Event()
+
+def crm_retry_delay(attempts):
+    """Экспоненциальная пауза перед следующей попыткой"""
+    delay = CRM_OUTBOX_BACKOFF_SECONDS * (2 ** max(attempts - 1, 0))
+    return min(delay, CRM_OUTBOX_BACKOFF_MAX_SECONDS)
+
+def notify_crm_result(bot, job, text):
+    """Сообщить в чат о результате синхронизации записи"""
+    if bot is None or not job.get('chat_id'):
+        return
+    try:
+        bot.send_message(
+            chat_id=job['chat_id'],
+            text=text,
+            reply_to_message_id=job.get('message_id'),
+            allow_sending_without_reply=True
+        )
+    except Exception as e:
+        log.warning("notify_crm_result error", extra={"error": str(e)})
+
+def process_crm_job(job, department, bot=None):
+    """
+    Выполнить задачу очереди: найти контакт, создать задачу, комментарий и
+    завершить задачу (в режиме batch - одним запросом). Каждый шаг фиксируется
+    в БД, поэтому повтор после ошибки продолжает с того места, где остановился,
+    без дублей в CRM.
+    """
+    job_id = job['id']
+    contact_id = job['contact_id']
+    task_id = job['task_id']
+
+    if not contact_id:
+        # «Не найден» из кэша перепроверяем: статус no_contact окончательный
+        contact = fetch_contact_by_phone(job['phone'], trust_negative=False)
+        if not contact:
+            save_crm_job_step(job_id, department, status='no_contact', last_error=None)
+            notify_crm_result(bot, job, f"❗ Клієнт {job['phone']} не знайдений у CRM (запис #{job['record_id']})")
+            return
+        contact_id = int(contact['ID'])
+        save_crm_job_step(job_id, department, contact_id=contact_id)
+
+    if BITRIX_BATCH_ENABLED:
+        results, errors = create_task_batch(
+            contact_id, job['category_name'], job['comment'], job['responsible_id'],
+            task_id=task_id,
+            with_comment=not job['comment_id']
+        )
+        done = {}
+        if not task_id and results.get('task'):
+            done['task_id'] = results['task']
+        if not job['comment_id'] and results.get('comment'):
+            done['comment_id'] = results['comment']
+        if done:
+            save_crm_job_step(job_id, department, **done)
+        if errors:
+            raise RuntimeError(format_batch_errors(errors))
+        save_crm_job_step(job_id, department, status='done', last_error=None)
+        return
+
+    if not task_id:
+        task_id = add_task(contact_id, job['category_name'], job['comment'], job['responsible_id'])
+        save_crm_job_step(job_id, department, task_id=task_id)
+
+    if not job['comment_id']:
+        comment_id = add_timeline_comment(contact_id, job['category_name'], job['comment'], job['responsible_id'])
+        save_crm_job_step(job_id, department, comment_id=comment_id)
 
-    for c in result:
-        for ph in c.get("PHONE", []):
-            if clean_phone(ph.get("VALUE", "")) == clean_phone(norm_phone_full):
-                return c
-    return None
+    complete_task(task_id)
+    save_crm_job_step(job_id, department, status='done', last_error=None)
 
-def create_task(contact_id, category, comment, responsible_id):
-    """Создание задачи в Bitrix24"""
-    now = datetime.now()
-    deadline = now + timedelta(days=1)
-    deadline_str = deadline.strftime("%Y-%m-%dT%H:%M:%S+03:00")
+def handle_crm_job_error(job, department, error, bot=None):
+    """Запланировать повтор или окончательно пометить задачу как failed"""
+    log.warning(
+        "CRM job error",
+        extra={"job_id": job['id'], "department": department, "attempt": job['attempts'], "error": str(error)}
+    )
+    if job['attempts'] >= CRM_OUTBOX_MAX_ATTEMPTS:
+        update_crm_job(job['id'], department, status='failed', last_error=str(error))
+        notify_crm_result(bot, job, f"⚠ Не вдалося створити задачу у Bitrix для запису #{job['record_id']}")
+    else:
+        update_crm_job(
+            job['id'], department,
+            status='pending',
+            last_error=str(error),
+            retry_in=crm_retry_delay(job['attempts'])
+        )
 
-    payload = {
-        "fields": {
-            "TITLE": f"Запис: {category}",
-            "DESCRIPTION": comment,
-            "RESPONSIBLE_ID": responsible_id,
-            "DEADLINE": deadline_str,
-            "UF_CRM_TASK": [f"C_{contact_id}"],
-        },
-        "notify": True
-    }
+def mark_crm_job_stuck(job, department, error, bot=None):
+    """
+    Окончательно остановить задачу, шаг которой не удалось записать: stuck
+    claim_crm_jobs не забирает, /crm_status показывает - проверить в CRM вручную.
+    """
+    log.error("CRM job state not saved", extra={"job_id": job['id'], "department": department, "error": str(error)})
+    if write_crm_job_state(job['id'], department, status='stuck', last_error=str(error)):
+        notify_crm_result(bot, job, f"🛑 Запис #{job['record_id']}: стан задачі CRM не збережено, перевірте Bitrix вручну")
+    else:
+        log.error("CRM job not marked stuck", extra={"job_id": job['id'], "department": department})
 
-    task_res = requests.post(BITRIX_TASK_URL, json=payload)
-    if task_res.status_code != 200:
-        print(f"❌ create_task: {task_res.text}")
-        return
+def drain_crm_outbox(bot=None):
+    """Обработать по одной пачке задач каждого департамента, вернуть их количество"""
+    processed = 0
+    for department in DEPARTMENTS:
+        for job in claim_crm_jobs(department):
+            try:
+                process_crm_job(job, department, bot)
+            except CrmJobStateError as e:
+                mark_crm_job_stuck(job, department, e, bot)
+            except Exception as e:
+                handle_crm_job_error(job, department, e, bot)
+            processed += 1
+    return processed
+
+def run_crm_outbox_worker(bot=None):
+    """Фоновый цикл обработки очереди"""
+    while not crm_outbox_stop.is_set():
+        try:
+            processed = drain_crm_outbox(bot)
+        except Exception:
+            log.exception("CRM outbox worker error")
+            processed = 0
+        if not processed:
+            crm_outbox_stop.wait(CRM_OUTBOX_POLL_SECONDS)
+
+def start_crm_outbox_worker(bot=None):
+    """Запустить воркер очереди в фоновом потоке"""
+    crm_outbox_stop.clear()
+    worker = threading.Thread(
+        target=run_crm_outbox_worker,
+        args=(bot,),
+        name="crm-outbox",
+        daemon=True
+    )
+    worker.start()
+    return worker
 
-    task_id = task_res.json().get("result")
-    if not task_id:
-        print("❌ create_task: no task id")
-        return
+# ==========================================
+# КЭШ /info
+# ==========================================
 
-    # Добавить комментарий в таймлайн
-    comment_url = BITRIX_CONTACT_URL.replace("crm.contact.list", "crm.timeline.comment.add")
-    timeline_payload = {
-        "fields": {
-            "ENTITY_ID": contact_id,
-            "ENTITY_TYPE": "contact",
-            "COMMENT": f"📌 {category}: {comment}",
-            "AUTHOR_ID": responsible_id
-        }
+class InfoCache:
+    """
+    Сводки /info по ключу (департамент, телефон, дни) с LRU и TTL.
+    invalidate() сбрасывает сводки телефона за все периоды. Сводка, запрос
+    которой начался до сброса, в кэш не кладётся - иначе она вернула бы
+    состояние без только что сохранённой записи.
+    """
+
+    MISSING = TTLCache.MISSING
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()       # (департамент, телефон, дни) -> (истекает, сводка)
+        self._periods = {}               # (департамент, телефон) -> {дни, ...}
+        self._invalidated = OrderedDict()  # (департамент, телефон) -> время сброса, за TTL
+        self._cleared_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, department, phone, days):
+        """Вернуть сводку или InfoCache.MISSING"""
+        key = (department, phone, days)
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, summary = item
+                if expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return summary
+                self._drop(key)
+            self.misses += 1
+            return self.MISSING
+
+    def set(self, department, phone, days, summary, started_at):
+        """Положить сводку, посчитанную запросом, начатым в started_at (monotonic)"""
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            # Старше TTL - отметка о сбросе могла быть уже вычищена
+            if started_at <= self._cleared_at or started_at < now - self.ttl:
+                return
+            if self._invalidated.get((department, phone), 0.0) >= started_at:
+                return
+            key = (department, phone, days)
+            self._data[key] = (now + self.ttl, summary)
+            self._data.move_to_end(key)
+            self._periods.setdefault((department, phone), set()).add(days)
+            while len(self._data) > self.maxsize:
+                self._drop(next(iter(self._data)))
+
+    def invalidate(self, department, phone):
+        """Сбросить сводки телефона (после сохранения записи по нему)"""
+        now = time.monotonic()
+        with self._lock:
+            for days in self._periods.pop((department, phone), ()):
+                self._data.pop((department, phone, days), None)
+            self._invalidated[(department, phone)] = now
+            self._invalidated.move_to_end((department, phone))
+            while self._invalidated and next(iter(self._invalidated.values())) < now - self.ttl:
+                self._invalidated.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._periods.clear()
+            self._invalidated.clear()
+            self._cleared_at = time.monotonic()
+
+    def _drop(self, key):
+        """Удалить сводку (под self._lock)"""
+        del self._data[key]
+        periods = self._periods.get(key[:2])
+        if periods is not None:
+            periods.discard(key[2])
+            if not periods:
+                del self._periods[key[:2]]
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+info_cache = InfoCache(INFO_CACHE_SIZE, INFO_CACHE_TTL) if INFO_CACHE_SIZE > 0 and INFO_CACHE_TTL > 0 else None
+
+def summarize_phone_records(records):
+    """Сводка /info: всего, по сотрудникам, по категориям и 5 последних записей"""
+    by_emp = Counter(r['employee_name'] for r in records if r['employee_name'])
+    by_cat = Counter((r['category_code'], r['category_name']) for r in records if r['category_code'])
+    return {
+        'total': len(records),
+        'by_employee': by_emp.most_common(),
+        'by_category': by_cat.most_common(),
+        'latest': records[:5]
     }
-    requests.post(comment_url, json=timeline_payload)
 
-    # Завершить задачу
-    complete_url = BITRIX_TASK_URL.replace("task.item.add", "task.complete")
-    requests.post(complete_url, json={"id": task_id})
+def get_phone_summary(phone, days, department):
+    """Сводка по телефону за N дней (через кэш /info)"""
+    if info_cache is None:
+        return summarize_phone_records(get_records_by_phone(phone, days, department))
+
+    summary = info_cache.get(department, phone, days)
+    if summary is not InfoCache.MISSING:
+        return summary
+    started_at = time.monotonic()
+    summary = summarize_phone_records(get_records_by_phone(phone, days, department))
+    info_cache.set(department, phone, days, summary, started_at)
+    return summary
 
 # ==========================================
 # КОМАНДА: /info
 # ==========================================
 
+@observe_handler
 def handle_info_command(update: Update, context: CallbackContext):
     """
     Команда: /info +380XXXXXXXXX, N
@@ -598,7 +3564,7 @@ def handle_info_command(update: Update, context: CallbackContext):
     # Определяем департамент по chat_id
     department = get_department_by_chat_id(update.message.chat_id)
     if not department:
-        update.message.reply_text("❌ Ця команда доступна тільки в чатах підтримки або досудебки")
+        update.message.reply_text(department_chat_only_text())
         return
 
     text = update.message.text.strip()
@@ -611,8 +3577,8 @@ def handle_info_command(update: Update, context: CallbackContext):
     phone = normalize_phone(phone_raw)
     days = int(days_str)
 
-    # Получаем данные из БД для данного департамента
-    records = get_records_by_phone(phone, days, department)
+    # Сводка по записям департамента (повторный запрос - из кэша)
+    summary = get_phone_summary(phone, days, department)
 
     # ФИО клиента из CRM
     contact = find_contact_by_phone(phone)
@@ -622,17 +3588,11 @@ def handle_info_command(update: Update, context: CallbackContext):
         if not client_name:
             client_name = None
 
-    total = len(records)
+    total = summary['total']
     since_dt = datetime.now() - timedelta(days=days)
-
-    # Агрегация по сотрудникам
-    by_emp = Counter(r['employee_name'] for r in records if r['employee_name'])
-
-    # Агрегация по категориям
-    by_cat = Counter((r['category_code'], r['category_name']) for r in records if r['category_code'])
-
-    # Последние 5 записей
-    latest = records[:5]
+    by_emp = summary['by_employee']
+    by_cat = summary['by_category']
+    latest = summary['latest']
 
     # Формирование ответа
     header_name = client_name if client_name else "Не знайдений у CRM"
@@ -645,7 +3605,7 @@ def handle_info_command(update: Update, context: CallbackContext):
 
     # За співробітниками
     if by_emp:
-        emp_lines = "\n".join([f"   — {emp}: {cnt}" for emp, cnt in by_emp.most_common()])
+        emp_lines = "\n".join([f"   — {emp}: {cnt}" for emp, cnt in by_emp])
         emp_block = f"👤 За співробітниками:\n{emp_lines}"
     else:
         emp_block = "👤 За співробітниками: —"
@@ -653,7 +3613,7 @@ def handle_info_command(update: Update, context: CallbackContext):
     # По категоріях
     if by_cat:
         cat_lines = []
-        for (code, name), cnt in by_cat.most_common():
+        for (code, name), cnt in by_cat:
             cat_lines.append(f"   — {name} ({code}): {cnt}")
         cat_block = "🧩 По категоріях:\n" + "\n".join(cat_lines)
     else:
@@ -681,6 +3641,7 @@ def handle_info_command(update: Update, context: CallbackContext):
 # КОМАНДА: /team_stats
 # ==========================================
 
+@observe_handler
 def handle_team_stats_command(update: Update, context: CallbackContext):
     """
     Команда: /team_stats N
@@ -689,7 +3650,7 @@ def handle_team_stats_command(update: Update, context: CallbackContext):
     # Определяем департамент по chat_id
     department = get_department_by_chat_id(update.message.chat_id)
     if not department:
-        update.message.reply_text("❌ Ця команда доступна тільки в чатах підтримки або досудебки")
+        update.message.reply_text(department_chat_only_text())
         return
 
     text = update.message.text.strip()
@@ -738,83 +3699,380 @@ def handle_team_stats_command(update: Update, context: CallbackContext):
 # КОМАНДА: /export
 # ==========================================
 
+@observe_handler
 def handle_export_command(update: Update, context: CallbackContext):
     """
-    Команда: /export N
-    Экспорт всех записей за последние N дней в Excel
+    Команда: /export N [xlsx|csv|parquet]
+    Экспорт всех записей за последние N дней в Excel (по умолчанию),
+    CSV (gzip) или Parquet
     """
     # Определяем департамент по chat_id
     department = get_department_by_chat_id(update.message.chat_id)
     if not department:
-        update.message.reply_text("❌ Ця команда доступна тільки в чатах підтримки або досудебки")
+        update.message.reply_text(department_chat_only_text())
         return
 
     text = update.message.text.strip()
-    m = re.match(r"^/export\s+(\d+)$", text, re.IGNORECASE)
+    m = re.match(r"^/export\s+(\d+)(?:\s+(xlsx|csv|parquet))?$", text, re.IGNORECASE)
     if not m:
-        update.message.reply_text("Формат: /export N\nНапр.: /export 30")
+        update.message.reply_text(
+            "Формат: /export N [xlsx|csv|parquet]\nНапр.: /export 30 або /export 365 csv"
+        )
         return
 
     days = int(m.group(1))
-    records = get_all_records(days, department)
+    export_format = (m.group(2) or "xlsx").lower()
+
+    if export_format == "csv":
+        export_csv(update, days, department)
+    elif export_format == "parquet":
+        export_parquet(update, days, department)
+    else:
+        export_xlsx(update, days, department)
+
+def export_xlsx(update, days, department):
+    """Экспорт в Excel"""
+    records = iter_all_records(days, department)
+    try:
+        first = next(records, None)
+        if first is None:
+            update.message.reply_text("❌ Немає записів за цей період")
+            return
+
+        # Excel пишется во временный файл, а не в память
+        with tempfile.TemporaryFile(suffix=".xlsx") as tmp:
+            count = write_records_xlsx(chain([first], records), tmp)
+            tmp.seek(0)
+
+            filename = f"export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+            update.message.reply_document(
+                document=tmp,
+                filename=filename,
+                caption=f"📊 Експорт за останні {days} дн. ({count} записів)"
+            )
+    finally:
+        records.close()
+
+def export_csv(update, days, department):
+    """Экспорт в CSV через COPY, сжатый gzip и нарезанный на части"""
+    writer = ChunkedGzipWriter(EXPORT_MAX_FILE_BYTES)
+    try:
+        copy_records_csv(days, department, writer)
+        writer.close()
+        if not writer.rows:
+            update.message.reply_text("❌ Немає записів за цей період")
+            return
+        send_export_parts(update, writer.parts, "csv.gz", days, writer.rows)
+    finally:
+        writer.discard()
 
-    if not records:
-        update.message.reply_text("❌ Немає записів за цей період")
+def export_parquet(update, days, department):
+    """Экспорт в Parquet (нужен pyarrow)"""
+    if pq is None:
+        update.message.reply_text("❌ Parquet недоступний: на сервері не встановлено pyarrow")
         return
 
-    # Создаем Excel
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Звернення"
-
-    # Заголовки
-    ws.append(["Дата/час", "Співробітник", "Категорія", "Телефон клієнта", "Коментар"])
-
-    # Данные
-    for r in records:
-        ws.append([
-            r['timestamp'].strftime("%Y-%m-%d %H:%M:%S"),
-            r['employee_name'] or "—",
-            f"{r['category_name']} ({r['category_code']})" if r['category_name'] else r['category_code'],
-            r['phone'],
-            r['comment'] or ""
-        ])
-
-    # Автоширина колонок
-    for col in ws.columns:
-        max_length = 0
-        column = col[0].column_letter
-        for cell in col:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(cell.value)
-            except:
-                pass
-        adjusted_width = min(max_length + 2, 50)
-        ws.column_dimensions[column].width = adjusted_width
-
-    # Сохраняем в BytesIO
-    buffer = BytesIO()
-    wb.save(buffer)
-    buffer.seek(0)
+    records = iter_all_records(days, department, raw=True)
+    parts = []
+    try:
+        count = write_records_parquet(records, parts, EXPORT_MAX_FILE_BYTES)
+        if not count:
+            update.message.reply_text("❌ Немає записів за цей період")
+            return
+        send_export_parts(update, parts, "parquet", days, count)
+    finally:
+        records.close()
+        for part in parts:
+            part.close()
+
+def send_export_parts(update, parts, extension, days, count):
+    """Отправить файлы выгрузки (несколько частей, если не влезло в лимит Telegram)"""
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    for idx, part in enumerate(parts, 1):
+        part.seek(0)
+        if len(parts) > 1:
+            filename = f"export_{stamp}_part{idx}.{extension}"
+            caption = f"📊 Експорт за останні {days} дн. ({count} записів), частина {idx}/{len(parts)}"
+        else:
+            filename = f"export_{stamp}.{extension}"
+            caption = f"📊 Експорт за останні {days} дн. ({count} записів)"
+        update.message.reply_document(document=part, filename=filename, caption=caption)
+
+class ChunkedGzipWriter:
+    """
+    Приёмник для copy_expert: пишет CSV в gzip-части не больше max_bytes.
+    COPY TO STDOUT отдаёт ровно одну строку таблицы на каждый write()
+    (libpq возвращает данные построчно), поэтому части режутся только
+    по границам строк, а заголовок повторяется в начале каждой части.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.parts = []
+        self.header = None
+        self.rows = 0
+        self._gz = None
+        self._part_rows = 0
+        self._open_part()
+
+    def _open_part(self):
+        raw = tempfile.TemporaryFile(suffix=".csv.gz")
+        self.parts.append(raw)
+        self._gz = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6)
+        self._part_rows = 0
+        if self.header is not None:
+            self._gz.write(self.header)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        if self.header is None:
+            self.header = data
+        else:
+            # Размер сжатого файла + несжатый размер строки - оценка с запасом
+            if self._part_rows and self.parts[-1].tell() + len(data) > self.max_bytes:
+                self._gz.close()
+                self._open_part()
+            self.rows += 1
+            self._part_rows += 1
+        self._gz.write(data)
+        return len(data)
+
+    def close(self):
+        """Дописать gzip-трейлер последней части"""
+        if self._gz is not None:
+            self._gz.close()
+            self._gz = None
+
+    def discard(self):
+        """Закрыть и удалить временные файлы"""
+        self.close()
+        for part in self.parts:
+            part.close()
+
+def write_records_parquet(records, parts, max_bytes):
+    """
+    Записать выгрузку в Parquet (zstd) row group'ами по EXPORT_PARQUET_ROW_GROUP строк.
+    Когда файл достигает max_bytes, начинается новая часть; открытые временные
+    файлы добавляются в parts. Возвращает количество записей.
+    """
+    schema = pa.schema([
+        ('timestamp', pa.timestamp('us', tz='UTC')),
+        ('employee_telegram_id', pa.int64()),
+        ('employee_name', pa.string()),
+        ('category_code', pa.string()),
+        ('category_name', pa.string()),
+        ('phone', pa.string()),
+        ('comment', pa.string()),
+    ])
+    count = 0
+    writer = None
+    group_bytes = 0  # Размер последней row group - оценка следующей
+    try:
+        while True:
+            batch = list(islice(records, EXPORT_PARQUET_ROW_GROUP))
+            if not batch:
+                break
+            if writer is None or parts[-1].tell() + group_bytes > max_bytes:
+                if writer is not None:
+                    writer.close()
+                parts.append(tempfile.TemporaryFile(suffix=".parquet"))
+                writer = pq.ParquetWriter(parts[-1], schema, compression='zstd')
+            columns = list(zip(*batch))
+            size_before = parts[-1].tell()
+            writer.write_table(pa.table(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                schema=schema
+            ))
+            group_bytes = parts[-1].tell() - size_before
+            count += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+EXPORT_HEADERS = ["Дата/час", "Співробітник", "Категорія", "Телефон клієнта", "Коментар"]
+
+def export_row(record):
+    """Строка выгрузки из кортежа iter_all_records"""
+    timestamp, employee_name, category_name, category_code, phone, comment = record
+    return [
+        timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+        employee_name or "—",
+        f"{category_name} ({category_code})" if category_name else category_code,
+        phone,
+        comment or ""
+    ]
+
+def write_records_xlsx(records, fileobj):
+    """
+    Записать выгрузку в xlsx за один проход (write-only режим openpyxl).
+    Ширина колонок задаётся до первой строки, поэтому считается по заголовку
+    и первым EXPORT_WIDTH_SAMPLE строкам, которые придерживаются в буфере.
+    Возвращает количество записей.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Звернення")
+
+    widths = [len(h) for h in EXPORT_HEADERS]
+    sample = []
+    count = 0
+
+    def flush_sample():
+        # Автоширина колонок
+        for idx, width in enumerate(widths, 1):
+            ws.column_dimensions[get_column_letter(idx)].width = min(width + 2, 50)
+        ws.append(EXPORT_HEADERS)
+        for row in sample:
+            ws.append(row)
+        sample.clear()
+
+    for record in records:
+        row = export_row(record)
+        count += 1
+        if count <= EXPORT_WIDTH_SAMPLE:
+            for idx, value in enumerate(row):
+                widths[idx] = max(widths[idx], len(str(value)))
+            sample.append(row)
+            if count == EXPORT_WIDTH_SAMPLE:
+                flush_sample()
+        else:
+            ws.append(row)
+
+    if count < EXPORT_WIDTH_SAMPLE:
+        flush_sample()
+
+    wb.save(fileobj)
+    return count
+
+# ==========================================
+# КОМАНДА: /crm_status
+# ==========================================
+
+CRM_STATUS_LABELS = {
+    'pending': "⏳ в черзі",
+    'processing': "🔄 обробляється",
+    'done': "✅ задачу створено",
+    'no_contact': "❗ клієнт не знайдений у CRM",
+    'failed': "⚠ помилка",
+    'stuck': "🛑 зупинено: крок виконано в CRM, але не збережено — перевірте вручну",
+}
+
+@observe_handler
+def handle_crm_status_command(update: Update, context: CallbackContext):
+    """
+    Команда: /crm_status ID
+    Показывает состояние синхронизации записи с Bitrix24
+    """
+    # Определяем департамент по chat_id
+    department = get_department_by_chat_id(update.message.chat_id)
+    if not department:
+        update.message.reply_text(department_chat_only_text())
+        return
+
+    text = update.message.text.strip()
+    m = re.match(r"^/crm_status\s+#?(\d+)$", text, re.IGNORECASE)
+    if not m:
+        update.message.reply_text("Формат: /crm_status ID\nНапр.: /crm_status 1024")
+        return
+
+    record_id = int(m.group(1))
+    job = get_crm_job_by_record(record_id, department)
+    if not job:
+        update.message.reply_text(f"❌ Для запису #{record_id} немає задачі у черзі CRM")
+        return
+
+    lines = [
+        f"🔗 Запис #{record_id}: {CRM_STATUS_LABELS.get(job['status'], job['status'])}",
+        f"• Спроб: {job['attempts']}",
+        f"• Оновлено: {job['updated_at'].strftime('%Y-%m-%d %H:%M:%S')}",
+    ]
+    if job['task_id']:
+        lines.append(f"• Задача Bitrix: {job['task_id']}")
+    if job['status'] == 'pending' and job['attempts']:
+        lines.append(f"• Наступна спроба: {job['next_attempt_at'].strftime('%Y-%m-%d %H:%M:%S')}")
+    if job['last_error']:
+        lines.append(f"• Остання помилка: {job['last_error'][:200]}")
+
+    update.message.reply_text("\n".join(lines))
+
+# ==========================================
+# КОМАНДА: /crm_cache (только для админа)
+# ==========================================
+
+@observe_handler
+def handle_crm_cache_command(update: Update, context: CallbackContext):
+    """
+    Команда: /crm_cache [clear]
+    Статистика кэша контактов Bitrix24, clear - очистить кэш
+    """
+    if not is_admin(update.message.from_user.id):
+        update.message.reply_text("❌ У вас немає доступу до цієї команди")
+        return
+
+    text = update.message.text.strip()
+    m = re.match(r"^/crm_cache(?:\s+(clear))?$", text, re.IGNORECASE)
+    if not m:
+        update.message.reply_text("Формат: /crm_cache [clear]")
+        return
+
+    if m.group(1):
+        contact_cache.clear()
+        update.message.reply_text("✅ Кеш контактів CRM очищено")
+        return
+
+    stats = contact_cache.stats()
+    update.message.reply_text(
+        f"🗂 Кеш контактів CRM:\n"
+        f"• Записів: {stats['size']} / {contact_cache.maxsize}\n"
+        f"• Влучань: {stats['hits']}\n"
+        f"• Промахів: {stats['misses']}\n"
+        f"• Hit ratio: {stats['hit_ratio']:.1%}"
+    )
 
-    filename = f"export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-    update.message.reply_document(
-        document=buffer,
-        filename=filename,
-        caption=f"📊 Експорт за останні {days} дн. ({len(records)} записів)"
+# ==========================================
+# КОМАНДА: /db_pool
+# ==========================================
+
+@observe_handler
+def handle_db_pool_command(update: Update, context: CallbackContext):
+    """
+    Команда: /db_pool
+    Статистика пула соединений PostgreSQL
+    """
+    if not is_admin(update.message.from_user.id):
+        update.message.reply_text("❌ У вас немає доступу до цієї команди")
+        return
+
+    stats = init_pool().stats()
+    text = (
+        f"🗄 Пул з'єднань БД:\n"
+        f"• Зайнято: {stats['in_use']} / {stats['size']}\n"
+        f"• Видач: {stats['checkouts']}\n"
+        f"• Очікування: сер. {stats['wait_avg'] * 1000:.1f} мс, макс. {stats['wait_max'] * 1000:.1f} мс\n"
+        f"• Таймаутів: {stats['timeouts']}"
     )
+    if record_writer is not None:
+        stats = record_writer.stats()
+        text += (
+            f"\n\n📦 Групова фіксація записів:\n"
+            f"• Пачок: {stats['batches']}, записів: {stats['records']}\n"
+            f"• Середня пачка: {stats['avg_batch']:.1f}, найбільша: {stats['largest']}\n"
+            f"• Пачок, записаних поштучно після помилки: {stats['fallbacks']}"
+        )
+    update.message.reply_text(text)
 
 # ==========================================
 # КОМАНДА: /list_employees
 # ==========================================
 
+@observe_handler
 def handle_list_employees_command(update: Update, context: CallbackContext):
     """Список всех сотрудников"""
     # Определяем департамент по chat_id
     department = get_department_by_chat_id(update.message.chat_id)
     if not department:
-        update.message.reply_text("❌ Ця команда доступна тільки в чатах підтримки або досудебки")
+        update.message.reply_text(department_chat_only_text())
         return
 
     employees = get_all_employees(department)
@@ -837,12 +4095,13 @@ def handle_list_employees_command(update: Update, context: CallbackContext):
 # КОМАНДА: /list_categories
 # ==========================================
 
+@observe_handler
 def handle_list_categories_command(update: Update, context: CallbackContext):
     """Список всех категорий"""
     # Определяем департамент по chat_id
     department = get_department_by_chat_id(update.message.chat_id)
     if not department:
-        update.message.reply_text("❌ Ця команда доступна тільки в чатах підтримки або досудебки")
+        update.message.reply_text(department_chat_only_text())
         return
 
     categories = get_all_categories(department, use_cache=False)
@@ -870,7 +4129,7 @@ def start_add_employee(update: Update, context: CallbackContext):
     # Определяем департамент по chat_id
     department = get_department_by_chat_id(update.message.chat_id)
     if not department:
-        update.message.reply_text("❌ Ця команда доступна тільки в чатах підтримки або досудебки")
+        update.message.reply_text(department_chat_only_text())
         return ConversationHandler.END
 
     # Сохраняем департамент в контексте
@@ -934,6 +4193,7 @@ def cancel_conversation(update: Update, context: CallbackContext):
 # КОМАНДА: /delete_employee (только для админа)
 # ==========================================
 
+@observe_handler
 def handle_delete_employee_command(update: Update, context: CallbackContext):
     """
     Команда: /delete_employee TELEGRAM_ID
@@ -946,7 +4206,7 @@ def handle_delete_employee_command(update: Update, context: CallbackContext):
     # Определяем департамент по chat_id
     department = get_department_by_chat_id(update.message.chat_id)
     if not department:
-        update.message.reply_text("❌ Ця команда доступна тільки в чатах підтримки або досудебки")
+        update.message.reply_text(department_chat_only_text())
         return
 
     text = update.message.text.strip()
@@ -976,7 +4236,7 @@ def start_add_category(update: Update, context: CallbackContext):
     # Определяем департамент по chat_id
     department = get_department_by_chat_id(update.message.chat_id)
     if not department:
-        update.message.reply_text("❌ Ця команда доступна тільки в чатах підтримки або досудебки")
+        update.message.reply_text(department_chat_only_text())
         return ConversationHandler.END
 
     # Сохраняем департамент в контексте
@@ -1016,6 +4276,7 @@ def add_category_name(update: Update, context: CallbackContext):
 # КОМАНДА: /delete_category (только для админа)
 # ==========================================
 
+@observe_handler
 def handle_delete_category_command(update: Update, context: CallbackContext):
     """
     Команда: /delete_category CODE
@@ -1028,7 +4289,7 @@ def handle_delete_category_command(update: Update, context: CallbackContext):
     # Определяем департамент по chat_id
     department = get_department_by_chat_id(update.message.chat_id)
     if not department:
-        update.message.reply_text("❌ Ця команда доступна тільки в чатах підтримки або досудебки")
+        update.message.reply_text(department_chat_only_text())
         return
 
     text = update.message.text.strip()
@@ -1049,19 +4310,16 @@ def handle_delete_category_command(update: Update, context: CallbackContext):
 # ОБРАБОТКА РАБОЧИХ СООБЩЕНИЙ
 # ==========================================
 
+@observe_handler
 def handle_message(update: Update, context: CallbackContext):
     """Обработка рабочих сообщений"""
-    # Логируем для отладки
-    print(f"📨 Получено сообщение из чата: {update.message.chat_id}", flush=True)
-    print(f"📝 Текст сообщения: {update.message.text}", flush=True)
-
     # Определяем департамент по chat_id
     department = get_department_by_chat_id(update.message.chat_id)
     if not department:
-        print(f"⚠️ Сообщение из неразрешенного чата, игнорируем")
+        log.debug("Сообщение из неразрешенного чата, игнорируем", extra={"chat_id": update.message.chat_id})
         return
 
-    print(f"🏢 Департамент: {department}", flush=True)
+    log.debug("Получено сообщение", extra={"chat_id": update.message.chat_id, "department": department})
 
     # Если это ответ на подтверждение дубликата
     if context.user_data.get('awaiting_duplicate_confirmation'):
@@ -1070,60 +4328,81 @@ def handle_message(update: Update, context: CallbackContext):
 
     parsed = parse_message(update.message.text, department)
     if not parsed:
+        MESSAGES.labels(department, "rejected").inc()
         return
 
     code, phone, comment = parsed
 
-    # Проверка категории
-    category = get_category_by_code(code, department)
-    if not category:
-        update.message.reply_text(f"❌ Невідома категорія: {code}")
-        return
-
-    category_name = category['name']
+    # Ключ занимаем до проверки дубликата: сохранение такого же предыдущего
+    # сообщения идёт в другом потоке и может зафиксироваться и освободить ключ
+    # в любой момент - проверка после резервирования его уже увидит
+    reservation = (department, update.message.from_user.id, code.upper(), phone)
+    reserved = reserve_record(reservation)
+    handed_off = False
+    try:
+        # Категория и сотрудник - из кэша справочников, дубликат - из окна в памяти
+        message_context = resolve_message_context(
+            update.message.from_user.id,
+            code,
+            phone,
+            department,
+            minutes=5
+        )
 
-    # Проверка сотрудника
-    employee = get_employee_by_telegram_id(update.message.from_user.id, department)
-    if employee:
-        employee_name = employee['name']
-        responsible_id = employee['bitrix_id']
-    else:
-        employee_name = update.message.from_user.full_name
-        responsible_id = RESPONSIBLE_ID
+        # Проверка категории
+        category = message_context['category']
+        if not category:
+            MESSAGES.labels(department, "unknown_category").inc()
+            update.message.reply_text(f"❌ Невідома категорія: {code}")
+            return
+
+        category_name = category['name']
+
+        # Проверка сотрудника
+        employee = message_context['employee']
+        if employee:
+            employee_name = employee['name']
+            responsible_id = employee['bitrix_id']
+        else:
+            employee_name = update.message.from_user.full_name
+            responsible_id = RESPONSIBLE_ID
+
+        # Проверка дубликата: в БД / окне или среди ещё не сохранённых записей
+        if not reserved or message_context['is_duplicate']:
+            MESSAGES.labels(department, "duplicate").inc()
+            # Сохраняем данные для подтверждения
+            context.user_data['awaiting_duplicate_confirmation'] = True
+            context.user_data['pending_record'] = {
+                'code': code,
+                'phone': phone,
+                'comment': comment,
+                'category_name': category_name,
+                'employee_name': employee_name,
+                'responsible_id': responsible_id,
+                'department': department
+            }
 
-    # Проверка дубликата
-    is_duplicate = check_duplicate_record(
-        update.message.from_user.id,
-        code,
-        phone,
-        department,
-        minutes=5
-    )
+            keyboard = [['Так', 'Ні']]
+            reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
+            update.message.reply_text(
+                f"⚠️ Ви вже записували категорію {code} для цього клієнта менше 5 хв тому.\n"
+                f"Продовжити?",
+                reply_markup=reply_markup
+            )
+            return
 
-    if is_duplicate:
-        # Сохраняем данные для подтверждения
-        context.user_data['awaiting_duplicate_confirmation'] = True
-        context.user_data['pending_record'] = {
-            'code': code,
-            'phone': phone,
-            'comment': comment,
-            'category_name': category_name,
-            'employee_name': employee_name,
-            'responsible_id': responsible_id,
-            'department': department
-        }
+        MESSAGES.labels(department, "parsed").inc()
 
-        keyboard = [['Так', 'Ні']]
-        reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=True, resize_keyboard=True)
-        update.message.reply_text(
-            f"⚠️ Ви вже записували категорію {code} для цього клієнта менше 5 хв тому.\n"
-            f"Продовжити?",
-            reply_markup=reply_markup
+        # Запись в БД; ключ освободит save_record
+        context.dispatcher.run_async(
+            save_record,
+            update, context, code, phone, comment, category_name, employee_name, responsible_id, department,
+            update=update, reservation=reservation
         )
-        return
-
-    # Запись в БД
-    save_record(update, context, code, phone, comment, category_name, employee_name, responsible_id, department)
+        handed_off = True
+    finally:
+        if reserved and not handed_off:
+            release_record(reservation)
 
 def handle_duplicate_confirmation(update: Update, context: CallbackContext):
     """Обработка подтверждения дубликата"""
@@ -1133,7 +4412,8 @@ def handle_duplicate_confirmation(update: Update, context: CallbackContext):
     if response in ['так', 'yes', 'y', 'да']:
         pending = context.user_data.get('pending_record')
         if pending:
-            save_record(
+            context.dispatcher.run_async(
+                save_record,
                 update, context,
                 pending['code'],
                 pending['phone'],
@@ -1141,64 +4421,767 @@ def handle_duplicate_confirmation(update: Update, context: CallbackContext):
                 pending['category_name'],
                 pending['employee_name'],
                 pending['responsible_id'],
-                pending['department']
+                pending['department'],
+                update=update
             )
     else:
         update.message.reply_text("❌ Операція скасована", reply_markup=ReplyKeyboardRemove())
 
     context.user_data.clear()
 
-def save_record(update, context, code, phone, comment, category_name, employee_name, responsible_id, department):
-    """Сохранить запись в БД и Bitrix"""
-    # Контакт в Bitrix
-    contact = find_contact_by_phone(phone)
-    if not contact:
-        update.message.reply_text("❗ Клієнт не знайдений у CRM", reply_markup=ReplyKeyboardRemove())
-        return
-
-    # Задача в Bitrix
-    create_task(contact["ID"], category_name, comment, responsible_id)
-
-    # Запись в БД для данного департамента
-    record_id = add_record(
-        update.message.from_user.id,
-        code,
-        phone,
-        comment,
-        department
-    )
+@observe_handler
+def save_record(update, context, code, phone, comment, category_name, employee_name, responsible_id, department,
+                reservation=None):
+    """
+    Сохранить запись в БД и поставить задачу для Bitrix в очередь.
+    Запросы в CRM выполняет фоновый воркер, сотрудник получает ответ сразу.
+    reservation - ключ из reserve_record, освобождается после записи
+    (при успехе запись уже видна проверке дубликатов).
+    """
+    try:
+        record_id = add_record(
+            update.message.from_user.id,
+            code,
+            phone,
+            comment,
+            department,
+            crm_job={
+                'category_name': category_name,
+                'responsible_id': responsible_id,
+                'chat_id': update.message.chat_id,
+                'message_id': update.message.message_id
+            }
+        )
+    finally:
+        if reservation is not None:
+            release_record(reservation)
 
     if record_id:
-        client_name = f"{contact.get('NAME', '')} {contact.get('LAST_NAME', '')}".strip()
         update.message.reply_text(
-            f"✅ Запис збережено: {category_name} – {client_name}",
+            f"✅ Запис #{record_id} збережено: {category_name} – {phone}",
             reply_markup=ReplyKeyboardRemove()
         )
     else:
         update.message.reply_text(
-            "⚠ Помилка збереження у БД, але задача у Bitrix створена",
+            "⚠ Помилка збереження у БД",
             reply_markup=ReplyKeyboardRemove()
         )
 
 # ==========================================
-# MAIN
+# БЭКФИЛЛ ИЗ ЭКСПОРТА TELEGRAM
 # ==========================================
+# История чата из экспорта Telegram Desktop (result.json) разбирается тем же
+# parse_message, строки загружаются COPY во временную таблицу и одним
+# INSERT ... SELECT переносятся в records без уже сохранённых.
+# Задачи в Bitrix24 для истории не создаются.
+
+BACKFILL_PROGRESS_EVERY = 10000
+
+def export_message_text(message):
+    """Текст сообщения экспорта: строка или список строк и фрагментов {'type', 'text'}"""
+    text = message.get("text") or ""
+    if isinstance(text, list):
+        text = "".join(part if isinstance(part, str) else part.get("text", "") for part in text)
+    return text
+
+def export_message_time(message, tz):
+    """Время сообщения в UTC: date_unixtime, в старых экспортах - локальное date"""
+    if message.get("date_unixtime"):
+        return datetime.fromtimestamp(int(message["date_unixtime"]), timezone.utc)
+    return datetime.fromisoformat(message["date"]).replace(tzinfo=tz).astimezone(timezone.utc)
+
+def export_sender_id(message):
+    """Telegram ID отправителя из from_id вида 'user123456' (None для каналов)"""
+    from_id = message.get("from_id") or ""
+    if from_id.startswith("user") and from_id[4:].isdigit():
+        return int(from_id[4:])
+    return None
 
-def main():
-    # Инициализация пула соединений
-    init_pool()
+def export_department(export):
+    """Департамент по id чата экспорта (id супергруппы там без префикса -100)"""
+    chat_id = export.get("id")
+    if not isinstance(chat_id, int):
+        return None
+    for candidate in (chat_id, -abs(chat_id), int(f"-100{abs(chat_id)}")):
+        department = get_department_by_chat_id(candidate)
+        if department:
+            return department
+    return None
+
+def parse_export_messages(messages, department, tz, stats, progress=None):
+    """
+    Строки (employee_telegram_id, category_code, phone, comment, timestamp)
+    из сообщений экспорта. Как и в handle_message, сообщения с неизвестной
+    категорией пропускаются, а отправители не из списка сотрудников
+    сохраняются под своим Telegram ID. Счётчики пропусков - в stats,
+    progress(n) вызывается каждые BACKFILL_PROGRESS_EVERY сообщений.
+    """
+    reference = get_reference_data(department, use_cache=False)
+    rows = []
+    for n, message in enumerate(messages, 1):
+        if progress is not None and n % BACKFILL_PROGRESS_EVERY == 0:
+            progress(n)
+
+        sender = export_sender_id(message)
+        text = export_message_text(message)
+        if message.get("type") != "message" or sender is None or not text or text.startswith("/"):
+            stats["skipped"] += 1
+            continue
+
+        parsed = parse_message(text, department)
+        if not parsed:
+            stats["rejected"] += 1
+            continue
+        code, phone, comment = parsed
+        if code not in reference.categories_by_code:
+            stats["unknown_category"] += 1
+            continue
+        if sender not in reference.employees_by_id:
+            stats["unknown_employee"] += 1
+
+        rows.append((sender, code, phone, comment, export_message_time(message, tz)))
+    return rows
+
+@observe_db
+def copy_backfill_records(rows, department, match_seconds=60):
+    """
+    Загрузить строки COPY во временную таблицу и перенести в records
+    те, для которых ещё нет записи того же сотрудника, категории и телефона
+    в пределах match_seconds после времени сообщения (живая запись
+    сохраняется чуть позже отправки, повторный импорт совпадает точно).
+    Возвращает число добавленных записей.
+    """
+    prefix = get_table_prefix(department)
+    if not prefix or not rows:
+        return 0
+
+    buffer = io.StringIO()
+    # QUOTE_NONNUMERIC: пустой комментарий остаётся пустой строкой, а не NULL
+    csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(rows)
+    buffer.seek(0)
+
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            create_record_partitions(cur, prefix, min(row[4] for row in rows))
+            cur.execute(
+                """
+                CREATE TEMP TABLE backfill_records (
+                    employee_telegram_id BIGINT,
+                    category_code VARCHAR(10),
+                    phone VARCHAR(20),
+                    comment TEXT,
+                    timestamp TIMESTAMPTZ
+                ) ON COMMIT DROP
+                """
+            )
+            cur.copy_expert("COPY backfill_records FROM STDIN WITH (FORMAT csv)", buffer)
+            # Индекс records_duplicate_idx: одна короткая проверка на строку
+            cur.execute(
+                """
+                INSERT INTO records (department, employee_telegram_id, category_code, phone, comment, timestamp)
+                SELECT %(department)s, b.employee_telegram_id, b.category_code, b.phone, b.comment, b.timestamp
+                FROM backfill_records b
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM records r
+                    WHERE r.department = %(department)s
+                    AND r.employee_telegram_id = b.employee_telegram_id
+                    AND r.category_code = b.category_code
+                    AND r.phone = b.phone
+                    AND r.timestamp > b.timestamp - INTERVAL '1 second'
+                    AND r.timestamp < b.timestamp + make_interval(secs => %(match_seconds)s)
+                )
+                ORDER BY b.timestamp
+                """,
+                {'department': department, 'match_seconds': match_seconds}
+            )
+            inserted = cur.rowcount
+        conn.commit()
+        return inserted
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_conn(conn)
+
+# ==========================================
+# ВЕБХУК TELEGRAM
+# ==========================================
+
+WEBHOOK_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+WEBHOOK_MAX_BODY = 1024 * 1024  # обновление Telegram - единицы КБ
+WEBHOOK_STOP_TIMEOUT = 5        # ожидание запросов, принятых до остановки, сек
+
+def check_webhook_config():
+    """Публичный вебхук без секрета принимает любой POST - не запускаемся"""
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise SystemExit("❌ WEBHOOK_URL задан без WEBHOOK_SECRET: задайте секрет вебхука")
+
+def start_dispatcher(updater):
+    """Запустить Dispatcher и JobQueue без встроенного polling/webhook Updater"""
+    updater.job_queue.start()
+    thread = threading.Thread(target=updater.dispatcher.start, name="dispatcher", daemon=True)
+    thread.start()
+    return thread
+
+def set_webhook(bot):
+    """Зарегистрировать вебхук в Telegram (если задан публичный WEBHOOK_URL)"""
+    if not WEBHOOK_URL:
+        log.warning("WEBHOOK_URL не задан - setWebhook не вызывается")
+        return
+    bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        api_kwargs={"secret_token": WEBHOOK_SECRET} if WEBHOOK_SECRET else None
+    )
+
+def decode_webhook_update(path, secret, body, bot):
+    """Проверить запрос вебхука, вернуть (HTTP-статус, Update или None)"""
+    if path.split("?", 1)[0] != WEBHOOK_PATH:
+        return 404, None
+    if WEBHOOK_SECRET and not hmac.compare_digest(secret or "", WEBHOOK_SECRET):
+        return 403, None
+    try:
+        update = Update.de_json(json.loads(body), bot)
+    except (ValueError, TypeError, KeyError) as e:
+        log.warning("webhook: bad update", extra={"error": str(e)})
+        return 400, None
+    return 200, update
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """POST с обновлением -> очередь Dispatcher; ответ сразу, обработка в фоне"""
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0 or length > WEBHOOK_MAX_BODY:
+            # Тело не читаем - соединение закрывается после ответа
+            self.close_connection = True
+            status, update = (413 if length > 0 else 400), None
+        else:
+            status, update = decode_webhook_update(
+                self.path,
+                self.headers.get(WEBHOOK_SECRET_HEADER),
+                self.rfile.read(length),
+                self.server.bot
+            )
+        if update is not None:
+            self.server.dispatcher.update_queue.put(update)
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class WebhookServer(ThreadingHTTPServer):
+    """HTTP-сервер вебхука, не больше max_connections запросов одновременно"""
+
+    daemon_threads = True
+
+    def __init__(self, address, dispatcher, bot, max_connections=WEBHOOK_MAX_CONNECTIONS):
+        super().__init__(address, WebhookRequestHandler)
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.max_connections = max_connections
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request, client_address):
+        # Лишние соединения ждут в backlog, пока не освободится слот
+        self.slots.acquire()
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.slots.release()
+
+    def serve(self):
+        """serve_forever до shutdown(), затем закрыть сокет"""
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+
+    def stop(self, timeout=WEBHOOK_STOP_TIMEOUT):
+        """Перестать принимать соединения и дождаться запросов в обработке"""
+        self.shutdown()
+        deadline = time.monotonic() + timeout
+        for _ in range(self.max_connections):
+            if not self.slots.acquire(timeout=max(0, deadline - time.monotonic())):
+                log.warning("webhook: не дождались запросов в обработке")
+                break
+
+def wait_for_stop_signal():
+    """Ждать SIGINT/SIGTERM (как Updater.idle), вернуть номер сигнала"""
+    received = []
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: received.append(signum))
+    while not received:
+        time.sleep(1)
+    return received[0]
+
+def run_webhook(updater):
+    """Потоковый движок с приёмом обновлений через вебхук"""
+    server = WebhookServer((WEBHOOK_LISTEN, WEBHOOK_PORT), updater.dispatcher, updater.bot)
+    start_dispatcher(updater)
+    threading.Thread(target=server.serve, name="webhook", daemon=True).start()
+    set_webhook(updater.bot)
+    log.info("Бот запущен", extra={"engine": "threads", "ingest": "webhook", "listen": f"{WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}"})
+
+    # Updater.idle() здесь не подходит: без start_polling/start_webhook
+    # Updater не считается запущенным и по сигналу завершает процесс через os._exit
+    signum = wait_for_stop_signal()
+    log.info("Остановка бота", extra={"signal": signal.Signals(signum).name})
+    server.stop()
+    # Dispatcher.stop() дорабатывает очередь обновлений и задачи run_async
+    updater.dispatcher.stop()
+    updater.job_queue.stop()
+
+# ==========================================
+# ASYNCIO-ДВИЖОК
+# ==========================================
+# Приём обновлений (getUpdates / вебхук), очередь CRM, запросы к Bitrix24 и
+# уведомления о результате CRM выполняются в одном event loop на aiohttp +
+# asyncpg, поэтому сотни задач CRM ждут сеть одновременно. Обработчики команд
+# и сообщений (сохранение записей, /info, /export, /team_stats) асинхронными
+# не стали: обновления передаются в Dispatcher, который выполняет их в своих
+# потоках на psycopg2, requests и синхронном Bot - их параллельность
+# по-прежнему ограничена BOT_WORKERS и пулом соединений.
+
+def numbered_placeholders(sql):
+    """%s -> $1, $2, ... (asyncpg использует нумерованные параметры)"""
+    numbers = count(1)
+    return re.sub(r"%s", lambda m: f"${next(numbers)}", sql)
+
+def log_mirror_store_error(future):
+    """done-callback фоновой записи в копию контактов: забрать и залогировать ошибку"""
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        log.warning("contacts mirror error", exc_info=error)
+
+def command_rowcount(status):
+    """Число строк из тега статуса asyncpg ('UPDATE 3' -> 3, 'INSERT 0 1' -> 1)"""
+    last = (status or "").rsplit(" ", 1)[-1]
+    return int(last) if last.isdigit() else 0
+
+class AsyncTelegramClient:
+    """Минимальный асинхронный клиент Bot API"""
+
+    def __init__(self, session, token=BOT_TOKEN, base_url=TELEGRAM_API_URL):
+        self.session = session
+        self.url = f"{base_url}{token}/"
+
+    async def call(self, method, request_timeout=None, **params):
+        timeout = aiohttp.ClientTimeout(total=request_timeout)
+        async with self.session.post(self.url + method, json=params, timeout=timeout) as res:
+            data = await res.json(content_type=None)
+        if not data.get("ok"):
+            raise RuntimeError(f"{method}: {data.get('description')}")
+        return data["result"]
+
+    async def get_updates(self, offset=None, timeout=TELEGRAM_POLL_TIMEOUT):
+        return await self.call(
+            "getUpdates",
+            request_timeout=timeout + 10,
+            offset=offset,
+            timeout=timeout
+        )
+
+    async def send_message(self, chat_id, text, **params):
+        return await self.call("sendMessage", chat_id=chat_id, text=text, **params)
 
-    updater = Updater(BOT_TOKEN, use_context=True)
+class AsyncBitrixClient:
+    """Асинхронный аналог BitrixClient: те же URL методов, таймауты и повторы GET"""
+
+    def __init__(self, session, client=bitrix, retries=BITRIX_RETRIES):
+        self.session = session
+        self.method_url = client.method_url
+        connect_timeout, read_timeout = client.timeout
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.retries = retries
+
+    async def request(self, http_method, method, **kwargs):
+        with BITRIX_ERRORS.labels(method).count_exceptions(), BITRIX_LATENCY.labels(method).time():
+            async with self.session.request(http_method, self.method_url(method), timeout=self.timeout, **kwargs) as res:
+                if res.status >= 400:
+                    raise RuntimeError(f"{method}: HTTP {res.status} {(await res.text())[:200]}")
+                return await res.json(content_type=None)
+
+    async def get(self, method, params=None):
+        for attempt in range(self.retries + 1):
+            try:
+                return await self.request("GET", method, params=params)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(0.3 * (2 ** attempt))
+
+    async def post(self, method, payload=None):
+        return await self.request("POST", method, json=payload)
+
+class AsyncEngine:
+    """
+    Event loop бота: приём обновлений (polling / webhook, None - без приёма)
+    -> Dispatcher и очередь CRM (ASYNC_CRM_CONCURRENCY задач одновременно).
+    """
+
+    def __init__(self, updater, ingest=BOT_INGEST):
+        self.updater = updater
+        self.ingest = ingest
+        self.dispatcher = updater.dispatcher
+        self.session = None
+        self.db = None
+        self.telegram = None
+        self.bitrix = None
+        self.crm_running = set()
+        self.stopping = None
+
+    # ---------- БД ----------
+
+    async def claim_crm_jobs(self, department, limit):
+        try:
+            with DB_LATENCY.labels("claim_crm_jobs").time():
+                rows = await self.db.fetch(
+                    numbered_placeholders(CLAIM_CRM_JOBS_SQL),
+                    float(CRM_OUTBOX_LEASE_SECONDS), department, limit
+                )
+        except Exception:
+            log.exception("claim_crm_jobs error")
+            return []
+        return [dict(row) for row in rows]
+
+    async def update_crm_job(self, job_id, department, **fields):
+        if 'retry_in' in fields:
+            fields['retry_in'] = float(fields['retry_in'])
+        if 'status' in fields:
+            CRM_JOBS.labels(fields['status']).inc()
+        sql, values = update_crm_job_sql(department, job_id, fields)
+        try:
+            with DB_LATENCY.labels("update_crm_job").time():
+                status = await self.db.execute(numbered_placeholders(sql), *values)
+            # Как cur.rowcount > 0 в update_crm_job: задачи уже нет - False
+            return command_rowcount(status) > 0
+        except Exception:
+            log.exception("update_crm_job error")
+            return False
+
+    async def write_crm_job_state(self, job_id, department, **fields):
+        for attempt in range(1, CRM_OUTBOX_STATE_ATTEMPTS + 1):
+            if await self.update_crm_job(job_id, department, **fields):
+                return True
+            if attempt < CRM_OUTBOX_STATE_ATTEMPTS:
+                await asyncio.sleep(crm_state_retry_delay(attempt))
+        return False
+
+    async def save_crm_job_step(self, job_id, department, **fields):
+        if not await self.write_crm_job_state(job_id, department, **fields):
+            raise CrmJobStateError(f"crm job {job_id}: не сохранено {fields}")
+
+    # ---------- Bitrix24 ----------
+
+    async def fetch_contact_by_phone(self, phone, trust_negative=True):
+        """Как fetch_contact_by_phone: кэш -> локальная копия -> crm.contact.list"""
+        norm_phone_full = normalize_phone(phone)
+        cached = contact_cache.get(norm_phone_full)
+        if cached is not TTLCache.MISSING and (cached is not None or trust_negative):
+            return cached
+
+        contact = None
+        if CONTACTS_SYNC_ENABLED:
+            try:
+                row = await self.db.fetchrow(numbered_placeholders(MIRROR_CONTACT_BY_PHONE_SQL), contact_phone_key(norm_phone_full))
+                contact = mirror_contact_to_bitrix(row) if row else None
+            except Exception:
+                log.warning("contacts mirror error", exc_info=True)
+
+        if contact is None:
+            data = await self.bitrix.get("crm.contact.list", params=contact_by_phone_params(norm_phone_full))
+            contact = match_contact_by_phone(data.get("result", []), norm_phone_full)
+            if contact and CONTACTS_SYNC_ENABLED:
+                # Запись в копию - в фоне, ответ не ждёт; ошибку только логируем
+                loop = asyncio.get_running_loop()
+                stored = loop.run_in_executor(None, store_mirror_contacts, [contact])
+                stored.add_done_callback(log_mirror_store_error)
+
+        contact_cache.set(norm_phone_full, contact)
+        return contact
+
+    async def bitrix_result(self, method, payload):
+        data = await self.bitrix.post(method, payload)
+        if "error" in data:
+            raise RuntimeError(f"{method}: {data.get('error_description') or data['error']}")
+        return data.get("result")
+
+    # ---------- Очередь CRM ----------
+
+    async def notify_crm_result(self, job, text):
+        if not job.get('chat_id'):
+            return
+        try:
+            await self.telegram.send_message(
+                job['chat_id'], text,
+                reply_to_message_id=job.get('message_id'),
+                allow_sending_without_reply=True
+            )
+        except Exception as e:
+            log.warning("notify_crm_result error", extra={"error": str(e)})
+
+    async def process_crm_job(self, job, department):
+        """Те же шаги и точки возобновления, что и в process_crm_job"""
+        job_id = job['id']
+        contact_id = job['contact_id']
+        task_id = job['task_id']
+
+        if not contact_id:
+            contact = await self.fetch_contact_by_phone(job['phone'], trust_negative=False)
+            if not contact:
+                await self.save_crm_job_step(job_id, department, status='no_contact', last_error=None)
+                await self.notify_crm_result(job, f"❗ Клієнт {job['phone']} не знайдений у CRM (запис #{job['record_id']})")
+                return
+            contact_id = int(contact['ID'])
+            await self.save_crm_job_step(job_id, department, contact_id=contact_id)
+
+        args = (contact_id, job['category_name'], job['comment'], job['responsible_id'])
+
+        if BITRIX_BATCH_ENABLED:
+            commands = task_batch_commands(*args, task_id=task_id, with_comment=not job['comment_id'])
+            results, errors = batch_results(await self.bitrix.post("batch", batch_payload(commands)))
+            done = {}
+            if not task_id and results.get('task'):
+                done['task_id'] = int(results['task'])
+            if not job['comment_id'] and results.get('comment'):
+                done['comment_id'] = int(results['comment'])
+            if done:
+                await self.save_crm_job_step(job_id, department, **done)
+            if errors:
+                raise RuntimeError(format_batch_errors(errors))
+            await self.save_crm_job_step(job_id, department, status='done', last_error=None)
+            return
+
+        if not task_id:
+            task_id = await self.bitrix_result("task.item.add", task_payload(*args))
+            if not task_id:
+                raise RuntimeError("task.item.add: no task id")
+            await self.save_crm_job_step(job_id, department, task_id=int(task_id))
+
+        if not job['comment_id']:
+            comment_id = await self.bitrix_result("crm.timeline.comment.add", timeline_payload(*args))
+            await self.save_crm_job_step(job_id, department, comment_id=int(comment_id) if comment_id else None)
+
+        await self.bitrix_result("task.complete", {"id": task_id})
+        await self.save_crm_job_step(job_id, department, status='done', last_error=None)
+
+    async def handle_crm_job_error(self, job, department, error):
+        log.warning(
+            "CRM job error",
+            extra={"job_id": job['id'], "department": department, "attempt": job['attempts'], "error": str(error)}
+        )
+        if job['attempts'] >= CRM_OUTBOX_MAX_ATTEMPTS:
+            await self.update_crm_job(job['id'], department, status='failed', last_error=str(error))
+            await self.notify_crm_result(job, f"⚠ Не вдалося створити задачу у Bitrix для запису #{job['record_id']}")
+        else:
+            await self.update_crm_job(
+                job['id'], department,
+                status='pending',
+                last_error=str(error),
+                retry_in=crm_retry_delay(job['attempts'])
+            )
+
+    async def run_crm_job(self, job, department):
+        try:
+            await self.process_crm_job(job, department)
+        except CrmJobStateError as e:
+            await self.mark_crm_job_stuck(job, department, e)
+        except Exception as e:
+            await self.handle_crm_job_error(job, department, e)
+
+    async def mark_crm_job_stuck(self, job, department, error):
+        log.error("CRM job state not saved", extra={"job_id": job['id'], "department": department, "error": str(error)})
+        if await self.write_crm_job_state(job['id'], department, status='stuck', last_error=str(error)):
+            await self.notify_crm_result(job, f"🛑 Запис #{job['record_id']}: стан задачі CRM не збережено, перевірте Bitrix вручну")
+        else:
+            log.error("CRM job not marked stuck", extra={"job_id": job['id'], "department": department})
+
+    async def drain_crm_outbox(self):
+        """Забрать задачи под свободные слоты и запустить их параллельно"""
+        processed = 0
+        for department in DEPARTMENTS:
+            free = ASYNC_CRM_CONCURRENCY - len(self.crm_running)
+            if free <= 0:
+                break
+            for job in await self.claim_crm_jobs(department, free):
+                task = asyncio.create_task(self.run_crm_job(job, department))
+                self.crm_running.add(task)
+                task.add_done_callback(self.crm_running.discard)
+                processed += 1
+        return processed
+
+    async def run_crm_outbox(self):
+        while not self.stopping.is_set():
+            try:
+                processed = await self.drain_crm_outbox()
+            except Exception:
+                log.exception("CRM outbox worker error")
+                processed = 0
+            if not processed:
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), CRM_OUTBOX_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+
+    # ---------- Telegram ----------
+
+    async def handle_webhook(self, request):
+        status, update = decode_webhook_update(
+            request.path_qs,
+            request.headers.get(WEBHOOK_SECRET_HEADER),
+            await request.read(),
+            self.updater.bot
+        )
+        if update is not None:
+            self.dispatcher.update_queue.put(update)
+        return aiohttp.web.Response(status=status)
+
+    async def serve_webhook(self):
+        """Приём обновлений встроенным HTTP-сервером aiohttp"""
+        app = aiohttp.web.Application(client_max_size=WEBHOOK_MAX_BODY)
+        app.router.add_post(WEBHOOK_PATH, self.handle_webhook)
+        runner = aiohttp.web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await aiohttp.web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+            await self.stopping.wait()
+        finally:
+            await runner.cleanup()
+
+    async def poll_updates(self):
+        """Long polling getUpdates -> очередь Dispatcher"""
+        offset = None
+        while not self.stopping.is_set():
+            try:
+                updates = await self.telegram.get_updates(offset)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("getUpdates error", extra={"error": str(e)})
+                await asyncio.sleep(1)
+                continue
+            for data in updates:
+                offset = data['update_id'] + 1
+                self.dispatcher.update_queue.put(Update.de_json(data, self.updater.bot))
+
+    async def run(self):
+        self.stopping = asyncio.Event()
+        # Сигналы принимает только главный поток; движок в другом потоке
+        # (benchmark.py) останавливают через stopping
+        if threading.current_thread() is threading.main_thread():
+            loop = asyncio.get_running_loop()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, self.stopping.set)
+        self.db = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=ASYNC_DB_POOL_MAX)
+        connector = aiohttp.TCPConnector(limit=ASYNC_CRM_CONCURRENCY + 10)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self.session = session
+            self.telegram = AsyncTelegramClient(session)
+            self.bitrix = AsyncBitrixClient(session)
+            tasks = [asyncio.create_task(self.run_crm_outbox())]
+            polling = None
+            if self.ingest == "webhook":
+                tasks.append(asyncio.create_task(self.serve_webhook()))
+            elif self.ingest == "polling":
+                polling = asyncio.create_task(self.poll_updates())
+                tasks.append(polling)
+            stop = asyncio.create_task(self.stopping.wait())
+            try:
+                done, _ = await asyncio.wait([stop, *tasks], return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+            finally:
+                # Сигнал или падение задачи: приём и очередь CRM выходят по stopping,
+                # long polling прерываем; задачи CRM в работе дожидаемся
+                self.stopping.set()
+                if polling is not None:
+                    polling.cancel()
+                await asyncio.gather(*tasks, *self.crm_running, return_exceptions=True)
+                await self.db.close()
+
+def run_async_engine(updater, ingest=BOT_INGEST):
+    """Запуск бота на asyncio-движке"""
+    if aiohttp is None or asyncpg is None:
+        raise SystemExit("❌ Для BOT_ENGINE=asyncio нужны aiohttp и asyncpg: pip install -r requirements-optional.txt")
+
+    start_dispatcher(updater)
+    if ingest == "webhook":
+        set_webhook(updater.bot)
+    else:
+        # В режиме polling вебхук должен быть снят
+        updater.bot.delete_webhook()
+    log.info("Бот запущен", extra={"engine": "asyncio", "ingest": ingest})
+    try:
+        asyncio.run(AsyncEngine(updater, ingest).run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Приём уже остановлен - Dispatcher.stop() дорабатывает очередь обновлений
+        updater.dispatcher.stop()
+        updater.job_queue.stop()
+
+# ==========================================
+# ОШИБКИ
+# ==========================================
+
+def handle_error(update, context: CallbackContext):
+    """Ошибки обработчиков: лог + ответ пользователю при перегрузке БД"""
+    log.error("Handler error", exc_info=context.error)
+    if isinstance(context.error, PoolTimeout) and isinstance(update, Update) and update.effective_message:
+        try:
+            update.effective_message.reply_text("⚠ Сервіс перевантажений, спробуйте ще раз за хвилину")
+        except Exception:
+            pass
+
+# ==========================================
+# MAIN
+# ==========================================
+
+def build_updater(bot=None):
+    """
+    Updater с зарегистрированными обработчиками - общий для обоих движков.
+    bot - готовый telegram.Bot (например, с подменённым Request в benchmark.py)
+    """
+    if bot is None:
+        updater = Updater(BOT_TOKEN, use_context=True, workers=BOT_WORKERS, base_url=TELEGRAM_API_URL)
+    else:
+        updater = Updater(bot=bot, use_context=True, workers=BOT_WORKERS)
     dp = updater.dispatcher
 
+    # Медленные команды (CRM, большие выборки) - в пуле потоков,
+    # чтобы не задерживать обработку остальных сообщений
+
     # Команда /info
-    dp.add_handler(CommandHandler("info", handle_info_command))
+    dp.add_handler(CommandHandler("info", handle_info_command, run_async=True))
 
     # Команда /team_stats
-    dp.add_handler(CommandHandler("team_stats", handle_team_stats_command))
+    dp.add_handler(CommandHandler("team_stats", handle_team_stats_command, run_async=True))
 
     # Команда /export
-    dp.add_handler(CommandHandler("export", handle_export_command))
+    dp.add_handler(CommandHandler("export", handle_export_command, run_async=True))
+
+    # Команда /crm_status
+    dp.add_handler(CommandHandler("crm_status", handle_crm_status_command))
+
+    # Команда /crm_cache
+    dp.add_handler(CommandHandler("crm_cache", handle_crm_cache_command))
+    dp.add_handler(CommandHandler("db_pool", handle_db_pool_command))
 
     # Команда /list_employees
     dp.add_handler(CommandHandler("list_employees", handle_list_employees_command))
@@ -1238,9 +5221,143 @@ def main():
     # Логирование рабочих сообщений
     dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
 
+    dp.add_error_handler(handle_error)
+
+    # Партиции записей наперёд - раз в сутки
+    updater.job_queue.run_repeating(
+        lambda context: ensure_record_partitions(),
+        interval=timedelta(days=1),
+        first=timedelta(hours=1)
+    )
+    return updater
+
+def init_database(migrate=AUTO_MIGRATE):
+    """
+    Пул соединений, миграции, реестр департаментов и их таблицы/партиции.
+    Возвращает список применённых миграций.
+    """
+    init_pool()
+    applied = run_migrations() if migrate else []
+    load_departments()
+    ensure_department_tables()
+    ensure_record_partitions()
+    return applied
+
+def run_bot(engine=BOT_ENGINE, ingest=BOT_INGEST):
+    if ingest == "webhook":
+        check_webhook_config()
+    init_database()
+    start_group_commit_writer()
+    warm_duplicate_index()
+
+    updater = build_updater()
+    start_metrics_server()
+
+    # Локальная копия контактов Bitrix24
+    if CONTACTS_SYNC_ENABLED:
+        start_contacts_sync_worker()
+
+    if engine == "asyncio":
+        run_async_engine(updater, ingest)
+        return
+
+    # Фоновая отправка записей в Bitrix24
+    start_crm_outbox_worker(updater.bot)
+
+    if ingest == "webhook":
+        run_webhook(updater)
+        return
+
     updater.start_polling()
-    print("✅ Бот запущено!")
+    log.info("Бот запущен", extra={"engine": "threads", "ingest": "polling"})
     updater.idle()
 
+def run_migrate(args):
+    """CLI: применить миграции схемы"""
+    applied = init_database(migrate=True)
+    if applied:
+        print(f"✅ Применены миграции: {', '.join(map(str, applied))}")
+    else:
+        print("✅ Схема актуальна")
+
+def check_department_arg(department):
+    """--department проверяется по реестру после его загрузки"""
+    if department and department not in DEPARTMENTS:
+        sys.exit(f"❌ Неизвестный департамент: {department} (есть: {', '.join(DEPARTMENTS)})")
+
+def run_rebuild_rollup(args):
+    """CLI: перестроить дневные агрегаты"""
+    init_database(migrate=False)
+    check_department_arg(args.department)
+    departments = [args.department] if args.department else DEPARTMENTS
+    for department in departments:
+        rows = rebuild_daily_rollup(department)
+        print(f"✅ {department}: {rows} строк дневных агрегатов")
+
+def run_backfill(args):
+    """CLI: загрузить историю из экспорта чата Telegram Desktop"""
+    started = time.monotonic()
+    with open(args.path, encoding="utf-8") as f:
+        export = json.load(f)
+    init_database(migrate=False)
+    check_department_arg(args.department)
+    department = args.department or export_department(export)
+    if not department:
+        sys.exit("❌ Не удалось определить департамент по id чата, укажите --department")
+
+    messages = export.get("messages", [])
+    stats = Counter()
+    rows = parse_export_messages(
+        messages, department, ZoneInfo(args.timezone), stats,
+        progress=lambda n: print(f"⏳ Разобрано {n}/{len(messages)}", flush=True)
+    )
+    print(
+        f"📄 {department}: сообщений {len(messages)}, распознано {len(rows)}, "
+        f"не по формату {stats['rejected']}, неизвестная категория {stats['unknown_category']}, "
+        f"служебные {stats['skipped']}, отправитель не в списке сотрудников {stats['unknown_employee']}",
+        flush=True
+    )
+    if args.dry_run:
+        return
+
+    print(f"⏳ COPY {len(rows)} записей...", flush=True)
+    inserted = copy_backfill_records(rows, department, match_seconds=args.match_seconds)
+    print(
+        f"✅ Добавлено {inserted}, уже были в базе {len(rows) - inserted} "
+        f"({time.monotonic() - started:.1f} с)"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Бот учёта обращений отдела поддержки")
+    commands = parser.add_subparsers(dest="command")
+
+    run_parser = commands.add_parser("run", help="Запустить бота (по умолчанию)")
+    run_parser.add_argument("--engine", choices=("threads", "asyncio"), default=BOT_ENGINE)
+    run_parser.add_argument("--ingest", choices=("polling", "webhook"), default=BOT_INGEST)
+    commands.add_parser("migrate", help="Применить миграции схемы БД")
+
+    rollup_parser = commands.add_parser("rebuild-rollup", help="Перестроить дневные агрегаты по истории")
+    rollup_parser.add_argument("--department", help="По умолчанию - все департаменты реестра")
+
+    backfill_parser = commands.add_parser("backfill", help="Загрузить историю из экспорта чата Telegram Desktop (JSON)")
+    backfill_parser.add_argument("path", help="result.json из экспорта чата")
+    backfill_parser.add_argument("--department", help="По умолчанию - по id чата в экспорте")
+    backfill_parser.add_argument("--timezone", default=STATS_TIMEZONE,
+                                 help="Часовой пояс поля date в экспортах без date_unixtime")
+    backfill_parser.add_argument("--match-seconds", type=int, default=60,
+                                 help="Окно совпадения с уже сохранёнными записями, с")
+    backfill_parser.add_argument("--dry-run", action="store_true", help="Только разобрать и посчитать")
+
+    args = parser.parse_args()
+    setup_logging()
+    if args.command == "migrate":
+        run_migrate(args)
+    elif args.command == "rebuild-rollup":
+        run_rebuild_rollup(args)
+    elif args.command == "backfill":
+        run_backfill(args)
+    else:
+        run_bot(getattr(args, "engine", BOT_ENGINE), getattr(args, "ingest", BOT_INGEST))
+
 if __name__ == "__main__":
     main()
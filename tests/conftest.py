@@ -0,0 +1,10 @@
+import os
+import sys
+
+# main.py читает обязательные настройки при импорте; тестам БД и сеть не нужны
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/test")
+os.environ.setdefault("BITRIX_CONTACT_URL", "http://bitrix.invalid/rest/1/token/crm.contact.list")
+os.environ.setdefault("BITRIX_TASK_URL", "http://bitrix.invalid/rest/1/token/task.item.add")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,16 @@
+import asyncio
+
+import main
+
+
+def test_mirror_store_error_is_retrieved_and_logged(caplog):
+    async def run():
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, lambda: 1 / 0)
+        future.add_done_callback(main.log_mirror_store_error)
+        await asyncio.wait([future])
+        await asyncio.sleep(0)
+
+    with caplog.at_level("WARNING", logger="bot"):
+        asyncio.run(run())
+    assert any(r.message == "contacts mirror error" and r.exc_info for r in caplog.records)
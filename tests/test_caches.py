@@ -0,0 +1,151 @@
+import pytest
+
+import main
+
+
+class Clock:
+    """Подменяемые time.monotonic / time.time"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    monkeypatch.setattr(main.time, "time", clock)
+    return clock
+
+
+# ---------- TTLCache ----------
+
+def test_ttl_cache_expiry_and_negative_ttl(clock):
+    cache = main.TTLCache(10, ttl=60, negative_ttl=5)
+    cache.set("found", {'ID': "1"})
+    cache.set("missing", None)
+
+    clock.now += 10
+    assert cache.get("found") == {'ID': "1"}
+    assert cache.get("missing") is main.TTLCache.MISSING
+
+    clock.now += 60
+    assert cache.get("found") is main.TTLCache.MISSING
+    assert cache.stats() == {'size': 0, 'hits': 1, 'misses': 2, 'hit_ratio': 1 / 3}
+
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    cache = main.TTLCache(2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("b") is main.TTLCache.MISSING
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_ttl_cache_disabled_by_zero_size(clock):
+    cache = main.TTLCache(0, ttl=60)
+    cache.set("a", 1)
+    assert cache.get("a") is main.TTLCache.MISSING
+
+
+# ---------- DuplicateIndex ----------
+
+KEY = ("support", 1, "CL1", "+380500000001")
+
+
+def test_duplicate_index_needs_warm_and_fits_window(clock):
+    index = main.DuplicateIndex(window_minutes=10)
+    index.add(*KEY)
+
+    assert index.seen(*KEY, minutes=5) is None  # не прогрет - спросить БД
+    index.ready = True
+    assert index.seen(*KEY, minutes=5) is True
+    assert index.seen(*KEY, minutes=15) is None  # шире хранимого окна
+    assert index.seen("support", 2, "CL1", "+380500000001", minutes=5) is False
+
+
+def test_duplicate_index_expiry(clock):
+    index = main.DuplicateIndex(window_minutes=10)
+    index.ready = True
+    index.add(*KEY)
+
+    clock.now += 4 * 60
+    assert index.seen(*KEY, minutes=5) is True
+    clock.now += 2 * 60
+    assert index.seen(*KEY, minutes=5) is False
+
+    clock.now += 10 * 60
+    index.seen(*KEY, minutes=5)
+    assert index.stats()['size'] == 0
+
+
+def test_duplicate_index_keeps_newer_time_of_key(clock):
+    index = main.DuplicateIndex(window_minutes=10)
+    index.ready = True
+    index.add(*KEY)
+    clock.now += 8 * 60
+    index.add(*KEY)
+    clock.now += 3 * 60
+
+    # Корзина первой записи удалена, ключ остался по второй
+    assert index.seen(*KEY, minutes=5) is True
+
+
+# ---------- InfoCache ----------
+
+def test_info_cache_invalidates_all_periods_of_phone(clock):
+    cache = main.InfoCache(10, ttl=300)
+    for days in (7, 30):
+        cache.set("support", "+1", days, {'total': days}, clock())
+    cache.set("support", "+2", 7, {'total': 1}, clock())
+    cache.set("pre_trial", "+1", 7, {'total': 1}, clock())
+
+    cache.invalidate("support", "+1")
+
+    assert cache.get("support", "+1", 7) is main.InfoCache.MISSING
+    assert cache.get("support", "+1", 30) is main.InfoCache.MISSING
+    assert cache.get("support", "+2", 7) == {'total': 1}
+    assert cache.get("pre_trial", "+1", 7) == {'total': 1}
+
+
+def test_info_cache_skips_summary_started_before_invalidation(clock):
+    cache = main.InfoCache(10, ttl=300)
+    started_at = clock()
+    clock.now += 1
+    cache.invalidate("support", "+1")
+    cache.set("support", "+1", 7, {'total': 0}, started_at)
+    assert cache.get("support", "+1", 7) is main.InfoCache.MISSING
+
+    clock.now += 1
+    cache.set("support", "+1", 7, {'total': 1}, clock())
+    assert cache.get("support", "+1", 7) == {'total': 1}
+
+
+def test_info_cache_clear_and_expiry(clock):
+    cache = main.InfoCache(10, ttl=300)
+    started_at = clock()
+    cache.clear()
+    cache.set("support", "+1", 7, {'total': 1}, started_at)
+    assert cache.get("support", "+1", 7) is main.InfoCache.MISSING
+
+    clock.now += 1
+    cache.set("support", "+1", 7, {'total': 1}, clock())
+    clock.now += 301
+    assert cache.get("support", "+1", 7) is main.InfoCache.MISSING
+    assert cache.stats()['size'] == 0
+
+
+def test_info_cache_lru(clock):
+    cache = main.InfoCache(2, ttl=300)
+    for phone in ("+1", "+2", "+3"):
+        clock.now += 1
+        cache.set("support", phone, 7, phone, clock())
+
+    assert cache.get("support", "+1", 7) is main.InfoCache.MISSING
+    assert cache.stats()['size'] == 2
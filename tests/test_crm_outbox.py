@@ -0,0 +1,70 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+JOB = {'id': 7, 'record_id': 42, 'chat_id': None, 'attempts': 1}
+
+
+@pytest.fixture
+def updates(monkeypatch):
+    """update_crm_job, который первые fail_times вызовов не записывает шаг"""
+    calls = []
+    state = {'fail_times': 0}
+
+    def update_crm_job(job_id, department, **fields):
+        calls.append(fields)
+        return len(calls) > state['fail_times']
+
+    monkeypatch.setattr(main, "update_crm_job", update_crm_job)
+    monkeypatch.setattr(main.time, "sleep", lambda seconds: None)
+    return calls, state
+
+
+def test_state_write_is_retried_until_saved(updates):
+    calls, state = updates
+    state['fail_times'] = 2
+    main.save_crm_job_step(7, "support", task_id=100)
+    assert calls == [{'task_id': 100}] * 3
+
+
+def test_unsaved_step_marks_job_stuck(updates, monkeypatch):
+    calls, state = updates
+    state['fail_times'] = main.CRM_OUTBOX_STATE_ATTEMPTS
+    monkeypatch.setattr(main, "DEPARTMENTS", ("support",))
+    monkeypatch.setattr(main, "claim_crm_jobs", lambda department: [dict(JOB)])
+    monkeypatch.setattr(main, "process_crm_job", lambda job, department, bot: main.save_crm_job_step(job['id'], department, task_id=100))
+
+    assert main.drain_crm_outbox() == 1
+    assert calls[-1]['status'] == 'stuck'
+    assert all(fields == {'task_id': 100} for fields in calls[:main.CRM_OUTBOX_STATE_ATTEMPTS])
+
+
+def test_stuck_jobs_are_not_claimed():
+    assert "AND status IN ('pending', 'processing')" in main.CLAIM_CRM_JOBS_SQL
+    assert 'stuck' in main.CRM_STATUS_LABELS
+
+
+def test_async_engine_marks_job_stuck(monkeypatch):
+    engine = main.AsyncEngine(SimpleNamespace(dispatcher=None))
+    calls = []
+
+    async def update_crm_job(job_id, department, **fields):
+        calls.append(fields)
+        return 'status' in fields
+
+    async def process_crm_job(job, department):
+        await engine.save_crm_job_step(job['id'], department, task_id=100)
+
+    async def sleep(seconds):
+        pass
+
+    monkeypatch.setattr(engine, "update_crm_job", update_crm_job)
+    monkeypatch.setattr(engine, "process_crm_job", process_crm_job)
+    monkeypatch.setattr(main.asyncio, "sleep", sleep)
+
+    asyncio.run(engine.run_crm_job(dict(JOB), "support"))
+    assert len(calls) == main.CRM_OUTBOX_STATE_ATTEMPTS + 1
+    assert calls[-1]['status'] == 'stuck'
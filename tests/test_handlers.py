@@ -0,0 +1,121 @@
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+SUPPORT_CHAT_ID = main.department_by_name["support"]["chat_id"]
+KEY = ("support", 1, "CL1", "+380631234567")
+
+
+class FakeMessage:
+    def __init__(self, text, user_id=1):
+        self.text = text
+        self.chat_id = SUPPORT_CHAT_ID
+        self.message_id = 1
+        self.from_user = SimpleNamespace(id=user_id, full_name="Alice")
+        self.replies = []
+
+    def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.calls = []
+
+    def run_async(self, func, *args, update=None, **kwargs):
+        self.calls.append((func, args, kwargs))
+
+
+@pytest.fixture
+def memory_storage(monkeypatch):
+    storage = main.MemoryStorage()
+    storage.add_employee(1, "Alice", 10, "support")
+    storage.add_category("CL1", "Call", "support")
+    monkeypatch.setattr(main, "storage", storage)
+    monkeypatch.setattr(main, "duplicate_index", None)
+    monkeypatch.setattr(main, "info_cache", None)
+    main.invalidate_reference_data("support")
+    main.saving_records.clear()
+    yield storage
+    main.invalidate_reference_data("support")
+    main.saving_records.clear()
+
+
+def send(text):
+    message = FakeMessage(text)
+    context = SimpleNamespace(user_data={}, dispatcher=FakeDispatcher())
+    main.handle_message(SimpleNamespace(message=message), context)
+    return message, context
+
+
+def test_reserve_record_is_exclusive():
+    assert main.reserve_record(KEY)
+    assert not main.reserve_record(KEY)
+    main.release_record(KEY)
+    assert main.reserve_record(KEY)
+    main.release_record(KEY)
+
+
+def test_resolve_message_context(memory_storage):
+    memory_storage.add_record(1, "CL1", "+380631234567", "a", "support")
+
+    context = main.resolve_message_context(1, "cl1", "+380631234567", "support")
+    assert context['category']['name'] == "Call"
+    assert context['employee']['name'] == "Alice"
+    assert context['is_duplicate'] is True
+
+    unknown = main.resolve_message_context(3, "XX", "+380631234567", "support")
+    assert unknown == {'category': None, 'employee': None, 'is_duplicate': False}
+
+
+def test_new_record_is_handed_off_with_reservation(memory_storage):
+    message, context = send("CL1 0631234567 | call")
+
+    [(func, _, kwargs)] = context.dispatcher.calls
+    assert func is main.save_record and kwargs["reservation"] == KEY
+    # Ключ держится до конца save_record
+    assert KEY in main.saving_records
+
+
+def test_record_in_flight_is_a_duplicate(memory_storage):
+    main.reserve_record(KEY)
+
+    message, context = send("CL1 0631234567 | call")
+
+    assert context.dispatcher.calls == []
+    assert context.user_data["awaiting_duplicate_confirmation"] is True
+    assert "Продовжити?" in message.replies[0]
+
+
+def test_key_is_reserved_before_duplicate_check(memory_storage, monkeypatch):
+    seen_reserved = []
+    original = main.resolve_message_context
+
+    def resolve(*args, **kwargs):
+        seen_reserved.append(KEY in main.saving_records)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(main, "resolve_message_context", resolve)
+    memory_storage.add_record(1, "CL1", "+380631234567", "saved", "support")
+
+    message, context = send("CL1 0631234567 | call")
+
+    assert seen_reserved == [True]
+    assert context.dispatcher.calls == []
+    # Дубликат из БД: ключ освобождён
+    assert KEY not in main.saving_records
+
+
+def test_department_command_outside_department_chat_lists_registry(monkeypatch):
+    monkeypatch.setattr(main, "department_by_name", {
+        "support": {"name": "support", "chat_id": SUPPORT_CHAT_ID, "title": "Підтримка"},
+        "sales": {"name": "sales", "chat_id": -42, "title": None},
+    })
+    message = FakeMessage("/info +380631234567, 7")
+    message.chat_id = 12345
+
+    main.handle_info_command(SimpleNamespace(message=message), SimpleNamespace(user_data={}))
+
+    assert message.replies == ["❌ Ця команда доступна тільки в чатах відділів: Підтримка, sales"]
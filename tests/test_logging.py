@@ -0,0 +1,17 @@
+import json
+import logging
+
+import main
+
+
+def test_json_formatter_keeps_extra_but_not_sample_marker():
+    record = logging.makeLogRecord({
+        "name": "bot", "levelname": "INFO", "msg": "rejected %s", "args": ("x",),
+        "department": "support", "length": 12, "sample": 0.01
+    })
+
+    entry = json.loads(main.JsonFormatter().format(record))
+
+    assert entry["msg"] == "rejected x"
+    assert entry["department"] == "support" and entry["length"] == 12
+    assert "sample" not in entry
@@ -0,0 +1,121 @@
+from datetime import timedelta
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def storage():
+    storage = main.MemoryStorage()
+    storage.add_employee(1, "Alice", 10, "support")
+    storage.add_employee(2, "Bob", 20, "support")
+    storage.add_category("CL1", "Call", "support")
+    storage.add_category("EM", "Email", "support")
+    return storage
+
+
+def age(storage, record_id, department, delta):
+    """Сдвинуть время записи в прошлое (записи общие для records и by_phone)"""
+    for record in storage.records[department]:
+        if record['id'] == record_id:
+            record['timestamp'] -= delta
+            key = (department, record['employee_telegram_id'], record['category_code'], record['phone'])
+            storage.last_seen[key] = record['timestamp']
+            return
+    raise KeyError(record_id)
+
+
+def test_reference_upserts(storage):
+    storage.add_employee(1, "Alice Smith", 11, "support")
+    storage.add_category("CL1", "Phone call", "support")
+
+    assert storage.get_employee(1, "support") == {'telegram_id': 1, 'name': "Alice Smith", 'bitrix_id': 11}
+    assert [emp['name'] for emp in storage.get_employees("support")] == ["Alice Smith", "Bob"]
+    assert [cat['code'] for cat in storage.get_categories("support")] == ["CL1", "EM"]
+    assert storage.get_category("CL1", "support")['name'] == "Phone call"
+    assert storage.get_employees("pre_trial") == []
+
+
+def test_delete_reports_whether_row_existed(storage):
+    assert storage.delete_employee(2, "support") is True
+    assert storage.delete_employee(2, "support") is False
+    assert storage.delete_category("EM", "support") is True
+    assert storage.get_category("EM", "support") is None
+
+
+def test_add_record_ids_and_crm_job(storage):
+    first = storage.add_record(1, "CL1", "+380500000001", "a", "support")
+    second = storage.add_record(2, "EM", "+380500000002", "b", "pre_trial", crm_job={'responsible_id': 20})
+
+    assert second == first + 1
+    assert storage.crm_jobs == [{
+        'responsible_id': 20, 'record_id': second, 'department': "pre_trial",
+        'phone': "+380500000002", 'comment': "b"
+    }]
+
+
+def test_duplicate_window(storage):
+    record_id = storage.add_record(1, "CL1", "+380500000001", "a", "support")
+
+    assert storage.has_recent_record(1, "CL1", "+380500000001", "support", 5)
+    assert not storage.has_recent_record(2, "CL1", "+380500000001", "support", 5)
+    assert not storage.has_recent_record(1, "EM", "+380500000001", "support", 5)
+    assert not storage.has_recent_record(1, "CL1", "+380500000001", "pre_trial", 5)
+
+    age(storage, record_id, "support", timedelta(minutes=6))
+    assert not storage.has_recent_record(1, "CL1", "+380500000001", "support", 5)
+    assert storage.has_recent_record(1, "CL1", "+380500000001", "support", 10)
+
+
+def test_recent_records(storage):
+    old = storage.add_record(1, "CL1", "+380500000001", "a", "support")
+    storage.add_record(2, "EM", "+380500000002", "b", "support")
+    age(storage, old, "support", timedelta(minutes=30))
+
+    assert [r['phone'] for r in storage.recent_records("support", 10)] == ["+380500000002"]
+
+
+def test_records_by_phone_newest_first_within_window(storage):
+    old = storage.add_record(1, "CL1", "+380500000001", "old", "support")
+    storage.add_record(1, "CL1", "+380500000001", "first", "support")
+    storage.add_record(3, "XX", "+380500000001", "second", "support")
+    storage.add_record(1, "CL1", "+380500000002", "other phone", "support")
+    age(storage, old, "support", timedelta(days=8))
+
+    records = storage.get_records_by_phone("+380500000001", 7, "support")
+
+    assert [r['comment'] for r in records] == ["second", "first"]
+    assert records[0]['employee_name'] is None and records[0]['category_name'] is None
+    assert records[0]['category_code'] == "XX"
+    assert records[1]['employee_name'] == "Alice" and records[1]['category_name'] == "Call"
+    assert len(storage.get_records_by_phone("+380500000001", 30, "support")) == 3
+
+
+def test_team_stats(storage):
+    old = storage.add_record(2, "EM", "+380500000009", "old", "support")
+    for phone in ("+380500000001", "+380500000002"):
+        storage.add_record(1, "CL1", phone, "", "support")
+    storage.add_record(2, "EM", "+380500000003", "", "support")
+    storage.add_record(1, "CL1", "+380500000004", "", "pre_trial")
+    age(storage, old, "support", timedelta(days=2))
+
+    stats = storage.get_team_stats(1, "support")
+
+    assert stats['total'] == 3
+    assert stats['by_employee'] == [{'name': "Alice", 'count': 2}, {'name': "Bob", 'count': 1}]
+    assert stats['by_category'] == [
+        {'name': "Call", 'code': "CL1", 'count': 2},
+        {'name': "Email", 'code': "EM", 'count': 1}
+    ]
+    assert storage.get_team_stats(3, "support")['total'] == 4
+    assert storage.get_team_stats(1, "sales") == {'total': 0, 'by_employee': [], 'by_category': []}
+
+
+def test_storage_interface_is_abstract():
+    class Incomplete(main.Storage):
+        def get_employee(self, telegram_id, department):
+            return None
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,44 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def matcher():
+    return main.CategoryMatcher(["CL1", "cl10", "EM"])
+
+
+def test_longest_code_wins(matcher):
+    assert matcher.match("CL10 +380631234567 | callback") == ("CL10", "+380631234567", "callback")
+    assert matcher.match("CL1 0631234567 | call") == ("CL1", "0631234567", "call")
+
+
+def test_case_insensitive_and_multiline_comment(matcher):
+    assert matcher.match("  em 380631234567|line 1\nline 2 ") == ("em", "380631234567", "line 1\nline 2")
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "hello | world",
+    "CL1 0631234567 without separator",
+    "XX 0631234567 | unknown code",
+    "CL1 phone | not digits",
+])
+def test_not_a_work_message(matcher, text):
+    assert matcher.match(text) is None
+
+
+@pytest.mark.parametrize("value, key", [
+    ("+38 (063) 123-45-67", "+380631234567"),
+    ("0631234567", "+380631234567"),
+    ("380631234567", "+380631234567"),
+    ("+33 6 12 34 56 78", "+33612345678"),
+    ("+48 601 234 567", "+48601234567"),
+])
+def test_contact_phone_key(value, key):
+    assert main.contact_phone_key(value) == key
+
+
+def test_contact_phones_do_not_collapse_foreign_numbers():
+    contact = {"PHONE": [{"VALUE": "+33 631234567"}, {"VALUE": ""}, {"VALUE": "063 123 45 67"}]}
+    assert main.contact_phones(contact) == {"+33631234567", "+380631234567"}
@@ -0,0 +1,114 @@
+import pytest
+
+import main
+
+
+def test_numbered_placeholders():
+    assert main.numbered_placeholders("a = %s AND b IN (%s, %s)") == "a = $1 AND b IN ($2, $3)"
+
+
+def test_numbered_placeholders_match_update_values():
+    sql, values = main.update_crm_job_sql("support", 7, {'status': 'pending', 'retry_in': 30.0})
+    numbered = main.numbered_placeholders(sql)
+    assert "%s" not in numbered
+    assert f"${len(values)}" in numbered and f"${len(values) + 1}" not in numbered
+
+
+@pytest.mark.parametrize("status, rows", [
+    ("UPDATE 1", 1),
+    ("UPDATE 0", 0),
+    ("INSERT 0 5", 5),
+    ("CREATE TABLE", 0),
+    (None, 0),
+])
+def test_command_rowcount(status, rows):
+    assert main.command_rowcount(status) == rows
+
+
+def test_update_crm_job_sql_is_scoped_to_department():
+    sql, values = main.update_crm_job_sql("support", 7, {'task_id': 100, 'status': 'done'})
+    assert sql == (
+        "UPDATE crm_outbox SET task_id = %s, status = %s, updated_at = NOW() "
+        "WHERE id = %s AND department = %s"
+    )
+    assert values == (100, 'done', 7, "support")
+
+
+def test_update_crm_job_sql_retry_in():
+    sql, values = main.update_crm_job_sql("support", 7, {'status': 'pending', 'retry_in': 30})
+    assert "next_attempt_at = NOW() + make_interval(secs => %s)" in sql
+    assert values == ('pending', 30, 7, "support")
+    assert sql.count("%s") == len(values)
+
+
+def test_claim_crm_jobs_sql_filters_by_department():
+    assert "WHERE department = %s" in main.CLAIM_CRM_JOBS_SQL
+    # (аренда, департамент, лимит)
+    assert main.CLAIM_CRM_JOBS_SQL.count("%s") == 3
+
+
+def test_crm_job_row_matches_insert_columns():
+    crm_job = {'category_name': "Call", 'responsible_id': 10, 'chat_id': -1}
+    row = main.crm_job_row("support", 42, "+380631234567", "call", crm_job)
+    assert row == ("support", 42, "+380631234567", "Call", "call", 10, -1, None)
+
+
+@pytest.mark.parametrize("raw", [False, True])
+def test_export_records_sql_joins_references_by_department(raw):
+    sql = main.export_records_sql(raw=raw)
+    assert "LEFT JOIN employees e ON e.department = r.department" in sql
+    assert "LEFT JOIN categories c ON c.department = r.department" in sql
+    assert sql.count("%s") == 2
+
+
+def test_raw_export_columns_follow_raw_export_order():
+    sql = main.export_records_sql(raw=True)
+    select = sql.split("FROM records")[0].replace("SELECT", "")
+    names = [column.strip().split()[-1].split(".")[-1] for column in select.split(",")]
+    assert names == main.RAW_EXPORT_COLUMNS
+
+
+def test_split_team_stats():
+    rows = [
+        {'by_employee': 1, 'by_category': 1, 'employee_name': None, 'category_name': None, 'code': None, 'count': 5},
+        {'by_employee': 0, 'by_category': 1, 'employee_name': "Alice", 'category_name': None, 'code': None, 'count': 3},
+        {'by_employee': 0, 'by_category': 1, 'employee_name': None, 'category_name': None, 'code': None, 'count': 2},
+        {'by_employee': 1, 'by_category': 0, 'employee_name': None, 'category_name': "Call", 'code': "CL1", 'count': 5},
+    ]
+    assert main.split_team_stats(rows) == {
+        'total': 5,
+        'by_employee': [{'name': "Alice", 'count': 3}, {'name': None, 'count': 2}],
+        'by_category': [{'name': "Call", 'code': "CL1", 'count': 5}],
+    }
+
+
+def test_split_team_stats_without_rows():
+    assert main.split_team_stats([]) == {'total': 0, 'by_employee': [], 'by_category': []}
+
+
+def test_bitrix_query_nested_params():
+    query = main.bitrix_query({"filter": {"PHONE": "+380 63"}, "select": ["ID", "NAME"], "notify": True, "x": None})
+    assert query == "filter[PHONE]=%2B380%2063&select[0]=ID&select[1]=NAME&notify=1&x="
+
+
+def test_task_batch_commands_on_retry():
+    commands = main.task_batch_commands(5, "Call", "c", 10, task_id=77, with_comment=False)
+    assert commands == {"complete": ("task.complete", {"id": 77})}
+
+    payload = main.batch_payload(commands, halt=True)
+    assert payload == {"halt": 1, "cmd": {"complete": "task.complete?id=77"}}
+
+
+def test_task_batch_commands_reference_new_task():
+    commands = main.task_batch_commands(5, "Call", "c", 10)
+    assert list(commands) == ["task", "comment", "complete"]
+    assert main.batch_payload(commands)["cmd"]["complete"] == "task.complete?id=%24result%5Btask%5D"
+
+
+def test_batch_results_and_errors():
+    data = {"result": {"result": {"task": 77}, "result_error": {"comment": {"error_description": "denied"}}}}
+    results, errors = main.batch_results(data)
+    assert results == {"task": 77}
+    assert main.format_batch_errors(errors) == "comment: denied"
+    # Пустые словари PHP отдаёт как []
+    assert main.batch_results({"result": {"result": [], "result_error": []}}) == ({}, {})